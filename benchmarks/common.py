@@ -0,0 +1,28 @@
+"""
+Helpers that are shared by the benchmark scripts. The scripts add the
+repository directory to `sys.path` and import this module as
+`benchmarks.common`, so they can be run from any directory.
+"""
+
+
+def percentiles(values, unit='ms'):
+  ''' Returns the median, 90th and 99th percentile and maximum of
+  *values* (in seconds), or None if there are no values. With the *unit*
+  ``'ms'`` the results are in milliseconds, with ``'s'`` in seconds. '''
+
+  if not values:
+    return None
+  values = sorted(values)
+  pick = lambda q: values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+  if unit == 'ms':
+    convert = lambda value: round(value * 1000, 2)
+  elif unit == 's':
+    convert = lambda value: round(value, 1)
+  else:
+    raise ValueError('unknown unit: {!r}'.format(unit))
+  return {
+    'p50_' + unit: convert(pick(0.5)),
+    'p90_' + unit: convert(pick(0.9)),
+    'p99_' + unit: convert(pick(0.99)),
+    'max_' + unit: convert(values[-1]),
+  }
@@ -0,0 +1,235 @@
+"""
+End-to-end benchmark of the build pipeline. A local bare Git repository of
+configurable size is served via `file://`, push events are sent to the
+`/hook/push` view through the Flask test client, and the resulting builds
+are run by the build workers with a configurable number of threads. The
+results are printed as JSON so they can be compared across commits.
+
+The benchmark runs once for every `--history` size, which is the number of
+finished builds in the database, to show how the database size affects the
+views and the webhook.
+
+    $ python benchmarks/pipeline.py --builds 20 --threads 2 --history 0 10000
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+from benchmarks.common import percentiles
+
+REPO_NAME = 'bench/repo'
+SECRET = 'benchmark'
+BUILD_SCRIPT = '#!/bin/sh\nmkdir -p out\ncp -r data out/\necho done\n'
+
+
+def git(*args, cwd=None):
+  subprocess.run(('git',) + args, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+
+
+def create_fixture(directory, num_files, file_size):
+  ''' Creates a bare repository in *directory* with *num_files* files of
+  *file_size* bytes and a build script. Returns the clone URL and the SHA
+  of the commit. '''
+
+  bare = os.path.join(directory, 'repo.git')
+  work = os.path.join(directory, 'work')
+  git('init', '-q', '--bare', bare)
+  git('init', '-q', work)
+  os.makedirs(os.path.join(work, 'data'))
+  for i in range(num_files):
+    with open(os.path.join(work, 'data', 'file{}.bin'.format(i)), 'wb') as fp:
+      fp.write(os.urandom(file_size))
+  script = os.path.join(work, '.flux-build.sh')
+  with open(script, 'w') as fp:
+    fp.write(BUILD_SCRIPT)
+  os.chmod(script, 0o755)
+  git('add', '-A', cwd=work)
+  git('-c', 'user.name=bench', '-c', 'user.email=bench@localhost', 'commit', '-q', '-m', 'fixture', cwd=work)
+  git('push', '-q', bare, 'HEAD:refs/heads/master', cwd=work)
+  sha = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=work).decode().strip()
+  return 'file://' + bare, sha
+
+
+def push_payload(sha):
+  return json.dumps({
+    'ref': 'refs/heads/master',
+    'after': sha,
+    'repository': {'name': REPO_NAME.split('/')[1], 'owner': {'name': REPO_NAME.split('/')[0]}},
+  }).encode('utf8')
+
+
+def add_history(models, num_builds):
+  ''' Adds *num_builds* finished builds to the benchmark repository. '''
+
+  from datetime import datetime, timedelta
+  Build = models.Build
+  with models.session():
+    repo = models.Repository.get(name=REPO_NAME)
+    now = datetime.now()
+    for i in range(num_builds):
+      date = now - timedelta(minutes=num_builds - i)
+      Build(repo=repo, ref='refs/heads/master', commit_sha='0' * 40, num=repo.build_count,
+        status=Build.Status_Success, date_queued=date, date_started=date, date_finished=date)
+      repo.build_count += 1
+
+
+def time_views(client, repeat):
+  results = {}
+  for name, url in [('dashboard', '/'), ('view_repo', '/repo/' + REPO_NAME),
+                    ('api_builds', '/api/v1/builds?repo=' + REPO_NAME)]:
+    times = []
+    for _ in range(repeat):
+      start = time.perf_counter()
+      response = client.get(url)
+      times.append(time.perf_counter() - start)
+      assert response.status_code == 200, (url, response.status_code)
+    results[name] = percentiles(times)
+  return results
+
+
+def run_round(args, client, sha, models, utils, webhooks):
+  Build = models.Build
+  payload = push_payload(sha)
+  signature = 'sha1=' + utils.get_github_signature(SECRET, payload)
+
+  # Send the push events.
+  times = []
+  start = time.perf_counter()
+  for _ in range(args.builds):
+    headers = {'X-Github-Event': 'push', 'X-Hub-Signature': signature,
+               'X-GitHub-Delivery': str(uuid.uuid4())}
+    t = time.perf_counter()
+    response = client.post('/hook/push?api=github', data=payload, headers=headers)
+    times.append(time.perf_counter() - t)
+    assert response.status_code == 202, response.data
+  hook_seconds = time.perf_counter() - start
+
+  # Create the builds from the stored deliveries.
+  with models.session():
+    first_id = (models.orm.max(b.id for b in Build) or 0) + 1
+  start = time.perf_counter()
+  while webhooks.process_deliveries():
+    pass
+  process_seconds = time.perf_counter() - start
+
+  # Wait until the workers finished all builds.
+  start = time.perf_counter()
+  while True:
+    with models.session():
+      pending = models.select(b for b in Build if b.id >= first_id and
+        b.status in (Build.Status_Queued, Build.Status_Building)).count()
+    if not pending:
+      break
+    time.sleep(0.05)
+  build_seconds = time.perf_counter() - start
+
+  with models.session():
+    builds = models.select(b for b in Build if b.id >= first_id)[:]
+    statuses = {}
+    for b in builds:
+      statuses[b.status] = statuses.get(b.status, 0) + 1
+    queue_wait = [(b.date_started - b.date_queued).total_seconds() for b in builds if b.date_started]
+    durations = [(b.date_finished - b.date_started).total_seconds() for b in builds if b.date_started]
+    phases = {}
+    for phase in models.select(p for p in models.BuildPhase if p.build.id >= first_id):
+      phases.setdefault(phase.name, []).append(phase.duration)
+
+  return {
+    'webhook': {
+      'requests': args.builds,
+      'requests_per_second': round(args.builds / hook_seconds, 1),
+      'latency': percentiles(times),
+      'processing_seconds': round(process_seconds, 3),
+    },
+    'builds': {
+      'count': len(builds),
+      'statuses': statuses,
+      'seconds': round(build_seconds, 3),
+      'builds_per_second': round(len(builds) / build_seconds, 2) if build_seconds else None,
+      'queue_wait': percentiles(queue_wait),
+      'duration': percentiles(durations),
+    },
+    'phases_ms': {name: round(statistics.mean(values) * 1000, 2) for name, values in phases.items()},
+  }
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--builds', type=int, default=10, help='push events per round (default: 10)')
+  parser.add_argument('-j', '--threads', type=int, default=1, help='build worker threads (default: 1)')
+  parser.add_argument('--files', type=int, default=100, help='files in the fixture repository (default: 100)')
+  parser.add_argument('--file-size', type=int, default=4096, help='bytes per file (default: 4096)')
+  parser.add_argument('--history', type=int, nargs='+', default=[0],
+    help='numbers of finished builds in the database, one round each (default: 0)')
+  parser.add_argument('--view-repeat', type=int, default=20, help='requests per view (default: 20)')
+  parser.add_argument('-o', '--output', help='write the results to this file')
+  args = parser.parse_args(argv)
+
+  root_dir = tempfile.mkdtemp(prefix='flux-bench-')
+  os.environ['FLUX_ROOT'] = root_dir
+  try:
+    from flux import config
+    config.load(os.path.join(repo_dir, 'flux_config.py'))
+    config.debug = False
+    config.embedded_workers = False
+
+    import flux
+    from flux import app, logger, main as flux_main
+    app.jinja_env.globals['config'] = config
+    app.jinja_env.globals['flux'] = flux
+    app.secret_key = config.secret_key
+    logger.setLevel('WARNING')
+    from flux import views, api, build, models, utils, webhooks
+    flux_main.setup()
+
+    clone_url, sha = create_fixture(os.path.join(root_dir, 'fixture'), args.files, args.file_size)
+    with models.session():
+      models.Repository(name=REPO_NAME, clone_url=clone_url, secret=SECRET, build_count=0)
+
+    client = app.test_client()
+    response = client.post('/login', data={'user_name': config.root_user, 'user_password': config.root_password})
+    assert response.status_code == 302, 'login failed'
+
+    build.run_consumers(num_threads=args.threads)
+    rounds = []
+    try:
+      for size in sorted(args.history):
+        with models.session():
+          history = models.select(b for b in models.Build).count()
+        if size > history:
+          add_history(models, size - history)
+        result = {'history': size, 'views': time_views(client, args.view_repeat)}
+        result.update(run_round(args, client, sha, models, utils, webhooks))
+        if config.database.get('provider') == 'sqlite':
+          result['database_bytes'] = os.path.getsize(config.database['filename'])
+        rounds.append(result)
+    finally:
+      build.stop_consumers()
+  finally:
+    shutil.rmtree(root_dir, ignore_errors=True)
+
+  output = json.dumps({
+    'benchmark': 'pipeline',
+    'python': sys.version.split()[0],
+    'params': {'builds': args.builds, 'threads': args.threads, 'files': args.files, 'file_size': args.file_size},
+    'results': rounds,
+  }, indent=2)
+  if args.output:
+    with open(args.output, 'w') as fp:
+      fp.write(output + '\n')
+  print(output)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,219 @@
+"""
+Replays webhook requests that were recorded with the `webhook_record_file`
+option against a running Flux instance, and reports the latency
+percentiles and the error rate as JSON.
+
+The requests are sent at the recorded pace, scaled by `--speed`, or at a
+fixed `--rate`. They are re-signed with the secret of each repository, read
+from the database of the Flux config passed with `-c` or given with
+`--secret`, and get new delivery IDs so Flux does not ignore them as
+duplicates (unless `--keep-ids` is set).
+
+    $ python benchmarks/replay.py hooks.jsonl -c flux_config.py --speed 10
+    $ python benchmarks/replay.py hooks.jsonl --secret owner/repo=xyz --rate 50 -j 16
+"""
+
+import argparse
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+from benchmarks.common import percentiles
+
+#: Headers that are set by urllib for the replayed request.
+SKIP_HEADERS = {'host', 'content-length', 'connection', 'accept-encoding'}
+
+
+class SecretStore(object):
+  ''' Returns the secret of a repository from the *overrides* or from the
+  database of the loaded Flux config. '''
+
+  def __init__(self, overrides, use_database):
+    self.secrets = dict(overrides)
+    self.use_database = use_database
+
+  def get(self, repo_name):
+    if repo_name not in self.secrets:
+      secret = None
+      if self.use_database:
+        from flux import models
+        with models.session():
+          repo = models.Repository.get(name=repo_name)
+          secret = repo.secret if repo else None
+      self.secrets[repo_name] = secret
+    return self.secrets[repo_name]
+
+
+def prepare(records, secrets):
+  ''' Re-signs the recorded requests. Returns a list of ``(time, api,
+  headers, data)`` tuples and the number of requests that could not be
+  signed because the repository or its secret is unknown. '''
+
+  from flux import webhooks
+  from werkzeug.datastructures import Headers
+
+  result = []
+  unsigned = 0
+  for timestamp, api, headers, data in records:
+    try:
+      repo_name = webhooks.parse_push(api, Headers(headers), data).repo_name
+    except (webhooks.WebhookError, KeyError):
+      repo_name = None
+    secret = secrets.get(repo_name) if repo_name else None
+    if secret is None:
+      unsigned += 1
+    elif api in webhooks.apis:
+      headers, data = webhooks.sign_delivery(api, headers, data, secret)
+    headers = {k: v for k, v in headers.items() if k.lower() not in SKIP_HEADERS}
+    result.append((timestamp, api, headers, data))
+  return result, unsigned
+
+
+def schedule(requests, args):
+  ''' Returns the time offset in seconds at which every request is sent. '''
+
+  offsets = []
+  for i in range(args.repeat):
+    base = len(offsets)
+    if args.rate:
+      offsets.extend((base + j) / args.rate for j in range(len(requests)))
+    else:
+      start = requests[0][0]
+      span = (requests[-1][0] - start) / args.speed
+      pass_offset = i * (span + 1.0 / args.speed)
+      offsets.extend(pass_offset + (r[0] - start) / args.speed for r in requests)
+  return offsets
+
+
+def send(url, api, headers, data, timeout):
+  ''' Sends a single request. Returns the status code, or the name of the
+  exception if the request failed. '''
+
+  target = '{}/hook/push?api={}'.format(url.rstrip('/'), api)
+  request = urllib.request.Request(target, data=data, headers=headers, method='POST')
+  try:
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+      response.read()
+      return response.status
+  except urllib.error.HTTPError as exc:
+    return exc.code
+  except (urllib.error.URLError, OSError) as exc:
+    return type(getattr(exc, 'reason', exc)).__name__
+
+
+def replay(requests, offsets, args):
+  ''' Sends the *requests* from ``args.concurrency`` threads. Returns
+  a list of ``(result, latency, lag)`` tuples, where *lag* is the time the
+  request was sent later than scheduled because all threads were busy. '''
+
+  from flux import webhooks
+
+  jobs = queue.Queue()
+  results = []
+  lock = threading.Lock()
+
+  def worker():
+    while True:
+      job = jobs.get()
+      if job is None:
+        break
+      due, (timestamp, api, headers, data) = job
+      if not args.keep_ids and api in webhooks.delivery_headers:
+        headers = webhooks.new_delivery_id(api, headers)
+      delay = due - time.perf_counter()
+      if delay > 0:
+        time.sleep(delay)
+      start = time.perf_counter()
+      result = send(args.url, api, headers, data, args.timeout)
+      latency = time.perf_counter() - start
+      with lock:
+        results.append((result, latency, max(0.0, start - due)))
+
+  threads = [threading.Thread(target=worker, daemon=True) for _ in range(args.concurrency)]
+  for thread in threads:
+    thread.start()
+  start = time.perf_counter()
+  for i, offset in enumerate(offsets):
+    jobs.put((start + offset, requests[i % len(requests)]))
+  for thread in threads:
+    jobs.put(None)
+  for thread in threads:
+    thread.join()
+  return results, time.perf_counter() - start
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('file', help='JSON lines file written by the webhook_record_file option')
+  parser.add_argument('--url', default='http://localhost:4042', help='URL of the Flux instance (default: http://localhost:4042)')
+  parser.add_argument('-c', '--config-file', help='Flux config to read the repository secrets from')
+  parser.add_argument('--secret', action='append', default=[], metavar='REPO=SECRET',
+    help='secret of a repository, overrides the database (can be repeated)')
+  parser.add_argument('--keep-ids', action='store_true', help='keep the recorded delivery IDs')
+  group = parser.add_mutually_exclusive_group()
+  group.add_argument('--speed', type=float, default=1.0, help='time scale of the recorded pace (default: 1.0)')
+  group.add_argument('--rate', type=float, help='send this many requests per second instead')
+  parser.add_argument('--repeat', type=int, default=1, help='number of passes over the recording (default: 1)')
+  parser.add_argument('-j', '--concurrency', type=int, default=8, help='concurrent requests (default: 8)')
+  parser.add_argument('--timeout', type=float, default=30, help='request timeout in seconds (default: 30)')
+  parser.add_argument('-o', '--output', help='write the results to this file')
+  args = parser.parse_args(argv)
+
+  if args.speed <= 0 or (args.rate is not None and args.rate <= 0):
+    parser.error('--speed and --rate must be positive')
+  overrides = {}
+  for item in args.secret:
+    name, sep, secret = item.partition('=')
+    if not sep:
+      parser.error('invalid --secret {!r}, expected REPO=SECRET'.format(item))
+    overrides[name] = secret
+
+  if args.config_file:
+    from flux import config, models
+    config.load(args.config_file)
+    models.init()
+
+  from flux import webhooks
+  records = sorted(webhooks.read_records(args.file), key=lambda r: r[0])
+  if not records:
+    parser.error('no requests recorded in {!r}'.format(args.file))
+  requests, unsigned = prepare(records, SecretStore(overrides, bool(args.config_file)))
+  offsets = schedule(requests, args)
+  results, seconds = replay(requests, offsets, args)
+
+  codes = {}
+  for result, latency, lag in results:
+    codes[str(result)] = codes.get(str(result), 0) + 1
+  errors = sum(1 for r in results if not (isinstance(r[0], int) and 200 <= r[0] < 300))
+  output = json.dumps({
+    'benchmark': 'replay',
+    'python': sys.version.split()[0],
+    'params': {'file': args.file, 'url': args.url, 'speed': None if args.rate else args.speed,
+               'rate': args.rate, 'repeat': args.repeat, 'concurrency': args.concurrency},
+    'results': {
+      'requests': len(results),
+      'unsigned': unsigned * args.repeat,
+      'seconds': round(seconds, 3),
+      'requests_per_second': round(len(results) / seconds, 1) if seconds else None,
+      'codes': codes,
+      'error_rate': round(errors / len(results), 4),
+      'latency': percentiles([r[1] for r in results]),
+      'lag': percentiles([r[2] for r in results]),
+    },
+  }, indent=2)
+  if args.output:
+    with open(args.output, 'w') as fp:
+      fp.write(output + '\n')
+  print(output)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,104 @@
+"""
+Compares the scheduling policies of the build queue (see
+`flux/scheduling.py`) by replaying the build history of a Flux database.
+Every finished build is queued at its recorded time and takes as long as it
+took, and the simulated wait times of every policy are printed as JSON.
+
+    $ python benchmarks/scheduling.py -c flux_config.py --slots 2 --days 30
+    $ python benchmarks/scheduling.py -c flux_config.py --aging 0.5 1 2
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+from datetime import datetime, timedelta
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+from benchmarks.common import percentiles
+
+
+def load_history(days=None):
+  ''' Returns the finished builds as a list of ``(repo, queued, duration,
+  waited)`` tuples in seconds, ordered by the time they were queued. '''
+
+  from flux import models
+  from flux.models import select, Build
+
+  since = datetime.now() - timedelta(days=days) if days else datetime.min
+  with models.session():
+    rows = select((b.repo.name, b.date_queued, b.date_started, b.date_finished) for b in Build
+      if b.status in (Build.Status_Success, Build.Status_Error)
+      and b.date_started is not None and b.date_finished is not None
+      and b.date_queued >= since).order_by(2)[:]
+  return [(repo, queued.timestamp(), (finished - started).total_seconds(),
+           max(0.0, (started - queued).total_seconds())) for repo, queued, started, finished in rows]
+
+
+def summarize(history, waits):
+  ''' Returns the statistics of the wait times, overall and per repository
+  (ordered by the mean build duration). '''
+
+  repos = {}
+  for (repo, queued, duration, waited), wait in zip(history, waits):
+    repos.setdefault(repo, ([], []))
+    repos[repo][0].append(duration)
+    repos[repo][1].append(wait)
+  slowdown = [(w + d) / d for (r, q, d, x), w in zip(history, waits) if d > 0]
+  return {
+    'mean_wait_s': round(statistics.mean(waits), 2),
+    'wait': percentiles(waits, 's'),
+    'mean_slowdown': round(statistics.mean(slowdown), 3) if slowdown else None,
+    'repos': {
+      repo: {'builds': len(d), 'mean_duration_s': round(statistics.mean(d), 2),
+             'mean_wait_s': round(statistics.mean(w), 2)}
+      for repo, (d, w) in sorted(repos.items(), key=lambda x: statistics.mean(x[1][0]))
+    },
+  }
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-c', '--config-file', help='Flux config of the database to read the history from')
+  parser.add_argument('--slots', type=int, help='number of parallel builds (default: parallel_builds)')
+  parser.add_argument('--days', type=float, help='only replay the builds of the last DAYS days')
+  parser.add_argument('--aging', type=float, nargs='+',
+    help='aging factors to simulate with the sejf policy (default: queue_aging_factor)')
+  parser.add_argument('-o', '--output', help='write the results to this file')
+  args = parser.parse_args(argv)
+
+  from flux import config, models, scheduling
+  config.load(args.config_file)
+  models.init()
+
+  history = load_history(args.days)
+  if not history:
+    parser.error('no finished builds in the database')
+  slots = args.slots or config.parallel_builds
+
+  results = {'recorded': summarize(history, [x[3] for x in history])}
+  builds = [x[:3] for x in history]
+  for name in scheduling.policies:
+    factors = (args.aging or [config.queue_aging_factor]) if name == 'sejf' else [None]
+    for factor in factors:
+      key = name if factor is None else '{}(aging={:g})'.format(name, factor)
+      waits = scheduling.simulate(builds, slots, scheduling.get_policy(name, factor))
+      results[key] = summarize(history, waits)
+
+  output = json.dumps({
+    'benchmark': 'scheduling',
+    'python': sys.version.split()[0],
+    'params': {'builds': len(history), 'slots': slots, 'days': args.days},
+    'results': results,
+  }, indent=2)
+  if args.output:
+    with open(args.output, 'w') as fp:
+      fp.write(output + '\n')
+  print(output)
+
+
+if __name__ == '__main__':
+  main()
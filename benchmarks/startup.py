@@ -0,0 +1,74 @@
+"""
+Measures the startup time of Flux CI entry points. Every scenario runs in
+a fresh Python interpreter with a temporary `FLUX_ROOT`, and the results
+are printed as JSON so they can be compared across commits.
+
+    $ python benchmarks/startup.py -n 10
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_load_config = (
+  'from flux import config; '
+  'config.load({!r}); '.format(os.path.join(repo_dir, 'flux_config.py'))
+)
+
+scenarios = [
+  ('cifile', 'import flux.cifile'),
+  ('main_help', 'import flux.main, contextlib, io\n'
+    'with contextlib.redirect_stdout(io.StringIO()):\n'
+    '  try: flux.main.main(["--help"])\n'
+    '  except SystemExit: pass'),
+  ('worker', _load_config + 'from flux import build, models; models.init()'),
+  ('web', _load_config + 'from flux import views, models; models.init()'),
+  ('ssh_keypair', 'from flux import utils; utils.generate_ssh_keypair()'),
+]
+
+
+def run_scenario(code, root_dir):
+  env = os.environ.copy()
+  env['FLUX_ROOT'] = root_dir
+  env['PYTHONPATH'] = repo_dir + os.pathsep + env.get('PYTHONPATH', '')
+  start = time.perf_counter()
+  subprocess.run([sys.executable, '-c', code], env=env, check=True)
+  return time.perf_counter() - start
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-n', '--repeat', type=int, default=5, help='runs per scenario (default: 5)')
+  parser.add_argument('scenario', nargs='*', help='scenarios to run (default: all)')
+  args = parser.parse_args(argv)
+
+  results = {}
+  root_dir = tempfile.mkdtemp(prefix='flux-bench-')
+  try:
+    for name, code in scenarios:
+      if args.scenario and name not in args.scenario:
+        continue
+      # The first run creates the database and warms the bytecode cache.
+      run_scenario(code, root_dir)
+      times = [run_scenario(code, root_dir) for _ in range(args.repeat)]
+      results[name] = {
+        'median_ms': round(statistics.median(times) * 1000, 1),
+        'min_ms': round(min(times) * 1000, 1),
+        'runs': args.repeat,
+      }
+  finally:
+    shutil.rmtree(root_dir)
+
+  print(json.dumps({'benchmark': 'startup', 'python': sys.version.split()[0], 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+  main()
@@ -21,9 +21,30 @@
 __author__ = 'Niklas Rosenstein <rosensteinniklas@gmail.com>'
 __version__ = '1.1.0'
 
-import flask
+import logging
 import os
+import threading
 
-app = flask.Flask(__name__)
-app.template_folder = os.path.join(os.path.dirname(__file__), 'templates')
-app.static_folder = os.path.join(os.path.dirname(__file__), 'static')
+#: The logger of the package. This is the same logger as `app.logger`,
+#: but using it does not require Flask.
+logger = logging.getLogger(__name__)
+
+_app_lock = threading.Lock()
+
+
+def __getattr__(name):
+  """
+  Creates the Flask #app on first access, so that tools which only need
+  parts of the package (like `python -m flux.cifile`) do not import Flask.
+  """
+
+  if name != 'app':
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+  with _app_lock:
+    if 'app' not in globals():
+      import flask
+      app = flask.Flask(__name__)
+      app.template_folder = os.path.join(os.path.dirname(__file__), 'templates')
+      app.static_folder = os.path.join(os.path.dirname(__file__), 'static')
+      globals()['app'] = app
+  return globals()['app']
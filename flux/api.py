@@ -0,0 +1,368 @@
+# Copyright (c) 2016  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+'''
+The JSON API under ``/api/v1``. Clients authenticate with the session of
+a logged-in user or with HTTP Basic authentication. Requests that change
+the state are rejected if they were sent by another site (see
+:func:`is_cross_site`), as browsers attach the session cookie to them.
+
+Build listings use the keyset pagination of :func:`models.paginate_builds`
+and all ``GET`` responses carry an ``ETag``. For build listings it is
+derived from the last modification of any build and the number of deleted
+builds (see :func:`builds_etag`), which are both read without scanning
+the builds, so that polling clients get a cheap 304 Not Modified response.
+'''
+
+from flux import app, config, estimates, events, metrics, models, utils
+from flux.build import queue_build, restart_build, stop_build, resize_consumers, pool_size, active_builds, autoscaler
+from flux.models import User, Repository, Build, select
+from flask import request, session
+
+import functools
+import hashlib
+import json
+import urllib.parse
+
+API_PREFIX = '/api/v1'
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class ApiError(Exception):
+  ''' Raised by API views to send an error response. '''
+
+  def __init__(self, status, message):
+    super().__init__(message)
+    self.status = status
+    self.message = message
+
+
+def json_response(data, status=200, etag=None):
+  response = app.response_class(json.dumps(data), status, mimetype='application/json')
+  if etag:
+    response.headers['ETag'] = '"{}"'.format(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+  return response
+
+
+def not_modified(etag):
+  ''' Returns a 304 response if the request's ``If-None-Match`` header
+  matches *etag*, otherwise None. '''
+
+  if request.if_none_match and request.if_none_match.contains_weak(etag):
+    response = app.response_class(None, 304)
+    response.headers['ETag'] = '"{}"'.format(etag)
+    return response
+  return None
+
+
+def make_etag(*parts):
+  return hashlib.sha1(repr(parts).encode('utf8')).hexdigest()[:20]
+
+
+def builds_etag(*parts):
+  ''' Returns an ETag for a list of builds. It changes with every build,
+  not only the ones in the list, so that no COUNT is needed: both values
+  are read with an index lookup. '''
+
+  last_modified = select(x.date_modified for x in Build).max()
+  deletions = models.IdSequence.get_value(Build.deletions_counter)
+  return make_etag(last_modified, deletions, estimates.estimator.get_version(), *parts)
+
+
+def is_cross_site(require_origin):
+  ''' Returns True if the request was sent by a page of another site, as
+  indicated by its ``Origin`` (or ``Referer``) header. If the request has
+  neither header, returns *require_origin*. Browsers send the header with
+  every cross-site ``POST`` request, command line clients usually don't. '''
+
+  origin = request.headers.get('Origin') or request.referrer
+  if not origin:
+    return require_origin
+  return urllib.parse.urlsplit(origin).netloc != request.host
+
+
+def api_view(func):
+  ''' Decorator for API views. Authenticates the user (available as
+  ``request.user``), runs the view in a database session and converts
+  :class:`ApiError` exceptions to JSON error responses.
+
+  Requests other than ``GET`` and ``HEAD`` are rejected if they come from
+  another site. Requests that are authenticated with the session cookie
+  must prove that they come from Flux itself with an ``Origin`` or
+  ``Referer`` header. '''
+
+  @functools.wraps(func)
+  @models.session
+  def wrapper(*args, **kwargs):
+    user = None
+    with_cookie = False
+    token = utils.login_token_cache.get(session.get('flux_login_token'))
+    if token and token.ip == request.remote_addr and not token.expired():
+      user = token.user
+      with_cookie = True
+    elif request.authorization:
+      auth = request.authorization
+      db_user = User.get(name=auth.username, passhash=utils.hash_pw(auth.password or ''))
+      if db_user:
+        user = utils.AuthenticatedUser(db_user)
+    if not user:
+      response = json_response({'error': 'authentication required'}, 401)
+      response.headers['WWW-Authenticate'] = 'Basic realm="Flux CI"'
+      return response
+    if request.method not in ('GET', 'HEAD') and is_cross_site(with_cookie):
+      return json_response({'error': 'cross-site request rejected'}, 403)
+    request.user = user
+    try:
+      return func(*args, **kwargs)
+    except ApiError as exc:
+      models.rollback()
+      return json_response({'error': exc.message}, exc.status)
+
+  return wrapper
+
+
+def require_manage():
+  if not request.user.can_manage:
+    raise ApiError(403, 'insufficient privileges')
+
+
+def get_param(name, required=False):
+  ''' Returns a parameter from the JSON body, the form or the query. '''
+
+  data = request.get_json(silent=True) if request.method == 'POST' else None
+  if isinstance(data, dict) and name in data:
+    value = data[name]
+  else:
+    value = request.values.get(name)
+  if isinstance(value, str):
+    value = value.strip()
+  if required and not value:
+    raise ApiError(400, 'missing parameter: {}'.format(name))
+  return value
+
+
+def get_build(build_id):
+  build = Build.get(id=build_id)
+  if not build:
+    raise ApiError(404, 'build not found')
+  return build
+
+
+def format_date(date):
+  return date.isoformat() if date else None
+
+
+def build_to_json(build):
+  data = events.build_event(build)
+  data['url'] = build.url()
+  data['estimate'] = estimate_to_json(estimates.estimator.get(build.id))
+  return data
+
+
+def estimate_to_json(estimate):
+  if not estimate:
+    return None
+  return {
+    'position': estimate.position,
+    'date_started': format_date(estimate.date_started),
+    'date_finished': format_date(estimate.date_finished),
+  }
+
+
+def repo_to_json(repo):
+  latest = repo.latest_build()
+  return {
+    'id': repo.id,
+    'name': repo.name,
+    'build_count': repo.build_count,
+    'latest_build': {
+      'id': latest.id,
+      'num': latest.num,
+      'status': latest.status,
+      'ref': latest.ref,
+      'date_queued': format_date(latest.date_queued),
+      'date_started': format_date(latest.date_started),
+      'date_finished': format_date(latest.date_finished),
+    } if latest else None,
+    'url': repo.url(),
+  }
+
+
+@app.route(API_PREFIX + '/repos')
+@api_view
+def api_repos():
+  repos = select(x for x in Repository).order_by(Repository.name)[:]
+  data = [repo_to_json(x) for x in repos]
+  etag = make_etag(data)
+  return not_modified(etag) or json_response({'repos': data}, etag=etag)
+
+
+@app.route(API_PREFIX + '/builds')
+@api_view
+def api_builds():
+  ''' Lists builds, newest first. Parameters: ``repo`` (the repository
+  name), ``status``, ``ref``, ``commit_sha`` (a prefix), ``limit`` and the
+  ``before`` and ``after`` cursors of the previous response. '''
+
+  query = select(x for x in Build)
+  repo_name = get_param('repo')
+  if repo_name:
+    repo = Repository.get(name=repo_name)
+    if not repo:
+      raise ApiError(404, 'repository not found')
+    query = query.filter(lambda x: x.repo == repo)
+  query = models.filter_builds(query, get_param('status'), get_param('ref'), get_param('commit_sha'))
+
+  try:
+    limit = min(int(get_param('limit') or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE)
+  except ValueError:
+    raise ApiError(400, 'invalid limit')
+  before, after = get_param('before'), get_param('after')
+  for cursor in (before, after):
+    if cursor and not Build.parse_cursor(cursor):
+      raise ApiError(400, 'invalid cursor')
+
+  etag = builds_etag(sorted(request.args.items()))
+  response = not_modified(etag)
+  if response:
+    return response
+
+  builds, older, newer = models.paginate_builds(query, limit, before, after)
+  data = {'builds': [build_to_json(x) for x in builds], 'older': older, 'newer': newer}
+  return json_response(data, etag=etag)
+
+
+@app.route(API_PREFIX + '/queue')
+@api_view
+def api_queue():
+  ''' Lists the running builds and the queued builds in the order in which
+  they start. '''
+
+  etag = builds_etag()
+  response = not_modified(etag)
+  if response:
+    return response
+  running = select(x for x in Build if x.status == Build.Status_Building)\
+    .order_by(Build.date_started)[:]
+  queued = select(x for x in Build if x.status == Build.Status_Queued)\
+    .order_by(Build.date_queued, Build.id)[:]
+  data = {'builds': [build_to_json(x) for x in list(running) + list(queued)]}
+  return json_response(data, etag=etag)
+
+
+@app.route(API_PREFIX + '/builds', methods=['POST'])
+@api_view
+def api_queue_build():
+  ''' Queues a build of ``ref`` for the repository ``repo``. If no
+  ``commit_sha`` is specified, the head of the ref is built. '''
+
+  require_manage()
+  repo = Repository.get(name=get_param('repo', required=True))
+  if not repo:
+    raise ApiError(404, 'repository not found')
+  ref = get_param('ref', required=True)
+  commit_sha = get_param('commit_sha')
+  if commit_sha and len(commit_sha) != 40:
+    raise ApiError(400, 'commit_sha must be a full SHA')
+  if not repo.check_accept_ref(ref):
+    raise ApiError(400, 'ref {!r} is not whitelisted'.format(ref))
+  build = queue_build(repo, ref, commit_sha)
+  return json_response(build_to_json(build), 201)
+
+
+@app.route(API_PREFIX + '/builds/<int:build_id>')
+@api_view
+def api_build(build_id):
+  build = get_build(build_id)
+  etag = make_etag(build.id, build.date_modified, estimates.estimator.get_version())
+  response = not_modified(etag)
+  if response:
+    return response
+  data = build_to_json(build)
+  data['phases'] = [{'name': x.name, 'duration': x.duration} for x in build.phase_timeline()]
+  return json_response(data, etag=etag)
+
+
+@app.route(API_PREFIX + '/builds/<int:build_id>/restart', methods=['POST'])
+@api_view
+def api_restart_build(build_id):
+  require_manage()
+  build = get_build(build_id)
+  if not restart_build(build):
+    raise ApiError(409, 'build is running')
+  return json_response(build_to_json(build))
+
+
+@app.route(API_PREFIX + '/builds/<int:build_id>/stop', methods=['POST'])
+@api_view
+def api_stop_build(build_id):
+  require_manage()
+  build = get_build(build_id)
+  if not stop_build(build):
+    raise ApiError(409, 'build is not queued or running')
+  return json_response(build_to_json(build))
+
+
+@app.route(API_PREFIX + '/workers', methods=['GET', 'POST'])
+@api_view
+def api_workers():
+  ''' Returns the build workers of this process. ``POST`` changes the
+  number of parallel builds to ``size``. '''
+
+  require_manage()
+  if request.method == 'POST':
+    size = get_param('size')
+    if size is None or size == '':
+      raise ApiError(400, 'missing parameter: size')
+    try:
+      size = int(size)
+    except (TypeError, ValueError):
+      raise ApiError(400, 'size must be an integer')
+    if size < 1:
+      raise ApiError(400, 'size must be >= 1')
+    if not pool_size():
+      raise ApiError(409, 'this process does not run build workers')
+    resize_consumers(size)
+  low, high = autoscaler.bounds()
+  check = autoscaler.last_check
+  if check:
+    check = dict(check, date=format_date(check['date']))
+  return json_response({
+    'size': pool_size(),
+    'active_builds': active_builds(),
+    'queued': select(e for e in models.QueueEntry if e.claimed_by is None).count(),
+    'autoscale': {
+      'enabled': bool(config.autoscale),
+      'min_size': low,
+      'max_size': high,
+      'last_check': check,
+    },
+  })
+
+
+@app.route('/metrics')
+@api_view
+def api_metrics():
+  ''' Sends the metrics of this process in the Prometheus text format.
+  Requires the "manage" privilege. '''
+
+  require_manage()
+  return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
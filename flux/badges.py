@@ -0,0 +1,195 @@
+# Copyright (c) 2016  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+'''
+Status badges for repositories. The status of the latest build of every
+repository and ref is kept in memory by a :class:`BadgeCache` that loads
+a repository from the database once and then updates it with the build
+events of :mod:`flux.events`, so serving a badge does not query the
+database.
+'''
+
+from flux import config, events, models
+from flux.models import select, Build, Repository
+from pony import orm
+
+import collections
+import hashlib
+import threading
+import time
+
+# The message and color of the badge for every build status.
+STATUSES = {
+  Build.Status_Queued: ('queued', '#9f9f9f'),
+  Build.Status_Building: ('building', '#dfb317'),
+  Build.Status_Error: ('failing', '#e05d44'),
+  Build.Status_Success: ('passing', '#4c1'),
+  Build.Status_Stopped: ('stopped', '#9f9f9f'),
+  None: ('unknown', '#9f9f9f'),
+}
+
+TEMPLATE = '''<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="20">
+<linearGradient id="s" x2="0" y2="100%"><stop offset="0" stop-color="#bbb" stop-opacity=".1"/><stop offset="1" stop-opacity=".1"/></linearGradient>
+<clipPath id="r"><rect width="{width}" height="20" rx="3" fill="#fff"/></clipPath>
+<g clip-path="url(#r)"><rect width="{label_width}" height="20" fill="#555"/><rect x="{label_width}" width="{message_width}" height="20" fill="{color}"/><rect width="{width}" height="20" fill="url(#s)"/></g>
+<g fill="#fff" text-anchor="middle" font-family="DejaVu Sans,Verdana,Geneva,sans-serif" font-size="11">
+<text x="{label_x}" y="15" fill="#010101" fill-opacity=".3">{label}</text><text x="{label_x}" y="14">{label}</text>
+<text x="{message_x}" y="15" fill="#010101" fill-opacity=".3">{message}</text><text x="{message_x}" y="14">{message}</text>
+</g>
+</svg>
+'''
+
+
+class Badge(object):
+  ''' A rendered badge and its ETag. '''
+
+  def __init__(self, label, message, color):
+    # An approximation of the text width, Verdana 11px is ~7px per glyph.
+    label_width = len(label) * 7 + 10
+    message_width = len(message) * 7 + 10
+    self.svg = TEMPLATE.format(
+      width=label_width + message_width,
+      label_width=label_width,
+      message_width=message_width,
+      label_x=label_width / 2,
+      message_x=label_width + message_width / 2,
+      label=label,
+      message=message,
+      color=color).encode('utf8')
+    self.etag = hashlib.sha1(self.svg).hexdigest()[:20]
+
+
+badges = {status: Badge('build', message, color) for status, (message, color) in STATUSES.items()}
+
+
+class BadgeCache(object):
+  ''' Maps ``(repo_name, ref)`` to the number and status of the latest
+  build. The key ``(repo_name, None)`` holds the latest build of any ref.
+  A repository is loaded on its first request, and the cache subscribes
+  to the build events. Use :meth:`invalidate` when builds are deleted,
+  which does not publish an event; the repository is reloaded on its
+  next request.
+
+  Names of repositories that do not exist are remembered for the
+  ``badge_max_age``, up to *max_unknown* names. Repositories are loaded
+  under one of *num_locks* locks that is picked by the name, so a slow
+  query does not hold up the badges of most other repositories. '''
+
+  def __init__(self, max_unknown=1000, num_locks=16):
+    self.max_unknown = max_unknown
+    self._lock = threading.Lock()
+    self._load_locks = [threading.Lock() for i in range(num_locks)]
+    self._entries = {}
+    self._loaded = set()
+    self._unknown = collections.OrderedDict()  # repo_name -> expiration time
+    self._loading = {}  # repo_name -> events received while it is loaded
+    self._listening = False
+
+  @staticmethod
+  def _update(entries, repo, ref, num, status):
+    for key in ((repo, ref), (repo, None)):
+      entry = entries.get(key)
+      if entry is None or entry[0] <= num:
+        entries[key] = (num, status)
+
+  def _on_event(self, event):
+    with self._lock:
+      self._update(self._entries, event['repo'], event['ref'], event['num'], event['status'])
+      if event['repo'] in self._loading:
+        self._loading[event['repo']].append(event)
+
+  def _load(self, repo_name):
+    # The latest build of a ref is the one with the highest number, like
+    # the latest build of the repository (see Repository.latest_build_num).
+    # Both queries use the (repo_id, num) index. Events that are received
+    # while the rows are loaded are applied on top of them.
+    with self._lock:
+      self._loading[repo_name] = []
+    try:
+      with models.session():
+        repo = Repository.get(name=repo_name)
+        latest = select((b.ref, orm.max(b.num)) for b in Build if b.repo == repo)[:] if repo else []
+        nums = [num for ref, num in latest]
+        rows = select((b.ref, b.num, b.status) for b in Build
+                      if b.repo == repo and b.num in nums)[:] if nums else []
+    except BaseException:
+      with self._lock:
+        self._loading.pop(repo_name)
+      raise
+    entries = {}
+    for ref, num, status in rows:
+      self._update(entries, repo_name, ref, num, status)
+    with self._lock:
+      for event in self._loading.pop(repo_name):
+        self._update(entries, repo_name, event['ref'], event['num'], event['status'])
+      for key in [k for k in self._entries if k[0] == repo_name]:
+        del self._entries[key]
+      self._entries.update(entries)
+      if repo is not None:
+        self._loaded.add(repo_name)
+      else:
+        self._unknown[repo_name] = time.monotonic() + config.badge_max_age.total_seconds()
+        while len(self._unknown) > self.max_unknown:
+          self._unknown.popitem(last=False)
+
+  def _is_loaded(self, repo_name):
+    with self._lock:
+      if repo_name in self._loaded:
+        return True
+      expires = self._unknown.get(repo_name)
+      if expires is None:
+        return False
+      if expires > time.monotonic():
+        return True
+      del self._unknown[repo_name]
+      return False
+
+  def get_status(self, repo_name, ref=None):
+    ''' Returns the status of the latest build of *ref* in the repository
+    *repo_name*, or None if there is no such build. '''
+
+    if not self._is_loaded(repo_name):
+      with self._lock:
+        if not self._listening:
+          events.bus.add_listener(self._on_event)
+          self._listening = True
+      with self._load_locks[hash(repo_name) % len(self._load_locks)]:
+        if not self._is_loaded(repo_name):
+          self._load(repo_name)
+    entry = self._entries.get((repo_name, ref or None))
+    return entry[1] if entry else None
+
+  def invalidate(self, repo_name):
+    with self._lock:
+      self._loaded.discard(repo_name)
+      self._unknown.pop(repo_name, None)
+
+
+badge_cache = BadgeCache()
+
+
+def get_badge(repo_name, ref=None):
+  ''' Returns the :class:`Badge` for the latest build of *ref* in the
+  repository *repo_name*. A *ref* that does not start with ``refs/`` is
+  a branch name. '''
+
+  if ref and not ref.startswith('refs/'):
+    ref = 'refs/heads/' + ref
+  status = badge_cache.get_status(repo_name, ref)
+  return badges.get(status, badges[None])
@@ -21,61 +21,90 @@
 This module implements the Flux worker queue. Flux will start one or
 more threads (based on the ``parallel_builds`` configuration value)
 that will process the queue.
+
+The queue is stored in the database (see :class:`models.QueueEntry`), so
+it survives restarts and can be consumed by several Flux processes that
+share the database. A worker claims an entry with a lease that is renewed
+while the build is running.
+
+The number of worker threads can be changed while they are running with
+:meth:`BuildConsumer.resize`, by hand or by the :class:`Autoscaler`.
 '''
 
-from flux import app, config, utils, models
-from flux.models import select, Build
-from collections import deque
+from flux import config, events, file_utils, metrics, scheduling, utils, models
+from flux import logger as flux_logger
+from flux.models import select, Build, BuildPhase, QueueEntry, Worker
 from threading import Event, Condition, Thread
 from datetime import datetime
-from distutils import dir_util
+from pony import orm
 
 import contextlib
 import os
+import random
 import shlex
 import shutil
+import socket
 import stat
 import subprocess
 import time
 import traceback
+import uuid
 
 
 class BuildConsumer(object):
   ''' This class can start a number of threads that consume
   :class:`Build` objects and execute them. '''
 
+  claim_attempts = 5
+
   def __init__(self):
     self._cond = Condition()
     self._running = False
-    self._queue = deque()
     self._terminate_events = {}
     self._threads = []
+    self._size = 0     # the number of workers the pool is resized to
+    self._workers = 0  # the number of workers that did not exit yet
+    self.worker_id = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
 
   def put(self, build):
-    if not isinstance(build, Build):
-      raise TypeError('expected Build instance')
-    assert build.id is not None
-    # TODO: Check if the build is commited to the database, we should'nt
-    #       enqueue it before it is.
-    if build.status != Build.Status_Queued:
-      raise TypeError('build status must be {!r}'.format(Build.Status_Queued))
+    ''' Adds the *build* to the durable queue in the current database
+    session. The caller must commit the session and then wake up the
+    workers with :meth:`notify`. '''
+
+    self.put_all([build])
+
+  def put_all(self, builds):
+    ''' Like :meth:`put`, but adds all *builds* to the queue. '''
+
+    for build in builds:
+      if not isinstance(build, Build):
+        raise TypeError('expected Build instance')
+      assert build.id is not None
+      if build.status != Build.Status_Queued:
+        raise TypeError('build status must be {!r}'.format(Build.Status_Queued))
+      if not build.queue_entry:
+        QueueEntry(build=build, date_queued=build.date_queued)
+
+  def notify(self):
+    ''' Wakes up the worker threads to claim new queue entries. Workers of
+    other Flux processes find them when they poll the queue. '''
+
     with self._cond:
-      if build.id not in self._queue:
-        self._queue.append(build.id)
-        self._cond.notify()
+      self._cond.notify_all()
 
   def terminate(self, build):
     ''' Given a :class:`Build` object, terminates the ongoing build
     process or removes the build from the queue and sets its status
-    to "stopped". '''
+    to "stopped". Builds that run in another Flux process are stopped
+    by that process when it renews the lease. '''
 
     if not isinstance(build, Build):
       raise TypeError('expected Build instance')
     with self._cond:
       if build.id in self._terminate_events:
         self._terminate_events[build.id].set()
-      elif build.id in self._queue:
-        self._queue.remove(build.id)
+      elif build.queue_entry and not build.queue_entry.claimed_by:
+        build.queue_entry.delete()
       build.status = build.Status_Stopped
 
   def stop(self, join=True):
@@ -83,23 +112,71 @@ class BuildConsumer(object):
       for event in self._terminate_events.values():
         event.set()
       self._running = False
-      self._cond.notify()
+      self._cond.notify_all()
     if join:
       [t.join() for t in self._threads]
 
   def start(self, num_threads=1):
-    def worker():
+    if num_threads < 1:
+      raise ValueError('num_threads must be >= 1')
+    with self._cond:
+      if self._running:
+        raise RuntimeError('already running')
+      self._running = True
+      self._threads = [Thread(target=self._heartbeat, daemon=True)]
+      self._threads[0].start()
+      self._resize(num_threads)
+
+  def resize(self, num_threads):
+    ''' Changes the number of worker threads while the consumer is running.
+    New threads start immediately. When the pool shrinks, idle workers
+    exit and busy workers exit after their current build, so no build is
+    interrupted. '''
+
+    if num_threads < 1:
+      raise ValueError('num_threads must be >= 1')
+    with self._cond:
+      if not self._running:
+        raise RuntimeError('not running')
+      self._resize(num_threads)
+      self._cond.notify_all()
+
+  def _resize(self, num_threads):
+    self._threads = [t for t in self._threads if t.is_alive()]
+    self._size = num_threads
+    while self._workers < self._size:
+      thread = Thread(target=self._worker)
+      self._threads.append(thread)
+      self._workers += 1
+      thread.start()
+
+  def pool_size(self):
+    ''' Returns the number of worker threads that the pool was resized to,
+    or 0 if the consumer is not running. '''
+
+    with self._cond:
+      return self._size if self._running else 0
+
+  def _worker(self):
+    counted = True  # False once this worker removed itself from the count
+    try:
       while True:
         with self._cond:
-          while not self._queue and self._running:
-            self._cond.wait()
-          if not self._running:
+          if not self._running or self._workers > self._size:
+            self._workers -= 1
+            counted = False
             break
-          build_id = self._queue.popleft()
-        with models.session():
-          build = Build.get(id=build_id)
-          if not build or build.status != Build.Status_Queued:
-            continue
+        try:
+          build_id = self._claim()
+        except Exception as exc:
+          # For example "database is locked" while another process writes.
+          traceback.print_exc()
+          build_id = None
+        if build_id is None:
+          with self._cond:
+            if self._running:
+              self._cond.wait(config.queue_poll_interval.total_seconds())
+          continue
         with self._cond:
           do_terminate = self._terminate_events[build_id] = Event()
         try:
@@ -109,40 +186,347 @@ class BuildConsumer(object):
         finally:
           with self._cond:
             self._terminate_events.pop(build_id)
+          try:
+            self._release(build_id)
+          except Exception as exc:
+            traceback.print_exc()
+          metrics.merge_query_stats()
+    finally:
+      # Keep the count in line with the live threads, so that resize()
+      # replaces a worker that died.
+      if counted:
+        with self._cond:
+          self._workers -= 1
+
+  def _heartbeat(self):
+    ''' Registers the pool size (see :class:`models.Worker`) and renews the
+    leases three times per ``queue_lease_duration`` and when the pool is
+    resized. Unregisters the pool when the consumer stops. '''
+
+    interval = config.queue_lease_duration.total_seconds() / 3
+    registered_size = None
+    next_renewal = time.monotonic()
+    while True:
+      with self._cond:
+        if not self._running:
+          break
+        size = self._size
+      if size != registered_size or time.monotonic() >= next_renewal:
+        next_renewal = time.monotonic() + interval
+        try:
+          with models.session():
+            Worker.register(self.worker_id, size)
+          registered_size = size
+          self._renew_leases()
+        except BaseException as exc:
+          traceback.print_exc()
+      with self._cond:
+        if self._running:
+          self._cond.wait(max(0, next_renewal - time.monotonic()))
+    try:
+      with models.session():
+        Worker.select(lambda w: w.worker_id == self.worker_id).delete(bulk=True)
+    except BaseException as exc:
+      traceback.print_exc()
 
-    if num_threads < 1:
-      raise ValueError('num_threads must be >= 1')
+  def is_running(self, build):
     with self._cond:
-      if self._running:
-        raise RuntimeError('already running')
-      self._running = True
-      self._threads = [Thread(target=worker) for i in range(num_threads)]
-      [t.start() for t in self._threads]
+      return build.id in self._terminate_events
 
-  def is_running(self, build):
+  def active_builds(self):
     with self._cond:
-      return build.id in self._queue
+      return len(self._terminate_events)
+
+  def _next_entry(self, now):
+    ''' Returns the next queue entry that is not claimed or whose lease
+    expired according to the ``queue_policy``, locked for update. Entries
+    that another worker is claiming are skipped (``SKIP LOCKED``), so the
+    workers do not wait for each other on the same row, unless the database
+    server does not support it (see :data:`models.skip_locked`). Only the oldest
+    ``queue_policy_window`` entries are considered by policies other than
+    ``fifo``. '''
+
+    if config.queue_policy == 'fifo':
+      return select(e for e in QueueEntry if e.claimed_by is None or e.lease_expires_at < now)\
+        .order_by(QueueEntry.date_queued).for_update(skip_locked=models.skip_locked).first()
+
+    policy = scheduling.get_policy()
+    rows = select((e.build.id, e.date_queued, e.build.repo.name, e.build.repo.duration_estimate)
+      for e in QueueEntry if e.claimed_by is None or e.lease_expires_at < now)\
+      .order_by(2, 1)[:config.queue_policy_window]
+    if not rows:
+      return None
+    expected = scheduling.expected_durations({r[2]: r[3] for r in rows if r[3] is not None})
+    build_id = scheduling.select_next([(expected(repo), (now - date_queued).total_seconds(),
+      (date_queued, build_id), build_id) for build_id, date_queued, repo, estimate in rows], policy)
+    entry = QueueEntry.get_for_update(build=build_id, skip_locked=models.skip_locked)
+    if entry and (entry.claimed_by is None or entry.lease_expired(now)):
+      return entry
+    raise orm.TransactionError('queue entry was claimed concurrently')
+
+  def _claim(self):
+    ''' Claims the next queue entry (see :meth:`_next_entry`). Entries of
+    builds that are no longer queued are removed. Returns the ID of the
+    claimed build, or None. Gives up after :attr:`claim_attempts` lost
+    races, waiting a random and growing delay between the attempts. '''
+
+    failures = 0
+    while True:
+      try:
+        with models.session():
+          now = datetime.now()
+          entry = self._next_entry(now)
+          if not entry:
+            return None
+          build = entry.build
+          if build.status != Build.Status_Queued:
+            if entry.claimed_by and build.status == Build.Status_Building:
+              flux_logger.info('Build {}#{} was interrupted (worker {} died)'.format(
+                build.repo.name, build.num, entry.claimed_by))
+              build.status = Build.Status_Stopped
+            entry.delete()
+            continue
+          entry.claimed_by = self.worker_id
+          entry.lease_expires_at = now + config.queue_lease_duration
+          return build.id
+      except orm.TransactionError as exc:
+        # Another worker claimed the same entry first.
+        flux_logger.debug('Could not claim queue entry: {}'.format(exc))
+        failures += 1
+        if failures >= self.claim_attempts:
+          return None
+        time.sleep(random.uniform(0, 0.05 * 2 ** failures))
+
+  def _release(self, build_id):
+    with models.session():
+      entry = QueueEntry.get(build=build_id)
+      if entry and entry.claimed_by == self.worker_id:
+        entry.delete()
+
+  def _renew_leases(self):
+    ''' Extends the leases of the builds that run in this process and
+    terminates builds that were stopped by another process. '''
+
+    with self._cond:
+      build_ids = list(self._terminate_events)
+    if not build_ids:
+      return
+    with models.session():
+      lease_expires_at = datetime.now() + config.queue_lease_duration
+      for entry in select(e for e in QueueEntry if e.claimed_by == self.worker_id):
+        entry.lease_expires_at = lease_expires_at
+      stopped = select(b.id for b in Build if b.id in build_ids and b.status == Build.Status_Stopped)[:]
+    with self._cond:
+      for build_id in stopped:
+        if build_id in self._terminate_events:
+          self._terminate_events[build_id].set()
+
+
+class Autoscaler(object):
+  ''' Resizes the worker pool of a :class:`BuildConsumer` to the load of
+  the host (see the ``autoscale`` options). Every check resizes the pool
+  by at most one worker: it shrinks if the host is under pressure, and
+  grows if all workers are busy and builds are waiting in the queue. '''
+
+  def __init__(self, consumer):
+    self.consumer = consumer
+    self.thread = None
+    #: The measurements and the decision of the last check, or None.
+    self.last_check = None
+
+  def bounds(self):
+    ''' Returns the minimum and maximum pool size. '''
+
+    high = config.autoscale_max_builds or config.parallel_builds
+    low = max(1, min(config.autoscale_min_builds, high))
+    return low, max(low, high)
+
+  def measure(self):
+    ''' Returns a dictionary of the load average per CPU, the available
+    memory and the free space of the build directory in bytes. Values
+    that are not available on this platform are None. '''
+
+    result = {'load': None, 'free_memory': None, 'free_disk': None}
+    if hasattr(os, 'getloadavg'):
+      result['load'] = os.getloadavg()[0] / (os.cpu_count() or 1)
+    try:
+      with open('/proc/meminfo') as fp:
+        for line in fp:
+          if line.startswith('MemAvailable:'):
+            result['free_memory'] = int(line.split()[1]) * 1024
+            break
+    except OSError:
+      pass
+    if os.path.isdir(config.build_dir):
+      result['free_disk'] = shutil.disk_usage(config.build_dir).free
+    return result
+
+  def check(self):
+    ''' Measures the host and resizes the pool. Returns the new size. '''
+
+    with models.session():
+      queued = select(e for e in QueueEntry if e.claimed_by is None).count()
+    values = self.measure()
+    size = self.consumer.pool_size()
+    low, high = self.bounds()
+
+    reasons = []
+    if values['load'] is not None and values['load'] > config.autoscale_max_load:
+      reasons.append('load {:.2f} per CPU'.format(values['load']))
+    if values['free_memory'] is not None and values['free_memory'] < config.autoscale_min_free_memory:
+      reasons.append('{} memory available'.format(file_utils.human_readable_size(values['free_memory'])))
+    if values['free_disk'] is not None and values['free_disk'] < config.autoscale_min_free_disk:
+      reasons.append('{} disk space free'.format(file_utils.human_readable_size(values['free_disk'])))
+
+    if size > high or (reasons and size > low):
+      new_size = size - 1
+    elif size < low or (not reasons and queued and size < high and self.consumer.active_builds() >= size):
+      new_size = size + 1
+    else:
+      new_size = size
+    if new_size != size:
+      flux_logger.info('Autoscaler: {} parallel builds -> {} ({})'.format(
+        size, new_size, ', '.join(reasons) or '{} queued'.format(queued)))
+      self.consumer.resize(new_size)
+
+    values.update(date=datetime.now(), queued=queued, reasons=reasons, size=new_size)
+    self.last_check = values
+    return new_size
+
+  def start(self):
+    ''' Starts a daemon thread that calls :meth:`check` every
+    ``autoscale_interval`` while the consumer is running. '''
+
+    interval = config.autoscale_interval.total_seconds()
+
+    def autoscaler():
+      while True:
+        time.sleep(interval)
+        if not self.consumer.pool_size():
+          continue
+        try:
+          self.check()
+        except BaseException as exc:
+          traceback.print_exc()
+
+    self.thread = Thread(target=autoscaler, name='Autoscaler', daemon=True)
+    self.thread.start()
+    return self.thread
 
 
 _consumer = BuildConsumer()
 enqueue = _consumer.put
+enqueue_all = _consumer.put_all
+notify_consumers = _consumer.notify
 terminate_build = _consumer.terminate
 run_consumers = _consumer.start
 stop_consumers = _consumer.stop
+resize_consumers = _consumer.resize
+pool_size = _consumer.pool_size
+active_builds = _consumer.active_builds
+autoscaler = Autoscaler(_consumer)
+run_autoscaler = autoscaler.start
+
+
+def queue_build(repo, ref, commit_sha=None):
+  ''' Creates a new build of *ref* for the :class:`models.Repository`
+  *repo*, adds the build to the queue and commits the current session.
+  Without a *commit_sha*, the build checks out the head of *ref*. '''
+
+  build = Build(
+    repo=repo,
+    commit_sha=commit_sha or ('0' * 32),
+    num=repo.build_count,
+    ref=ref,
+    status=Build.Status_Queued,
+    date_queued=datetime.now(),
+    date_started=None,
+    date_finished=None)
+  repo.build_count += 1
+  enqueue(build)
+  models.commit()
+  notify_consumers()
+  events.publish_build(build)
+  return build
+
+
+def restart_build(build):
+  ''' Deletes the results of *build* and adds it to the queue again.
+  Returns False if the build is running. '''
+
+  if build.status == Build.Status_Building:
+    return False
+  build.delete_build()
+  build.phases.select().delete(bulk=True)
+  build.status = Build.Status_Queued
+  build.date_started = None
+  build.date_finished = None
+  enqueue(build)
+  models.commit()
+  notify_consumers()
+  events.publish_build(build)
+  return True
+
+
+def stop_build(build):
+  ''' Stops a queued or running *build* and commits the current session.
+  Returns False if the build is neither queued nor running. '''
+
+  if build.status not in (Build.Status_Queued, Build.Status_Building):
+    return False
+  terminate_build(build)
+  models.commit()
+  events.publish_build(build)
+  return True
 
 
 def update_queue(consumer=None):
-  ''' Make sure all builds in the database that are still queued
-  are actually queued in the BuildConsumer. '''
+  ''' Recovers the durable queue after a restart. Queued builds that
+  have no queue entry (eg. because they were queued by an older version
+  of Flux) are added to the queue. Builds that are still marked as
+  building but have no queue entry can not be running anymore and are
+  marked as stopped. Builds with an expired lease are recovered by the
+  workers when they claim them.
+
+  Returns a tuple of the number of builds that were added to the queue
+  and the number of builds that were marked as stopped. '''
 
   if consumer is None:
     consumer = _consumer
+  queued = stopped = 0
   with models.session():
-    for build in select(x for x in Build if x.status == Build.Status_Queued):
-      enqueue(build)
-    for build in select(x for x in Build if x.status == Build.Status_Building):
+    for build in select(x for x in Build if x.status == Build.Status_Queued and x.queue_entry is None):
+      consumer.put(build)
+      queued += 1
+    for build in select(x for x in Build if x.status == Build.Status_Building and x.queue_entry is None):
       if not consumer.is_running(build):
         build.status = Build.Status_Stopped
+        stopped += 1
+  if queued:
+    consumer.notify()
+  return queued, stopped
+
+
+class PhaseTimer(object):
+  ''' Measures the consecutive phases of a build. :meth:`start` ends the
+  current phase and starts the next one. The phases are recorded as
+  tuples of the phase name, the start date and the duration in seconds. '''
+
+  def __init__(self):
+    self.phases = []
+    self._current = None
+
+  def start(self, name):
+    self.stop()
+    self._current = (name, datetime.now(), time.perf_counter())
+
+  def stop(self):
+    if self._current:
+      name, date, start = self._current
+      seconds = time.perf_counter() - start
+      self.phases.append((name, date, seconds))
+      metrics.build_phase.observe(seconds, phase=name)
+      self._current = None
 
 
 def do_build(build_id, terminate_event):
@@ -154,6 +538,7 @@ def do_build(build_id, terminate_event):
   logfile = None
   logger = None
   status = None
+  timer = PhaseTimer()
 
   with contextlib.ExitStack() as stack:
     try:
@@ -161,10 +546,13 @@ def do_build(build_id, terminate_event):
         # Retrieve the current build information.
         with models.session():
           build = Build.get(id=build_id)
-          app.logger.info('Build {}#{} started.'.format(build.repo.name, build.num))
+          flux_logger.info('Build {}#{} started.'.format(build.repo.name, build.num))
 
           build.status = Build.Status_Building
           build.date_started = datetime.now()
+          build.phases.select().delete(bulk=True)
+          metrics.build_queue_wait.observe(
+            (build.date_started - build.date_queued).total_seconds(), repo=build.repo.name)
 
           build_path = build.path()
           override_path = build.path(Build.Data_OverrideDir)
@@ -174,10 +562,12 @@ def do_build(build_id, terminate_event):
 
           # Prefetch the repository member as it is required in do_build_().
           build.repo
+          models.commit()
+          events.publish_build(build)
 
         # Execute the actual build process (must not perform writes to the
         # 'build' object as the DB session is over).
-        if do_build_(build, build_path, override_path, logger, logfile, terminate_event):
+        if do_build_(build, build_path, override_path, logger, logfile, terminate_event, timer):
           status = Build.Status_Success
         else:
           if terminate_event.is_set():
@@ -189,8 +579,12 @@ def do_build(build_id, terminate_event):
         # Create a ZIP from the build directory.
         if os.path.isdir(build_path):
           logger.info('[Flux]: Zipping build directory...')
+          timer.start('zip')
           utils.zipdir(build_path, build_path + '.zip')
+          metrics.artifact_bytes.inc(os.path.getsize(build_path + '.zip'))
+          timer.start('rmtree')
           utils.rmtree(build_path, remove_write_protection=True)
+          timer.stop()
           logger.info('[Flux]: Done')
 
     except BaseException as exc:
@@ -200,20 +594,34 @@ def do_build(build_id, terminate_event):
         if logger:
           logger.exception(exc)
         else:
-          app.logger.exception(exc)
+          flux_logger.exception(exc)
 
     finally:
+      timer.stop()
+      if logfile:
+        logfile.flush()
+        metrics.log_bytes.inc(os.fstat(logfile.fileno()).st_size)
       with models.session():
         build = Build.get(id=build_id)
         if status is not None:
           build.status = status
         build.date_finished = datetime.now()
+        for name, date, seconds in timer.phases:
+          BuildPhase(build=build, name=name, date_started=date, duration=seconds)
+        build.repo.update_duration_estimate(build)
+        models.commit()
+        events.publish_build(build)
+        if build.date_started:
+          metrics.build_duration.observe(
+            (build.date_finished - build.date_started).total_seconds(),
+            repo=build.repo.name, status=build.status)
 
   return status == Build.Status_Success
 
 
-def do_build_(build, build_path, override_path, logger, logfile, terminate_event):
+def do_build_(build, build_path, override_path, logger, logfile, terminate_event, timer):
   logger.info('[Flux]: build {}#{} started'.format(build.repo.name, build.num))
+  timer.start('clone')
 
   # Clone the repository.
   if build.repo and os.path.isfile(utils.get_repo_private_key_path(build.repo)):
@@ -242,6 +650,7 @@ def do_build_(build, build_path, override_path, logger, logfile, terminate_event
     is_ref_build = False
 
   # Checkout the correct build_start_point.
+  timer.start('checkout')
   checkout_cmd = ['git', 'checkout', build_start_point]
   res = utils.run(checkout_cmd, logger, cwd=build_path)
   if res != 0:
@@ -280,10 +689,13 @@ def do_build_(build, build_path, override_path, logger, logfile, terminate_event
   utils.rmtree(os.path.join(build_path, '.git'), remove_write_protection=True)
 
   # Copy over overridden files if any
+  timer.start('overrides')
   if os.path.exists(override_path):
+    from distutils import dir_util  # imports setuptools, which is slow
     dir_util.copy_tree(override_path, build_path);
 
   # Find the build script that we need to execute.
+  timer.start('script')
   script_fn = None
   for fname in config.build_scripts:
     script_fn = os.path.join(build_path, fname)
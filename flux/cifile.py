@@ -6,8 +6,8 @@
 #
 # vim: sw=4 ts=4 noexpandtab:
 
-import os, sys, threading
-import yaml, re
+import os, sys, threading, time
+import functools, glob, json, yaml, re
 from copy import deepcopy
 
 #########################################################
@@ -47,6 +47,8 @@ class IdGenerator(object):
   """
   A class which provides an ID for jobs & pipelines.
   Supposed to be passed as per-project preserved object.
+  The IDs are kept in memory, see flux.models.SequenceIdGenerator
+  for IDs that are stored in the database.
   """
 
   def __init__(self, last_job_id=0, last_pipeline_id=0):
@@ -189,7 +191,7 @@ class CiFile:
 
     if fyaml:
       with open(fyaml, 'r') as f:
-        dictionary=yaml.load(f.read())
+        dictionary=yaml.safe_load(f.read())
     if dictionary:
       self._parse_cidict(dictionary)
     return self
@@ -581,7 +583,7 @@ class CiFile:
 def get_argument_parser(prog=None):
   import argparse
   parser = argparse.ArgumentParser(prog=prog)
-  parser.add_argument('cifile', nargs='?', default='.ci.yml')
+  parser.add_argument('cifile', nargs='*', default=['.ci.yml'], help='CI file(s), directories or glob patterns. More than one file, a directory or a pattern implies --batch.')
   parser.add_argument('--branch', default='master', help='The brach name for which the pipeline was triggered.')
   parser.add_argument('--source', default='trigger', help='Indicates how the pipeline was triggered.')
   parser.add_argument('--ref', default='0'*32, help='The commit ref for which the pipeline was triggered. Defaults to empty SHA.')
@@ -591,9 +593,72 @@ def get_argument_parser(prog=None):
   parser.add_argument('--dump-matrix', action='store_true', help='Dump the build matrix.')
   parser.add_argument('--dump-run', action='store_true', help='Dump how a run of the CI file would look like.')
   parser.add_argument('--env', default=[], action='append', help='Define an environment variable.')
+  parser.add_argument('--batch', action='store_true', help='Parse and prepare all files in parallel and print JSON lines diagnostics.')
+  parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of worker processes in batch mode. Defaults to the number of CPUs.')
   return parser
 
 
+def expand_cifile_paths(patterns, filename='.ci.yml'):
+  """
+  Expand a list of file paths, directories and glob patterns into a sorted
+  list of unique CI file paths. Directories are searched recursively for
+  files named *filename*. Plain file paths are kept as they are, even if
+  they do not exist, so that they are reported as errors.
+  """
+
+  result = []
+  for pattern in patterns:
+    if os.path.isdir(pattern):
+      matches = glob.glob(os.path.join(pattern, '**', filename), recursive=True)
+    elif glob.has_magic(pattern):
+      matches = glob.glob(pattern, recursive=True)
+    else:
+      matches = [pattern]
+    for path in sorted(matches):
+      if path not in result:
+        result.append(path)
+  return result
+
+
+def lint_cifile(path, branch, source, msg, ref, tag=None, variables=None):
+  """
+  Read and prepare a single CI file and return a JSON serializable dictionary
+  with the diagnostics. This function is executed in the worker processes of
+  #lint_cifiles() and thus must not raise for an invalid file. Interrupts
+  still abort the batch.
+  """
+
+  start = time.perf_counter()
+  result = {'file': path, 'ok': True, 'error': None, 'stages': 0, 'jobs': 0}
+  try:
+    cifile = CiFile(id_generator=IdGenerator(), variables=variables)
+    cifile.read_cifile(path)
+    cifile.prepare_run_with(branch, source, msg, ref, tag)
+    matrix = cifile.convert_to_matrix()
+    result['stages'] = len(matrix[MATRIXKEY_STAGES])
+    result['jobs'] = sum(len(x) for x in matrix[MATRIXKEY_JOBS])
+  except Exception as exc:
+    result['ok'] = False
+    result['error'] = '{}: {}'.format(type(exc).__name__, exc)
+  result['seconds'] = round(time.perf_counter() - start, 6)
+  return result
+
+
+def lint_cifiles(paths, branch, source, msg, ref, tag=None, variables=None, jobs=None):
+  """
+  Run #lint_cifile() for every file in *paths* across a process pool with
+  *jobs* workers. Yields the diagnostics in the order of *paths*, so that
+  the output does not depend on which worker finishes first.
+  """
+
+  from concurrent.futures import ProcessPoolExecutor
+
+  lint = functools.partial(lint_cifile, branch=branch, source=source, msg=msg,
+                           ref=ref, tag=tag, variables=variables)
+  with ProcessPoolExecutor(max_workers=jobs) as executor:
+    yield from executor.map(lint, paths)
+
+
 def main(argv=None, prog=None):
   parser = get_argument_parser(prog)
   args = parser.parse_args(argv)
@@ -603,8 +668,20 @@ def main(argv=None, prog=None):
     key, value = item.partition('=')[::2]
     env[key] = value
 
+  if args.batch or len(args.cifile) > 1 or os.path.isdir(args.cifile[0]) or glob.has_magic(args.cifile[0]):
+    paths = expand_cifile_paths(args.cifile)
+    start = time.perf_counter()
+    failed = 0
+    for result in lint_cifiles(paths, args.branch, args.source, args.msg, args.ref, args.tag, env, args.jobs):
+      failed += not result['ok']
+      print(json.dumps(result, sort_keys=True))
+      sys.stdout.flush()
+    print(json.dumps({'summary': True, 'files': len(paths), 'failed': failed,
+                      'seconds': round(time.perf_counter() - start, 6)}, sort_keys=True))
+    return 1 if failed else 0
+
   cifile = CiFile(variables=env)
-  cifile.read_cifile(args.cifile)
+  cifile.read_cifile(args.cifile[0])
   cifile.prepare_run_with(args.branch, args.source, args.msg, args.ref, args.tag)
   matrix = cifile.convert_to_matrix()
 
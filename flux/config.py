@@ -24,9 +24,62 @@ Loads the Python configuration file for Flux CI.
 
 import os
 import sys
+from datetime import timedelta
 
 loaded = False
 
+# Default values for options that were added after the first release, so
+# that older configuration files keep working. The configuration file that
+# is executed by #load() overrides them.
+
+id_block_size = 20
+login_token_cache_size = 1000
+login_token_cache_ttl = timedelta(minutes=5)
+login_token_sweep_interval = timedelta(minutes=15)
+queue_lease_duration = timedelta(minutes=2)
+queue_poll_interval = timedelta(seconds=5)
+queue_policy = 'fifo'
+queue_aging_factor = 1.0
+queue_policy_window = 100
+autoscale = False
+autoscale_min_builds = 1
+autoscale_max_builds = None
+autoscale_interval = timedelta(seconds=30)
+autoscale_max_load = 1.0
+autoscale_min_free_memory = 512 * 1024 * 1024
+autoscale_min_free_disk = 1024 * 1024 * 1024
+embedded_workers = True
+web_server = 'werkzeug'
+web_threads = 32
+web_connection_limit = 100
+web_backlog = 1024
+web_keepalive_timeout = timedelta(seconds=120)
+webhook_batch_size = 50
+webhook_max_attempts = 5
+webhook_poll_interval = timedelta(seconds=5)
+webhook_delivery_retention = timedelta(days=7)
+webhook_record_file = None
+stream_chunk_size = 64 * 1024
+file_offload = None
+file_offload_prefix = '/_flux_files/'
+artifact_index_cache_size = 32
+event_queue_size = 100
+event_stream_limit = 24
+event_stream_duration = timedelta(minutes=5)
+event_keepalive_interval = timedelta(seconds=5)
+event_poll_interval = timedelta(seconds=2)
+badge_max_age = timedelta(minutes=1)
+public_badges = False
+estimate_smoothing = 0.2
+# Worker processes serve their metrics to localhost only, and only to users
+# with the "manage" privilege (see flux.metrics.serve()).
+worker_metrics_host = '127.0.0.1'
+worker_metrics_port = None
+request_profiling = False
+slow_request_threshold = timedelta(seconds=1)
+profile_sample_rate = 0
+profile_dir = None
+
 def load(filename=None):
   global loaded
   if filename is None:
@@ -0,0 +1,227 @@
+# Copyright (c) 2016  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+'''
+Estimates the queue position and the start and finish of queued and
+running builds. The expected duration of a build is the moving average of
+the build durations of its repository (see
+:meth:`models.Repository.update_duration_estimate`).
+
+The :class:`QueueEstimator` keeps the queued and running builds and the
+averages in memory. It is loaded from the database once and then updated
+by the build events of :mod:`flux.events`, so the estimates are not
+recomputed from the database for every request.
+'''
+
+from flux import build, config, events, models, scheduling
+from flux.models import select, Build, Repository, Worker
+from datetime import datetime, timedelta
+
+import collections
+import heapq
+import threading
+
+#: The estimate for a build. The *position* in the queue is 1 for the
+#: next build that starts, and None for running builds.
+Estimate = collections.namedtuple('Estimate', 'position date_started date_finished')
+
+
+def parse_date(value):
+  ''' Parses a date of a build event. '''
+
+  if value is None:
+    return None
+  if '.' in value:
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+  return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+
+class QueueEstimator(object):
+  ''' Simulates the build queue with the expected durations of the builds.
+  Whenever one of the build slots (the pools of the workers of all
+  processes, see :meth:`_pool_size`) becomes free, the next queued build
+  is assigned to it by the ``queue_policy`` (see :mod:`flux.scheduling`),
+  which is how the workers claim them. Builds of repositories without a
+  finished build are expected to take as long as the average of all
+  repositories.
+
+  The estimates are computed again when a build changes, and when they
+  are older than :attr:`max_age` seconds, as running builds may take
+  longer than expected. Use :meth:`invalidate` when builds are deleted,
+  which does not publish an event. '''
+
+  max_age = 10
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._load_lock = threading.Lock()
+    self._loaded = False
+    self._stale = False
+    self._queued = {}     # build_id -> (date_queued, repo_name)
+    self._running = {}    # build_id -> (date_started, repo_name)
+    self._modified = {}   # build_id -> date_modified of the last event
+    self._durations = {}  # repo_name -> seconds
+    self._estimates = None
+    self._computed_at = None
+    self._pool = None     # (date read, pool size)
+    self._previous = None  # the last computed estimates
+    #: Incremented with every change of the queue, the durations or the
+    #: computed estimates (eg. when the pool is resized).
+    self.version = 0
+
+  def _on_event(self, event):
+    build_id = event['id']
+    with self._lock:
+      # Events of other processes may arrive out of order.
+      modified = event['date_modified']
+      if modified and (self._modified.get(build_id) or '') > modified:
+        return
+      self._modified[build_id] = modified
+      self._queued.pop(build_id, None)
+      running = self._running.pop(build_id, None)
+      status = event['status']
+      if status == Build.Status_Queued:
+        self._queued[build_id] = (parse_date(event['date_queued']), event['repo'])
+      elif status == Build.Status_Building and event['date_started']:
+        self._running[build_id] = (parse_date(event['date_started']), event['repo'])
+      else:
+        self._modified.pop(build_id, None)
+        if running and status in (Build.Status_Success, Build.Status_Error) and event['date_finished']:
+          # The same update that the worker applied to the database.
+          duration = (parse_date(event['date_finished']) - running[0]).total_seconds()
+          self._durations[event['repo']] = models.ewma(self._durations.get(event['repo']), duration)
+      self._estimates = None
+      self.version += 1
+
+  def _load(self):
+    with models.session():
+      queued = select((b.id, b.date_queued, b.repo.name) for b in Build
+                      if b.status == Build.Status_Queued)[:]
+      running = select((b.id, b.date_started, b.repo.name) for b in Build
+                       if b.status == Build.Status_Building and b.date_started is not None)[:]
+      durations = select((r.name, r.duration_estimate) for r in Repository
+                         if r.duration_estimate is not None)[:]
+    with self._lock:
+      self._queued = {row[0]: row[1:] for row in queued}
+      self._running = {row[0]: row[1:] for row in running}
+      self._modified = {}
+      self._durations = dict(durations)
+      self._estimates = None
+      self.version += 1
+
+  def _pool_size(self, now):
+    ''' Returns the number of builds that run in parallel. The workers
+    usually run in separate processes, so this is the sum of the pool
+    sizes that they registered in the database. Falls back to the pool of
+    this process, or ``parallel_builds`` if no worker is running. The
+    database is read at most every :attr:`max_age` seconds, and must not
+    be read while holding the lock of the estimator. '''
+
+    pool = self._pool
+    if pool is None or not 0 <= (now - pool[0]).total_seconds() <= self.max_age:
+      with models.session():
+        size = Worker.total_pool_size(now)
+      pool = self._pool = (now, size or build.pool_size() or config.parallel_builds)
+    return pool[1]
+
+  def _is_fresh(self, now):
+    return self._estimates is not None and (now - self._computed_at).total_seconds() <= self.max_age
+
+  def _compute(self, now, pool_size):
+    if not self._durations:
+      return {}
+    expected = scheduling.expected_durations(self._durations)
+    duration = lambda repo: timedelta(seconds=expected(repo))
+
+    result = {}
+    slots = []
+    for build_id, (date_started, repo) in self._running.items():
+      date_finished = max(now, date_started + duration(repo))
+      result[build_id] = Estimate(None, date_started, date_finished)
+      slots.append(date_finished)
+    slots.extend([now] * max(0, pool_size - len(slots)))
+    heapq.heapify(slots)
+
+    policy = scheduling.get_policy()
+    queue = sorted(self._queued.items(), key=lambda x: (x[1][0], x[0]))
+    for position in range(1, len(queue) + 1):
+      date_started = heapq.heappop(slots)
+      if config.queue_policy == 'fifo':
+        index = 0
+      else:
+        index = scheduling.select_next([(expected(repo), (date_started - date_queued).total_seconds(),
+          i, i) for i, (build_id, (date_queued, repo)) in enumerate(queue)], policy)
+      build_id, (date_queued, repo) = queue.pop(index)
+      date_finished = date_started + duration(repo)
+      heapq.heappush(slots, date_finished)
+      result[build_id] = Estimate(position, date_started, date_finished)
+    return result
+
+  def _ensure_loaded(self):
+    if not self._loaded:
+      with self._load_lock:
+        if not self._loaded:
+          events.bus.add_listener(self._on_event)
+          self._load()
+          self._loaded = True
+    if self._stale:
+      self._stale = False
+      self._load()
+
+  def get_estimates(self):
+    ''' Returns a dictionary that maps the IDs of the queued and running
+    builds to their :data:`Estimate`. The dictionary is empty if no build
+    has finished yet. '''
+
+    self._ensure_loaded()
+    now = datetime.now()
+    with self._lock:
+      if self._is_fresh(now):
+        return self._estimates
+    pool_size = self._pool_size(now)
+    with self._lock:
+      if not self._is_fresh(now):
+        estimates = self._compute(now, pool_size)
+        if self._previous is not None and estimates != self._previous:
+          self.version += 1
+        self._estimates = self._previous = estimates
+        self._computed_at = now
+      return self._estimates
+
+  def get_version(self):
+    ''' Returns the :attr:`version` of the current estimates. They are
+    computed first, so that the version changes when they are recomputed
+    with different results, eg. because a build runs longer than expected
+    or the pool was resized. Use it in ETags of responses with estimates. '''
+
+    self.get_estimates()
+    return self.version
+
+  def get(self, build_id):
+    ''' Returns the :data:`Estimate` for the build with the specified
+    *build_id*, or None if it is neither queued nor running. '''
+
+    return self.get_estimates().get(build_id)
+
+  def invalidate(self):
+    self._stale = True
+
+
+estimator = QueueEstimator()
+get_estimates = estimator.get_estimates
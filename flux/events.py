@@ -0,0 +1,249 @@
+# Copyright (c) 2016  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+'''
+An in-process bus for build state changes. The places that change the
+status of a build publish the new state with :func:`publish_build`, and
+the event stream view forwards the events to the browsers that subscribed
+with :func:`subscribe`.
+
+Publishing never blocks. Every subscription buffers at most
+``event_queue_size`` events; a subscriber that does not keep up loses its
+buffer and is told to resynchronize instead of slowing down the builds.
+
+Builds that run in other Flux processes (see the ``worker`` command) are
+picked up by :func:`run_change_poller`, which watches the modification
+date of the builds while there are subscribers.
+'''
+
+from flux import config, logger, metrics, models
+from flux.models import select, Build
+from datetime import datetime, timedelta
+
+import collections
+import json
+import threading
+import time
+
+
+def build_event(build):
+  ''' Returns the event data that describes the state of *build*. '''
+
+  def fmt(date):
+    return date.isoformat() if date else None
+
+  return {
+    'id': build.id,
+    'repo': build.repo.name,
+    'num': build.num,
+    'ref': build.ref,
+    'commit_sha': build.commit_sha,
+    'status': build.status,
+    'date_queued': fmt(build.date_queued),
+    'date_started': fmt(build.date_started),
+    'date_finished': fmt(build.date_finished),
+    'date_modified': fmt(build.date_modified),
+  }
+
+
+class Subscription(object):
+  ''' Receives the events of all repositories, or of the repository with
+  the name *repo*. Use :meth:`get` to wait for events and :meth:`close`
+  to unsubscribe. '''
+
+  def __init__(self, bus, repo, max_size):
+    self.repo = repo
+    self.max_size = max_size
+    self.overflowed = False
+    self._bus = bus
+    self._events = collections.deque()
+    self._cond = threading.Condition()
+
+  def put(self, event):
+    with self._cond:
+      if self.overflowed:
+        return
+      if len(self._events) >= self.max_size:
+        self._events.clear()
+        self.overflowed = True
+      else:
+        self._events.append(event)
+      self._cond.notify()
+
+  def get(self, timeout=None):
+    ''' Waits up to *timeout* seconds for events and returns all buffered
+    events. Returns an empty list if no event arrived in time. Once the
+    subscription :attr:`overflowed`, no more events are returned. '''
+
+    with self._cond:
+      if not self._events and not self.overflowed:
+        self._cond.wait(timeout)
+      events = list(self._events)
+      self._events.clear()
+      return events
+
+  def close(self):
+    self._bus.unsubscribe(self)
+
+
+class EventBus(object):
+  ''' Distributes events to the subscriptions. The last published
+  modification date of every build is remembered, so that a change that
+  is published by the process that made it and again by the change poller
+  is only delivered once. '''
+
+  def __init__(self, history_size=1000):
+    self._lock = threading.Lock()
+    self._subscriptions = []
+    self._listeners = []
+    self._history = collections.OrderedDict()
+    self._history_size = history_size
+
+  def subscribe(self, repo=None, max_size=None, limit=None):
+    ''' Returns a new :class:`Subscription`, or None if there are already
+    *limit* subscriptions. '''
+
+    with self._lock:
+      if limit is not None and len(self._subscriptions) >= limit:
+        return None
+      subscription = Subscription(self, repo, max_size or config.event_queue_size)
+      self._subscriptions.append(subscription)
+      return subscription
+
+  def unsubscribe(self, subscription):
+    with self._lock:
+      if subscription in self._subscriptions:
+        self._subscriptions.remove(subscription)
+
+  def add_listener(self, listener):
+    ''' Adds a function that is called with every event by the thread
+    that publishes it. Listeners must return quickly. '''
+
+    with self._lock:
+      self._listeners.append(listener)
+
+  def has_subscribers(self):
+    return bool(self._subscriptions or self._listeners)
+
+  def publish(self, event):
+    with self._lock:
+      if event['date_modified'] is not None:
+        if self._history.get(event['id']) == event['date_modified']:
+          return
+        self._history[event['id']] = event['date_modified']
+        self._history.move_to_end(event['id'])
+        if len(self._history) > self._history_size:
+          self._history.popitem(last=False)
+      subscriptions = list(self._subscriptions)
+      listeners = list(self._listeners)
+    for listener in listeners:
+      try:
+        listener(event)
+      except Exception as exc:
+        logger.exception(exc)
+    for subscription in subscriptions:
+      if subscription.repo is None or subscription.repo == event['repo']:
+        subscription.put(event)
+
+
+bus = EventBus()
+subscribe = bus.subscribe
+
+
+def publish_build(build):
+  ''' Publishes the state of *build*. Must be called in the database
+  session of *build* after the changes have been committed. '''
+
+  bus.publish(build_event(build))
+
+
+def publish_builds(builds):
+  for build in builds:
+    publish_build(build)
+
+
+def stream(subscription, duration=None, keepalive=None):
+  ''' Yields the events of *subscription* in the server-sent events format
+  for *duration* and closes the subscription. A comment is sent every
+  *keepalive* interval without events, so that disconnected clients are
+  noticed. The browser reconnects after the stream ended. If the
+  subscription overflowed, a ``resync`` event is sent and the stream
+  ends. Both intervals are :class:`timedelta` objects and default to the
+  ``event_stream_duration`` and ``event_keepalive_interval`` options. '''
+
+  duration = (duration or config.event_stream_duration).total_seconds()
+  keepalive = (keepalive or config.event_keepalive_interval).total_seconds()
+  deadline = time.monotonic() + duration
+  try:
+    yield 'retry: 2000\n\n'
+    while True:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        break
+      events = subscription.get(min(keepalive, remaining))
+      if subscription.overflowed:
+        yield 'event: resync\ndata: {}\n\n'
+        break
+      if events:
+        yield ''.join('event: build\ndata: {}\n\n'.format(json.dumps(x)) for x in events)
+      else:
+        yield ': keepalive\n\n'
+  finally:
+    subscription.close()
+
+
+def run_change_poller(interval=None):
+  ''' Starts a daemon thread that publishes the builds that were modified
+  by other Flux processes. It checks the ``date_modified`` of the builds
+  every *interval* (a :class:`timedelta`, defaults to the
+  ``event_poll_interval`` option) while there are subscribers. '''
+
+  interval = (interval or config.event_poll_interval).total_seconds()
+  # Transactions can commit after a later transaction of another process
+  # was already seen, so every poll looks back over the last interval.
+  overlap = timedelta(seconds=interval)
+
+  def poller():
+    since, seen = None, {}
+    while True:
+      time.sleep(interval)
+      if not bus.has_subscribers():
+        since = None
+        continue
+      try:
+        with models.session():
+          if since is None:
+            since = select(b.date_modified for b in Build).max() or datetime.now()
+            publish = False
+          else:
+            publish = True
+          modified = select(b for b in Build if b.date_modified > since - overlap)
+          modified = modified.order_by(Build.date_modified)[:]
+          for build in modified:
+            if publish and seen.get(build.id) != build.date_modified:
+              publish_build(build)
+            since = max(since, build.date_modified)
+          seen = {build.id: build.date_modified for build in modified}
+      except Exception as exc:
+        logger.exception(exc)
+      metrics.merge_query_stats()
+
+  thread = threading.Thread(target=poller, name='BuildChangePoller', daemon=True)
+  thread.start()
+  return thread
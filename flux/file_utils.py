@@ -1,5 +1,6 @@
 import os
 import shutil
+import zipfile
 
 def split_url_path(path):
   """
@@ -189,4 +190,82 @@ class File:
     self.filename = filename
     self.path = path
     self.filesize = os.path.getsize(full_path) if self.type == File.TYPE_FILE else 0
-    self.filesize_readable = human_readable_size(self.filesize)
\ No newline at end of file
+    self.filesize_readable = human_readable_size(self.filesize)
+
+class ZipIndex:
+  """
+  The central directory of the zip file at *filename*. Folders are derived
+  from the member names, as archives do not need to contain entries for
+  them. Use #ZipIndex.list_folder() to list a folder like #list_folder().
+
+  Absolute paths and paths with `..` components are not looked up, even
+  if the archive contains a member with such a name.
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.members = {}
+    self._children = {'': set()}
+    with zipfile.ZipFile(filename) as zf:
+      for info in zf.infolist():
+        parts = info.filename.strip('/').split('/')
+        for i in range(len(parts)):
+          folder = '/'.join(parts[:i])
+          self._children.setdefault(folder, set()).add(parts[i])
+        if info.filename.endswith('/'):
+          self._children.setdefault('/'.join(parts), set())
+        else:
+          self.members['/'.join(parts)] = info
+
+  def is_folder(self, path):
+    path = self._normalize(path)
+    return path is not None and path in self._children
+
+  def get_member(self, path):
+    """
+    Returns the #zipfile.ZipInfo of the file at *path*, or None.
+    """
+
+    path = self._normalize(path)
+    return self.members.get(path) if path is not None else None
+
+  @staticmethod
+  def _normalize(path):
+    if path.startswith('/') or '..' in path.split('/'):
+      return None
+    return path.strip('/')
+
+  def list_folder(self, path):
+    """
+    Lists the folder at *path* inside the archive.
+
+    # Parameters
+    path (str): The path of the folder, empty for the root folder.
+
+    # Return
+    list (ZipEntry): The folders and files in the folder.
+    """
+
+    path = self._normalize(path)
+    dirs = []
+    files = []
+    for filename in sorted(self._children.get(path, ())):
+      name = (path + '/' + filename) if path else filename
+      if name in self._children:
+        dirs.append(ZipEntry(filename, path))
+      else:
+        files.append(ZipEntry(filename, path, self.members[name]))
+    return dirs + files
+
+class ZipEntry:
+  TYPE_FOLDER = File.TYPE_FOLDER
+  TYPE_FILE = File.TYPE_FILE
+
+  def __init__(self, filename, path, info=None):
+    self.type = ZipEntry.TYPE_FOLDER if info is None else ZipEntry.TYPE_FILE
+    self.filename = filename
+    self.path = path
+    self.name = (path + '/' + filename) if path else filename
+    self.filesize = info.file_size if info else 0
+    self.filesize_readable = human_readable_size(self.filesize)
+    self.compressed = bool(info and info.compress_type != zipfile.ZIP_STORED)
@@ -23,25 +23,55 @@
 
 import argparse
 import re
+import signal
 import subprocess
 import sys
 import os
+import threading
 
 
 def get_argument_parser(prog=None):
+  config_parser = argparse.ArgumentParser(add_help=False)
+  config_parser.add_argument('-c','--config-file', default=argparse.SUPPRESS, help='Flux CI config file to load')
+
   parser = argparse.ArgumentParser(prog=prog)
-  parser.add_argument('--web', action='store_true', help='launch builtin webserver')
+  parser.add_argument('--web', action='store_true', help='launch builtin webserver (same as the "web" command)')
+  parser.add_argument('--worker', action='store_true', help='run the build workers without the webserver (same as the "worker" command)')
   parser.add_argument('-c','--config-file', help='Flux CI config file to load')
+  subparsers = parser.add_subparsers(dest='command')
+
+  web = subparsers.add_parser('web', parents=[config_parser], help='launch builtin webserver')
+  web.add_argument('--no-workers', action='store_true', help='do not run build workers in the webserver process')
+
+  worker = subparsers.add_parser('worker', parents=[config_parser], help='run the build workers without the webserver')
+  worker.add_argument('-j', '--threads', type=int, help='number of builds to run in parallel (defaults to parallel_builds)')
+  worker.add_argument('--cpus', help='comma separated list of CPU cores to pin the worker and its builds to')
+
+  subparsers.add_parser('recover', parents=[config_parser], help='recover the build queue once and exit')
   return parser
 
 def main(argv=None, prog=None):
   parser = get_argument_parser(prog)
   args = parser.parse_args(argv)
 
-  if not args.web:
+  command = args.command
+  if args.web and args.worker:
+    parser.error('--web and --worker can not be combined')
+  elif not command and args.web:
+    command = 'web'
+  elif not command and args.worker:
+    command = 'worker'
+  if not command:
     parser.print_usage()
     return 0
 
+  cpus = None
+  if command == 'worker' and args.cpus:
+    try:
+      cpus = set(int(x) for x in args.cpus.split(','))
+    except ValueError:
+      parser.error('invalid --cpus value: {!r}'.format(args.cpus))
+
   # Add possible locations of flux config
   sys.path.insert(0, '.')
   if args.config_file and os.path.isfile(args.config_file):
@@ -51,7 +81,12 @@ def main(argv=None, prog=None):
   from flux import config
   config.load(args.config_file)
 
-  start_web()
+  if command == 'worker':
+    start_worker(num_threads=args.threads, cpus=cpus)
+  elif command == 'recover':
+    recover()
+  else:
+    start_web(workers=False if getattr(args, 'no_workers', False) else None)
 
 
 def check_requirements():
@@ -71,7 +106,51 @@ def check_requirements():
     sys.exit(1)
 
 
-def start_web():
+def init_logging():
+  """
+  Sends the messages of the #flux.logger to stderr the same way that Flask
+  does for the `app.logger`, for commands that do not create the app.
+  """
+
+  import logging
+  from flux import config, logger
+
+  if not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s in %(module)s: %(message)s'))
+    logger.addHandler(handler)
+  if config.debug and not logger.level:
+    logger.setLevel(logging.DEBUG)
+
+
+def setup():
+  """
+  Prepares the data directories and the database. Required by both the
+  webserver and the build workers.
+  """
+
+  from flux import config, models, migrations
+
+  # Ensure that some of the required directories exist.
+  for dirname in [config.root_dir, config.build_dir, config.override_dir, config.customs_dir]:
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+  # Bring the schema of existing databases up to date.
+  migrations.run_migrations()
+
+  # Make sure the root user exists and has all privileges, and that
+  # the password is up to date.
+  with models.session():
+    models.User.create_or_update_root()
+
+
+def start_web(workers=None):
+  """
+  Runs the webserver. The build workers run in the same process if
+  *workers* is #True, or if it is #None and `embedded_workers` is enabled.
+  """
+
   check_requirements()
 
   import flux
@@ -85,18 +164,10 @@ def start_web():
   print('DEBUG = {}'.format(config.debug))
   print('SERVER_NAME = {}'.format(config.server_name))
 
-  from flux import views, build, models
+  from flux import views, api, build, events, profiling, webhooks
   from urllib.parse import urlparse
 
-  # Ensure that some of the required directories exist.
-  for dirname in [config.root_dir, config.build_dir, config.override_dir, config.customs_dir]:
-    if not os.path.exists(dirname):
-        os.makedirs(dirname)
-
-  # Make sure the root user exists and has all privileges, and that
-  # the password is up to date.
-  with models.session():
-    models.User.create_or_update_root()
+  setup()
 
   # Create a dispatcher for the sub-url under which the app is run.
   url_prefix = urlparse(config.app_url).path
@@ -109,18 +180,126 @@ def start_web():
   else:
     target_app = app
 
-  app.logger.info('Starting builder threads...')
-  build.run_consumers(num_threads=config.parallel_builds)
-  build.update_queue()
+  utils.run_login_token_sweeper()
+  webhooks.run_delivery_processor()
+  events.run_change_poller()
+
+  if workers is None:
+    workers = config.embedded_workers
+  if workers:
+    app.logger.info('Starting builder threads...')
+    build.run_consumers(num_threads=config.parallel_builds)
+    build.update_queue()
+    if config.autoscale:
+      build.run_autoscaler()
   try:
+    serve(target_app)
+  finally:
+    if workers:
+      app.logger.info('Stopping builder threads...')
+      build.stop_consumers()
+
+
+def serve(wsgi_app):
+  """
+  Serves the *wsgi_app* with the server that is selected with the
+  `web_server` option. The `waitress` server is recommended for production
+  and requires the `waitress` package.
+  """
+
+  from flux import config
+
+  if config.web_server == 'waitress':
+    try:
+      import waitress
+    except ImportError:
+      print('Error: web_server = "waitress" requires the waitress package '
+            '(pip install flux-ci[production])')
+      sys.exit(1)
+    waitress.serve(wsgi_app, host=config.host, port=config.port,
+      threads=config.web_threads,
+      connection_limit=config.web_connection_limit,
+      backlog=config.web_backlog,
+      channel_timeout=config.web_keepalive_timeout.total_seconds(),
+      ident='Flux CI')
+  elif config.web_server == 'werkzeug':
     from werkzeug.serving import run_simple
-    run_simple(config.host, config.port, target_app,
-      use_debugger=config.debug, use_reloader=False)
+    run_simple(config.host, config.port, wsgi_app,
+      use_debugger=config.debug, use_reloader=False, threaded=True)
+  else:
+    print('Error: unsupported web_server {!r}'.format(config.web_server))
+    sys.exit(1)
+
+
+def start_worker(num_threads=None, cpus=None):
+  """
+  Runs the build workers without the webserver until the process receives
+  SIGINT or SIGTERM. The workers share the build queue with all other Flux
+  processes that use the same database.
+
+  # Parameters
+  num_threads (int, None): The number of parallel builds. Defaults to the
+      `parallel_builds` option.
+  cpus (set of int, None): The CPU cores to pin the process to. The build
+      scripts inherit the affinity.
+  """
+
+  check_requirements()
+
+  from flux import config, logger, build
+
+  init_logging()
+  if cpus:
+    if not hasattr(os, 'sched_setaffinity'):
+      print('Error: --cpus is not supported on this platform')
+      sys.exit(1)
+    os.sched_setaffinity(0, cpus)
+
+  setup()
+  if config.worker_metrics_port:
+    from flux import metrics
+    metrics.serve(config.worker_metrics_host, config.worker_metrics_port)
+
+  stop = threading.Event()
+  signal.signal(signal.SIGTERM, lambda *args: stop.set())
+
+  logger.info('Starting builder threads...')
+  build.run_consumers(num_threads=num_threads or config.parallel_builds)
+  build.update_queue()
+  if config.autoscale:
+    build.run_autoscaler()
+  try:
+    while not stop.wait(1):
+      pass
+  except KeyboardInterrupt:
+    pass
   finally:
-    app.logger.info('Stopping builder threads...')
+    logger.info('Stopping builder threads...')
     build.stop_consumers()
 
 
+def recover():
+  """
+  Runs #build.update_queue() and processes the pending webhook deliveries
+  once, eg. after a crash of all Flux processes, without starting the
+  webserver or the build workers.
+  """
+
+  from flux import build, webhooks
+
+  init_logging()
+  setup()
+  queued, stopped = build.update_queue()
+  print('Recovered build queue: {} build(s) queued, {} build(s) marked as stopped'.format(queued, stopped))
+  deliveries = 0
+  while True:
+    count = webhooks.process_deliveries()
+    if not count:
+      break
+    deliveries += count
+  print('Processed {} pending webhook deliveries'.format(deliveries))
+
+
 _entry_point = lambda: sys.exit(main())
 
 
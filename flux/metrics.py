@@ -0,0 +1,320 @@
+# Copyright (c) 2016  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+'''
+Metrics in the Prometheus text format, served by the ``/metrics`` view
+and by the ``worker`` command if ``worker_metrics_port`` is set.
+
+Counters and histograms are updated without locks: every thread updates
+its own shard, and the shards are added up when the metrics are rendered.
+Gauges are computed when the metrics are rendered.
+'''
+
+from flux import config, logger, models
+
+import base64
+import bisect
+import contextlib
+import threading
+import time
+
+DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class _Shards(object):
+  ''' One dictionary per thread. Only the owning thread writes to it. The
+  shards of threads that exited are folded into a base shard with
+  *merge(base, shard)*, so that short-lived request threads do not add up. '''
+
+  def __init__(self, merge):
+    self._merge = merge
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self._base = {}
+    self._shards = []  # (thread, shard)
+
+  def get(self):
+    try:
+      return self._local.shard
+    except AttributeError:
+      shard = self._local.shard = {}
+      with self._lock:
+        self._reap()
+        self._shards.append((threading.current_thread(), shard))
+      return shard
+
+  def _reap(self):
+    alive = []
+    for thread, shard in self._shards:
+      if thread.is_alive():
+        alive.append((thread, shard))
+      else:
+        self._merge(self._base, shard)
+    self._shards = alive
+
+  def collect(self):
+    ''' Returns the totals of all shards. '''
+
+    with self._lock:
+      self._reap()
+      totals = {}
+      self._merge(totals, self._base)
+      shards = [shard for thread, shard in self._shards]
+    for shard in shards:
+      self._merge(totals, shard.copy())
+    return totals
+
+
+class Metric(object):
+
+  type = None
+
+  def __init__(self, name, help, labelnames=()):
+    self.name = name
+    self.help = help
+    self.labelnames = tuple(labelnames)
+    registry.append(self)
+
+  def _key(self, labels):
+    return tuple(str(labels[name]) for name in self.labelnames)
+
+  def samples(self):
+    ''' Returns a list of ``(suffix, labels, value)`` tuples. '''
+
+    raise NotImplementedError
+
+
+class Counter(Metric):
+
+  type = 'counter'
+
+  def __init__(self, name, help, labelnames=()):
+    super().__init__(name, help, labelnames)
+    self._shards = _Shards(self._merge)
+
+  @staticmethod
+  def _merge(totals, shard):
+    for key, value in shard.items():
+      totals[key] = totals.get(key, 0) + value
+
+  def inc(self, amount=1, **labels):
+    key = self._key(labels)
+    shard = self._shards.get()
+    shard[key] = shard.get(key, 0) + amount
+
+  def samples(self):
+    totals = self._shards.collect()
+    return [('', zip(self.labelnames, key), value) for key, value in sorted(totals.items())]
+
+
+class Histogram(Metric):
+
+  type = 'histogram'
+
+  def __init__(self, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+    super().__init__(name, help, labelnames)
+    self.buckets = tuple(buckets)
+    self._shards = _Shards(self._merge)
+
+  @staticmethod
+  def _merge(totals, shard):
+    for key, counts in shard.items():
+      if key in totals:
+        counts = [a + b for a, b in zip(totals[key], counts)]
+      totals[key] = list(counts)
+
+  def observe(self, value, **labels):
+    key = self._key(labels)
+    shard = self._shards.get()
+    counts = shard.get(key)
+    if counts is None:
+      # One count per bucket, the +Inf bucket and the sum of the values.
+      counts = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+    counts[bisect.bisect_left(self.buckets, value)] += 1
+    counts[-1] += value
+
+  @contextlib.contextmanager
+  def time(self, **labels):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(time.perf_counter() - start, **labels)
+
+  def samples(self):
+    totals = self._shards.collect()
+    samples = []
+    for key, counts in sorted(totals.items()):
+      labels = list(zip(self.labelnames, key))
+      cumulative = 0
+      for bound, count in zip(self.buckets + ('+Inf',), counts):
+        cumulative += count
+        samples.append(('_bucket', labels + [('le', str(bound))], cumulative))
+      samples.append(('_sum', labels, counts[-1]))
+      samples.append(('_count', labels, cumulative))
+    return samples
+
+
+class Gauge(Metric):
+  ''' A metric whose value is computed by *func* when the metrics are
+  rendered. *func* may use the database. '''
+
+  type = 'gauge'
+
+  def __init__(self, name, help, func, type=None):
+    super().__init__(name, help)
+    self.func = func
+    if type:
+      self.type = type
+
+  def samples(self):
+    return [('', (), self.func())]
+
+
+registry = []
+
+
+def _escape(value):
+  return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def render():
+  ''' Renders all metrics in the Prometheus text format. Must be called
+  in a database session. '''
+
+  lines = []
+  for metric in registry:
+    try:
+      samples = metric.samples()
+    except Exception as exc:
+      logger.exception(exc)
+      continue
+    lines.append('# HELP {} {}'.format(metric.name, metric.help))
+    lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+    for suffix, labels, value in samples:
+      labels = ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels)
+      lines.append('{}{}{} {}'.format(metric.name, suffix, '{' + labels + '}' if labels else '', value))
+  return '\n'.join(lines) + '\n'
+
+
+def merge_query_stats():
+  ''' Adds the query statistics of the current thread to the totals of
+  the ``flux_db_queries_total`` metric. Pony ORM counts the queries per
+  thread, so threads that use the database call this regularly. '''
+
+  if models.db.provider is not None:
+    models.db.merge_local_stats()
+
+
+def _query_stat(attr):
+  def func():
+    stat = models.db.global_stats.get(None)
+    return (getattr(stat, attr) or 0) if stat else 0
+  return func
+
+
+def _queue_length():
+  from flux.models import select, QueueEntry
+  return select(e for e in QueueEntry if e.claimed_by is None).count()
+
+
+def _running_builds():
+  from flux.models import select, Build
+  return select(b for b in Build if b.status == Build.Status_Building).count()
+
+
+def _active_builds():
+  from flux.build import _consumer
+  return _consumer.active_builds()
+
+
+def _pool_size():
+  from flux.build import _consumer
+  return _consumer.pool_size()
+
+
+queue_length = Gauge('flux_queue_length', 'Builds waiting in the queue of all Flux processes.', _queue_length)
+running_builds = Gauge('flux_running_builds', 'Builds running in all Flux processes.', _running_builds)
+active_builds = Gauge('flux_active_builds', 'Builds running in this process.', _active_builds)
+pool_size = Gauge('flux_build_pool_size', 'Builds that may run in parallel in this process.', _pool_size)
+build_queue_wait = Histogram('flux_build_queue_wait_seconds', 'Time from queueing to the start of a build.', ['repo'])
+build_duration = Histogram('flux_build_duration_seconds', 'Duration of builds.', ['repo', 'status'])
+build_phase = Histogram('flux_build_phase_seconds', 'Duration of the phases of builds.', ['phase'])
+artifact_bytes = Counter('flux_artifact_bytes_written_total', 'Bytes of build artifacts written.')
+log_bytes = Counter('flux_log_bytes_written_total', 'Bytes of build logs written.')
+webhook_requests = Counter('flux_webhook_requests_total', 'Webhook requests by API and status code.', ['api', 'code'])
+webhook_latency = Histogram('flux_webhook_request_seconds', 'Webhook request latency by API.', ['api'], LATENCY_BUCKETS)
+db_queries = Gauge('flux_db_queries_total', 'Database queries.', _query_stat('db_count'), type='counter')
+db_query_time = Gauge('flux_db_query_seconds_total', 'Time spent in database queries.', _query_stat('sum_time'), type='counter')
+
+
+def serve(host, port):
+  ''' Serves the metrics on *host* and *port* in a daemon thread, for the
+  processes that do not run the webserver. Like the ``/metrics`` page of
+  the webserver, the metrics are only sent to users with the "manage"
+  privilege, who authenticate with HTTP Basic authentication. '''
+
+  from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+  class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+      if self.path.split('?')[0] != '/metrics':
+        self.send_error(404)
+        return
+      with models.session():
+        user = check_basic_auth(self.headers.get('Authorization'))
+        if user is None:
+          self.send_response(401)
+          self.send_header('WWW-Authenticate', 'Basic realm="Flux CI"')
+          self.send_header('Content-Length', '0')
+          self.end_headers()
+          return
+        if not user.can_manage:
+          self.send_error(403)
+          return
+        data = render().encode('utf8')
+      merge_query_stats()
+      self.send_response(200)
+      self.send_header('Content-Type', 'text/plain; version=0.0.4')
+      self.send_header('Content-Length', str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+    def log_message(self, format, *args):
+      pass
+
+  server = ThreadingHTTPServer((host, port), Handler)
+  thread = threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True)
+  thread.start()
+  return server
+
+
+def check_basic_auth(header):
+  ''' Returns the :class:`models.User` for the HTTP Basic *header*, or
+  None if it is missing or the credentials are invalid. '''
+
+  scheme, _, credentials = (header or '').partition(' ')
+  if scheme.lower() != 'basic':
+    return None
+  try:
+    user_name, _, password = base64.b64decode(credentials).decode('utf8').partition(':')
+  except (ValueError, UnicodeDecodeError):
+    return None
+  return models.User.get_by_login_details(user_name, password)
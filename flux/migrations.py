@@ -0,0 +1,187 @@
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+'''
+A small, versioned schema migration runner. PonyORM creates missing tables
+with all their indexes, but it does not alter tables that already exist.
+Every migration in this module is applied exactly once to a database and
+recorded in the #models.SchemaMigration table.
+
+Migrations must be idempotent, as they are also applied to databases that
+were freshly created by PonyORM and thus already have the new schema.
+'''
+
+from flux import logger, models
+from pony import orm
+
+_migrations = {}
+
+
+def migration(version):
+  ''' Decorator that registers a migration function with the specified
+  *version*. The function is called inside a database session with the
+  #orm.Database object as its only argument. '''
+
+  def decorator(func):
+    if version in _migrations:
+      raise ValueError('duplicate migration version: {!r}'.format(version))
+    _migrations[version] = func
+    return func
+
+  return decorator
+
+
+def create_index(db, name, table, columns):
+  ''' Creates an index on the *columns* of *table* unless an index with
+  the specified *name* already exists. Use the index names that PonyORM
+  would generate, so fresh databases are not indexed twice. '''
+
+  provider = db.provider_name
+  if provider == 'mysql':
+    exists = db.select('SELECT 1 FROM information_schema.statistics WHERE '
+      'table_schema = DATABASE() AND table_name = $table AND index_name = $name')
+    if not exists:
+      db.execute('CREATE INDEX {} ON {} ({})'.format(name, table, ', '.join(columns)))
+  else:
+    db.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+      name, table, ', '.join(columns)))
+
+
+_column_types = {
+  'int': {'mysql': 'INTEGER', 'postgres': 'INTEGER', 'sqlite': 'INTEGER'},
+  'str': {'mysql': 'LONGTEXT', 'postgres': 'TEXT', 'sqlite': 'TEXT'},
+  'datetime': {'mysql': 'DATETIME', 'postgres': 'TIMESTAMP', 'sqlite': 'DATETIME'},
+  'float': {'mysql': 'DOUBLE', 'postgres': 'DOUBLE PRECISION', 'sqlite': 'REAL'},
+}
+
+
+def column_exists(db, table, column):
+  ''' Returns #True if the *column* exists in *table*. '''
+
+  provider = db.provider_name
+  if provider == 'sqlite':
+    cursor = db.execute('PRAGMA table_info({})'.format(table))
+    return any(x[1] == column for x in cursor.fetchall())
+  elif provider == 'mysql':
+    query = 'SELECT 1 FROM information_schema.columns WHERE table_schema = DATABASE() '\
+      'AND table_name = $table AND column_name = $column'
+  else:
+    query = 'SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema() '\
+      'AND table_name = $table AND column_name = $column'
+  return bool(db.select(query))
+
+
+def add_column(db, table, column, type):
+  ''' Adds a nullable *column* to *table* unless it already exists. The
+  *type* must be one of `int`, `str`, `datetime` or `float`. '''
+
+  if not column_exists(db, table, column):
+    sql_type = _column_types[type][db.provider_name]
+    db.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, column, sql_type))
+
+
+def pending_migrations():
+  ''' Returns a sorted list of the versions that have not been applied. '''
+
+  with models.session():
+    applied = set(orm.select(x.version for x in models.SchemaMigration))
+  return sorted(v for v in _migrations if v not in applied)
+
+
+def run_migrations():
+  ''' Applies all pending migrations in order. Every migration runs in its
+  own transaction. If another Flux process applies the same migration at
+  the same time, the duplicate is ignored. '''
+
+  models.init()
+  for version in pending_migrations():
+    func = _migrations[version]
+    logger.info('Applying schema migration {}: {}'.format(version, func.__name__))
+    try:
+      with models.session():
+        func(models.db)
+        models.SchemaMigration(version=version, name=func.__name__)
+    except orm.TransactionIntegrityError:
+      logger.info('Schema migration {} was applied concurrently'.format(version))
+
+  # The models are mapped without checking the tables, as columns may
+  # only have been added by the migrations above.
+  models.db.check_tables()
+
+
+@migration(1)
+def build_query_indexes(db):
+  create_index(db, 'idx_builds__repo_id_num', 'builds', ['repo_id', 'num'])
+  create_index(db, 'idx_builds__status', 'builds', ['status'])
+  create_index(db, 'idx_builds__repo_id_date_queued', 'builds', ['repo_id', 'date_queued'])
+
+
+@migration(2)
+def build_filter_indexes(db):
+  create_index(db, 'idx_builds__repo_id_ref', 'builds', ['repo_id', 'ref'])
+  create_index(db, 'idx_builds__repo_id_status', 'builds', ['repo_id', 'status'])
+  create_index(db, 'idx_builds__commit_sha', 'builds', ['commit_sha'])
+
+
+@migration(3)
+def repository_latest_build(db):
+  columns = [('id', 'int'), ('num', 'int'), ('status', 'str'), ('ref', 'str'),
+    ('date_queued', 'datetime'), ('date_started', 'datetime'), ('date_finished', 'datetime')]
+  for name, type in columns:
+    add_column(db, 'repos', 'latest_build_' + name, type)
+  for name, type in columns:
+    db.execute('UPDATE repos SET latest_build_{0} = (SELECT b.{0} FROM builds b '
+      'WHERE b.repo_id = repos.id ORDER BY b.num DESC LIMIT 1)'.format(name))
+
+
+@migration(4)
+def build_date_modified(db):
+  # The index is not declared in the model. PonyORM would create it before
+  # the column exists, and SQLite would index the string 'date_modified'.
+  add_column(db, 'builds', 'date_modified', 'datetime')
+  db.execute('UPDATE builds SET date_modified = COALESCE(date_finished, date_started, date_queued) '
+    'WHERE date_modified IS NULL')
+  create_index(db, 'idx_builds__date_modified', 'builds', ['date_modified'])
+
+
+@migration(5)
+def repository_duration_estimate(db):
+  add_column(db, 'repos', 'duration_estimate', 'float')
+  Build = models.Build
+  rows = orm.select((b.repo.id, b.date_started, b.date_finished) for b in Build
+    if b.status in (Build.Status_Success, Build.Status_Error)
+    and b.date_started is not None and b.date_finished is not None).order_by(3)
+  estimates = {}
+  for repo_id, date_started, date_finished in rows:
+    duration = (date_finished - date_started).total_seconds()
+    estimates[repo_id] = models.ewma(estimates.get(repo_id), duration)
+  for repo_id, estimate in estimates.items():
+    db.execute('UPDATE repos SET duration_estimate = $estimate WHERE id = $repo_id')
+
+
+@migration(6)
+def build_queue_lease_index(db):
+  create_index(db, 'idx_build_queue__claimed_by_lease_expires_at', 'build_queue',
+    ['claimed_by', 'lease_expires_at'])
+
+
+@migration(7)
+def webhook_delivery_attempts(db):
+  add_column(db, 'webhook_deliveries', 'attempts', 'int')
+  db.execute('UPDATE webhook_deliveries SET attempts = 0 WHERE attempts IS NULL')
@@ -4,26 +4,224 @@ This package provides the database models using PonyORM.
 
 Note that we do not rely on the auto increment feature as the previous
 SQLAlchemy implementation did not set AUTO INCREMENT on the ID fields,
-as PonyORM would.
+as PonyORM would. Instead, IDs are handed out by an #IdAllocator.
+
+The database is not bound when this module is imported. Call #init()
+before accessing it.
 """
 
-from flask import url_for
-from flux import app, config, utils
+from flux import config, logger, utils
 
+import collections
 import datetime
 import hashlib
 import os
 import pony.orm as orm
+import re
 import shutil
+import threading
 import uuid
 
-db = orm.Database(**config.database)
+db = orm.Database()
 session = orm.db_session
 commit = orm.commit
 rollback = orm.rollback
 select = orm.select
 desc = orm.desc
 
+# Whether the database server supports `SELECT ... FOR UPDATE SKIP LOCKED`,
+# detected by #init().
+skip_locked = True
+
+
+class IdSequence(db.Entity):
+  """
+  Stores the highest ID that has been reserved for a named sequence. The
+  rows are maintained by the #IdAllocator. Rows can also be used as
+  counters, see #increment(). The value is volatile as the allocator
+  updates it on a separate connection.
+  """
+
+  _table_ = 'id_sequences'
+
+  name = orm.PrimaryKey(str)
+  value = orm.Required(int, size=64, volatile=True)
+
+  @classmethod
+  def increment(cls, name):
+    " Increments the counter *name* in the current transaction. "
+
+    seq = cls.get_for_update(name=name)
+    if seq is None:
+      cls(name=name, value=1)
+    else:
+      seq.value += 1
+
+  @classmethod
+  def get_value(cls, name):
+    " Returns the value of the counter *name*, or 0. "
+
+    seq = cls.get(name=name)
+    return seq.value if seq else 0
+
+
+# A second database for the #IdAllocator, which reserves blocks of IDs on
+# its own connection and commits them independently of the caller's
+# transaction. It is bound together with the #db in #init().
+sequence_db = orm.Database()
+
+
+class SequenceBlock(sequence_db.Entity):
+  " The #IdSequence table as seen by the connection of the #sequence_db. "
+
+  _table_ = 'id_sequences'
+
+  name = orm.PrimaryKey(str)
+  value = orm.Required(int, size=64, volatile=True)
+
+
+class IdAllocator(object):
+  """
+  A hi-lo ID allocator. Instead of computing `max(id) + 1` for every insert,
+  the allocator reserves a block of *block_size* IDs from the #IdSequence
+  row with the specified *name* and hands them out from memory.
+
+  Blocks are reserved on the connection of the #sequence_db and committed
+  right away, so the row is only locked for a moment and multiple Flux
+  processes can share a database. That connection can not write while the
+  caller's transaction holds the write lock of an SQLite database. In that
+  case, a single ID is reserved in the caller's transaction instead, which
+  is rolled back together with the entity that uses it.
+
+  When the sequence does not exist yet, it is initialized with the result
+  of the *initial* function (which is called inside a database session),
+  so IDs stay compatible with existing rows.
+
+  IDs are unique, but not monotonic: a block is handed out after IDs that
+  other processes or single reservations took from the sequence later.
+  Order rows by a timestamp or a number such as #Build.num, not by their ID.
+  """
+
+  def __init__(self, name, initial=None, block_size=None):
+    self.name = name
+    self.initial = initial
+    self.block_size = block_size
+    self._lock = threading.Lock()
+    self._next = 0
+    self._limit = 0
+
+  def next_id(self):
+    " Returns the next ID from the sequence. "
+
+    with self._lock:
+      if self._next < self._limit:
+        return self._take()
+    block = self._reserve_block(self.block_size or config.id_block_size)
+    if block is None:
+      return self._reserve_one()
+    with self._lock:
+      # Another thread may have reserved a block meanwhile, which is dropped.
+      self._next, self._limit = block
+      return self._take()
+
+  def reset(self):
+    " Forget the reserved block. The next call reserves a new block. "
+
+    with self._lock:
+      self._next = self._limit = 0
+
+  def _take(self):
+    result = self._next
+    self._next += 1
+    return result
+
+  def _initial_value(self):
+    return (self.initial() if self.initial else 0) or 0
+
+  def _reserve_one(self):
+    " Reserves a single ID in the caller's transaction. "
+
+    seq = IdSequence.get_for_update(name=self.name)
+    if seq is None:
+      seq = IdSequence(name=self.name, value=self._initial_value())
+    seq.value += 1
+    return seq.value
+
+  def _reserve_block(self, block_size):
+    """
+    Reserves *block_size* IDs on the connection of the #sequence_db.
+    Returns the range of IDs as a tuple, or #None if the SQLite database
+    is locked.
+    """
+
+    if sequence_db.provider is None:
+      return None
+    with orm.db_session:
+      try:
+        seq = SequenceBlock.get_for_update(name=self.name)
+        if seq is None:
+          seq = SequenceBlock(name=self.name, value=self._initial_value())
+        first = seq.value + 1
+        seq.value += block_size
+        sequence_db.commit()
+      except orm.OperationalError:
+        sequence_db.rollback()
+        if sequence_db.provider_name != 'sqlite':
+          raise
+        return None
+      except BaseException:
+        sequence_db.rollback()
+        raise
+    return first, first + block_size
+
+
+class SequenceIdGenerator(object):
+  """
+  A drop-in replacement for #flux.cifile.IdGenerator that draws pipeline and
+  job IDs from #IdAllocator sequences in the database instead of memory, so
+  they are unique across restarts and Flux processes. Use one generator per
+  repository, see #for_repository().
+
+  Like the IDs of the #IdAllocator, the IDs are unique but not monotonic.
+  """
+
+  _instances = {}
+  _instances_lock = threading.Lock()
+
+  def __init__(self, scope, block_size=None):
+    self._pipelines = IdAllocator('pipelines:{}'.format(scope), block_size=block_size)
+    self._jobs = IdAllocator('jobs:{}'.format(scope), block_size=block_size)
+    self._lock = threading.Lock()
+    self._last = {"job": 0, "pipeline": 0}
+
+  @classmethod
+  def for_repository(cls, repo_id):
+    " Returns the generator of the repository with the ID *repo_id*. "
+
+    with cls._instances_lock:
+      generator = cls._instances.get(repo_id)
+      if generator is None:
+        generator = cls._instances[repo_id] = cls(repo_id)
+      return generator
+
+  def next_pipeline_id(self):
+    return self._next('pipeline', self._pipelines)
+
+  def next_job_id(self):
+    return self._next('job', self._jobs)
+
+  def current_ids(self):
+    " Returns the last IDs that this generator handed out. "
+
+    with self._lock:
+      return dict(self._last)
+
+  def _next(self, kind, allocator):
+    result = allocator.next_id()
+    with self._lock:
+      self._last[kind] = result
+    return result
+
 
 class User(db.Entity):
   _table_ = 'users'
@@ -36,9 +234,11 @@ class User(db.Entity):
   can_view_buildlogs = orm.Required(bool)
   login_tokens = orm.Set('LoginToken')
 
+  id_allocator = IdAllocator('users', lambda: orm.max(x.id for x in User))
+
   def __init__(self, **kwargs):
     if 'id' not in kwargs:
-      kwargs['id'] = (orm.max(x.id for x in User) or 0) + 1
+      kwargs['id'] = self.id_allocator.next_id()
     super().__init__(**kwargs)
 
   def set_password(self, password):
@@ -66,7 +266,7 @@ class User(db.Entity):
       root.name = config.root_user
     else:
       # Create a new root user.
-      app.logger.info('Creating new root user: {!r}'.format(config.root_user))
+      logger.info('Creating new root user: {!r}'.format(config.root_user))
       root = cls(
         name=config.root_user,
         passhash=utils.hash_pw(config.root_password),
@@ -76,6 +276,7 @@ class User(db.Entity):
     return root
 
   def url(self):
+    from flask import url_for
     return url_for('edit_user', user_id=self.id)
 
 
@@ -99,16 +300,27 @@ class LoginToken(db.Entity):
   token = orm.Required(str, unique=True)
   created = orm.Required(datetime.datetime)
 
+  id_allocator = IdAllocator('logintokens', lambda: orm.max(x.id for x in LoginToken))
+
   @classmethod
   def create(cls, ip, user):
     " Create a new login token assigned to the specified IP and user. "
 
-    id = (orm.max(x.id for x in cls) or 0) + 1
+    id = cls.id_allocator.next_id()
     created = datetime.datetime.now()
     token = str(uuid.uuid4()).replace('-', '')
     token += hashlib.md5((token + str(created)).encode()).hexdigest()
     return cls(id=id, ip=ip, user=user, token=token, created=created)
 
+  @classmethod
+  def delete_expired(cls):
+    " Deletes all expired tokens with a single query. Returns their number. "
+
+    if config.login_token_duration is None:
+      return 0
+    cutoff = datetime.datetime.now() - config.login_token_duration
+    return cls.select(lambda x: x.created < cutoff).delete(bulk=True)
+
   def expired(self):
     " Returns #True if the token is expired, #False otherwise. "
 
@@ -133,14 +345,36 @@ class Repository(db.Entity):
   clone_url = orm.Required(str)
   build_count = orm.Required(int, default=0)
   builds = orm.Set('Build')
+  webhook_deliveries = orm.Set('WebhookDelivery')
   ref_whitelist = orm.Optional(str)  # newline separated list of accepted Git refs
 
+  # Snapshot of the build with the highest number, maintained by the Build
+  # hooks so that the repository list does not need to query the builds.
+  # The columns are written without optimistic checks, as they are updated
+  # by concurrent builds of the same repository.
+  latest_build_id = orm.Optional(int, volatile=True, optimistic=False)
+  latest_build_num = orm.Optional(int, volatile=True, optimistic=False)
+  latest_build_status = orm.Optional(str, nullable=True, volatile=True, optimistic=False)
+  latest_build_ref = orm.Optional(str, nullable=True, volatile=True, optimistic=False)
+  latest_build_date_queued = orm.Optional(datetime.datetime, volatile=True, optimistic=False)
+  latest_build_date_started = orm.Optional(datetime.datetime, volatile=True, optimistic=False)
+  latest_build_date_finished = orm.Optional(datetime.datetime, volatile=True, optimistic=False)
+
+  # Exponentially weighted moving average of the duration of finished
+  # builds in seconds, see #update_duration_estimate().
+  duration_estimate = orm.Optional(float, volatile=True, optimistic=False)
+
+  id_allocator = IdAllocator('repos', lambda: orm.max(x.id for x in Repository))
+
   def __init__(self, **kwargs):
     if 'id' not in kwargs:
-      kwargs['id'] = (orm.max(x.id for x in Repository) or 0) + 1
+      kwargs['id'] = self.id_allocator.next_id()
     super().__init__(**kwargs)
 
+  _deleting = False
+
   def url(self, **kwargs):
+    from flask import url_for
     return url_for('view_repo', path=self.name, **kwargs)
 
   def check_accept_ref(self, ref):
@@ -152,9 +386,83 @@ class Repository(db.Entity):
   def validate_ref_whitelist(self, value, oldvalue, initiator):
     return '\n'.join(filter(bool, (x.strip() for x in value.split('\n'))))
 
+  # db.Entity Overrides
+
+  def delete(self):
+    # Builds are deleted in cascade and must not update the snapshot.
+    self._deleting = True
+    if not self.builds.is_empty():
+      IdSequence.increment(Build.deletions_counter)
+    super().delete()
+
   def most_recent_build(self):
     return self.builds.select().order_by(desc(Build.date_started)).first()
 
+  def phase_averages(self, num_builds=50):
+    """
+    Returns a list of #PhaseSummary objects with the average duration of
+    every phase in the last *num_builds* builds of the repository.
+    """
+
+    build_ids = select(b.id for b in Build if b.repo == self).order_by(lambda: desc(b.num))[:num_builds]
+    if not build_ids:
+      return []
+    averages = dict(select((p.name, orm.avg(p.duration)) for p in BuildPhase if p.build.id in build_ids))
+    return BuildPhase.summarize((name, averages[name]) for name in BuildPhase.Names if name in averages)
+
+  def update_duration_estimate(self, build):
+    """
+    Adds the duration of the finished *build* to the #duration_estimate.
+    Builds that were stopped are ignored, as they did not run to the end.
+    """
+
+    if build.status in (Build.Status_Success, Build.Status_Error) \
+        and build.date_started and build.date_finished:
+      duration = (build.date_finished - build.date_started).total_seconds()
+      self.duration_estimate = ewma(self.duration_estimate, duration)
+
+  def latest_build(self):
+    " Returns a #BuildSummary of the latest build, or #None. "
+
+    if self.latest_build_id is None:
+      return None
+    return BuildSummary(
+      id=self.latest_build_id,
+      num=self.latest_build_num,
+      status=self.latest_build_status,
+      ref=self.latest_build_ref,
+      date_queued=self.latest_build_date_queued,
+      date_started=self.latest_build_date_started,
+      date_finished=self.latest_build_date_finished)
+
+  def update_latest_build(self, build):
+    """
+    Updates the latest build snapshot from *build* if it is the latest
+    build of the repository.
+    """
+
+    if build.id != self.latest_build_id and self.latest_build_num is not None \
+        and build.num < self.latest_build_num:
+      return
+    self._set_latest_build(build)
+
+  def reset_latest_build(self, exclude=None):
+    " Recomputes the latest build snapshot, ignoring the build *exclude*. "
+
+    query = self.builds.select()
+    if exclude is not None:
+      query = query.filter(lambda b: b.id != exclude.id)
+    self._set_latest_build(query.order_by(desc(Build.num)).first())
+
+  def _set_latest_build(self, build):
+    self.latest_build_id = build.id if build else None
+    self.latest_build_num = build.num if build else None
+    self.latest_build_status = build.status if build else None
+    self.latest_build_ref = build.ref if build else None
+    self.latest_build_date_queued = build.date_queued if build else None
+    self.latest_build_date_started = build.date_started if build else None
+    self.latest_build_date_finished = build.date_finished if build else None
+
 
 class Build(db.Entity):
   """
@@ -181,27 +489,43 @@ class Build(db.Entity):
   Data_Artifact = 'artifact'
   Data_Log = 'log'
 
+  #: The #IdSequence counter of deleted builds. Deletions do not change the
+  #: `date_modified` of the remaining builds.
+  deletions_counter = 'builds:deleted'
+
   class CanNotDelete(Exception):
     pass
 
   id = orm.PrimaryKey(int)
   repo = orm.Required(Repository, column='repo_id')
   ref = orm.Required(str)
-  commit_sha = orm.Required(str)
+  commit_sha = orm.Required(str, index=True)
   num = orm.Required(int)
-  status = orm.Required(str)  # One of the Status strings
+  status = orm.Required(str, index=True)  # One of the Status strings
   date_queued = orm.Required(datetime.datetime, default=datetime.datetime.now)
   date_started = orm.Optional(datetime.datetime)
   date_finished = orm.Optional(datetime.datetime)
+  date_modified = orm.Optional(datetime.datetime, optimistic=False)  # indexed by migration 4
+  queue_entry = orm.Optional('QueueEntry', cascade_delete=True)
+  phases = orm.Set('BuildPhase', cascade_delete=True)
+
+  # Existing databases receive these indexes via flux.migrations.
+  orm.composite_index(repo, num)
+  orm.composite_index(repo, date_queued)
+  orm.composite_index(repo, ref)
+  orm.composite_index(repo, status)
+
+  id_allocator = IdAllocator('builds', lambda: orm.max(x.id for x in Build))
 
   def __init__(self, **kwargs):
     # Backwards compatibility for when SQLAlchemy was used, Auto Increment
     # was not enabled there.
     if 'id' not in kwargs:
-      kwargs['id'] = (orm.max(x.id for x in Build) or 0) + 1
+      kwargs['id'] = self.id_allocator.next_id()
     super(Build, self).__init__(**kwargs)
 
   def url(self, data=None, **kwargs):
+    from flask import url_for
     path = self.repo.name + '/' + str(self.num)
     if not data:
       return url_for('view_build', path=path, **kwargs)
@@ -210,6 +534,21 @@ class Build(db.Entity):
     else:
       raise ValueError('invalid mode: {!r}'.format(mode))
 
+  def cursor(self):
+    " Returns the keyset pagination cursor for this build. See #paginate_builds(). "
+
+    return '{:%Y%m%d%H%M%S%f}-{}'.format(self.date_queued, self.id)
+
+  @staticmethod
+  def parse_cursor(cursor):
+    " Parses a string returned by #cursor(). Returns #None if it is invalid. "
+
+    date, _, id = (cursor or '').partition('-')
+    try:
+      return datetime.datetime.strptime(date, '%Y%m%d%H%M%S%f'), int(id)
+    except ValueError:
+      return None
+
   def path(self, data=Data_BuildDir):
     base = os.path.join(config.build_dir, self.repo.name.replace('/', os.sep), str(self.num))
     if data == self.Data_BuildDir:
@@ -233,6 +572,12 @@ class Build(db.Entity):
         return fp.read()
     return None
 
+  def phase_timeline(self):
+    " Returns a list of #PhaseSummary objects in the order of the phases. "
+
+    phases = self.phases.select().order_by(BuildPhase.date_started)[:]
+    return BuildPhase.summarize((p.name, p.duration) for p in phases)
+
   def check_download_permission(self, data, user):
     if data == self.Data_Artifact:
       return user.can_download_artifacts and (
@@ -248,16 +593,278 @@ class Build(db.Entity):
     try:
       os.remove(self.path(self.Data_Artifact))
     except OSError as exc:
-      app.logger.exception(exc)
+      logger.exception(exc)
     try:
       os.remove(self.path(self.Data_Log))
     except OSError as exc:
-      app.logger.exception(exc)
+      logger.exception(exc)
 
   # db.Entity Overrides
 
+  def before_insert(self):
+    self.date_modified = datetime.datetime.now()
+    self.repo.update_latest_build(self)
+
+  def before_update(self):
+    self.date_modified = datetime.datetime.now()
+    self.repo.update_latest_build(self)
+
+  def delete(self):
+    IdSequence.increment(self.deletions_counter)
+    super().delete()
+
   def before_delete(self):
     self.delete_build()
+    if self.repo.latest_build_id == self.id and not self.repo._deleting:
+      self.repo.reset_latest_build(exclude=self)
+
+
+class BuildSummary(object):
+  """
+  A snapshot of the latest build of a repository as stored in the
+  repository's `latest_build_*` columns. It provides the attributes and
+  status constants of a #Build that the templates need to render it.
+  """
+
+  Status_Queued = Build.Status_Queued
+  Status_Building = Build.Status_Building
+  Status_Error = Build.Status_Error
+  Status_Success = Build.Status_Success
+  Status_Stopped = Build.Status_Stopped
+
+  def __init__(self, id, num, status, ref, date_queued, date_started, date_finished):
+    self.id = id
+    self.num = num
+    self.status = status
+    self.ref = ref
+    self.date_queued = date_queued
+    self.date_started = date_started
+    self.date_finished = date_finished
+
+
+class QueueEntry(db.Entity):
+  """
+  A build in the durable build queue. Workers claim an entry by setting
+  #claimed_by to their worker ID and must renew #lease_expires_at while the
+  build is running. An entry with an expired lease belongs to a worker that
+  died and may be taken over. The entry is deleted when the build is done.
+  """
+
+  _table_ = 'build_queue'
+
+  build = orm.PrimaryKey(Build, column='build_id')
+  date_queued = orm.Required(datetime.datetime, default=datetime.datetime.now, index=True)
+  claimed_by = orm.Optional(str, nullable=True)
+  lease_expires_at = orm.Optional(datetime.datetime)
+
+  # Existing databases receive this index via flux.migrations.
+  orm.composite_index(claimed_by, lease_expires_at)
+
+  def lease_expired(self, now=None):
+    if self.lease_expires_at is None:
+      return False
+    return self.lease_expires_at < (now or datetime.datetime.now())
+
+
+class Worker(db.Entity):
+  """
+  A #flux.build.BuildConsumer that consumes the #QueueEntry table. Every
+  consumer registers the size of its worker pool and renews #date_seen
+  while it is running, so that processes without workers (eg. the web
+  server) know how many builds run in parallel. A worker that was not
+  seen for `queue_lease_duration` is considered dead.
+  """
+
+  _table_ = 'workers'
+
+  worker_id = orm.PrimaryKey(str)
+  pool_size = orm.Required(int)
+  date_seen = orm.Required(datetime.datetime, index=True)
+
+  @classmethod
+  def register(cls, worker_id, pool_size, now=None):
+    """
+    Creates or updates the worker with the specified *worker_id* and
+    removes the workers that died.
+    """
+
+    now = now or datetime.datetime.now()
+    worker = cls.get(worker_id=worker_id)
+    if worker:
+      worker.set(pool_size=pool_size, date_seen=now)
+    else:
+      cls(worker_id=worker_id, pool_size=pool_size, date_seen=now)
+    deadline = now - config.queue_lease_duration
+    orm.select(w for w in cls if w.date_seen < deadline).delete(bulk=True)
+
+  @classmethod
+  def total_pool_size(cls, now=None):
+    """
+    Returns the sum of the pool sizes of the live workers.
+    """
+
+    deadline = (now or datetime.datetime.now()) - config.queue_lease_duration
+    return orm.sum(w.pool_size for w in cls if w.date_seen >= deadline)
+
+
+PhaseSummary = collections.namedtuple('PhaseSummary', 'name duration percent')
+
+
+class BuildPhase(db.Entity):
+  """
+  The duration of a phase of a #Build, as measured by
+  #flux.build.PhaseTimer. The phases of a build are replaced when the
+  build runs again.
+  """
+
+  _table_ = 'build_phases'
+
+  Names = ['clone', 'checkout', 'overrides', 'script', 'zip', 'rmtree']
+
+  id = orm.PrimaryKey(int, auto=True)
+  build = orm.Required(Build, column='build_id', index=True)
+  name = orm.Required(str)
+  date_started = orm.Required(datetime.datetime)
+  duration = orm.Required(float)
+
+  @staticmethod
+  def summarize(phases):
+    """
+    Converts an iterable of `(name, duration)` tuples to a list of
+    #PhaseSummary objects with the share of every phase in percent.
+    """
+
+    phases = list(phases)
+    total = sum(duration for name, duration in phases)
+    return [PhaseSummary(name, duration, (duration / total * 100) if total else 0)
+            for name, duration in phases]
+
+
+class WebhookDelivery(db.Entity):
+  """
+  A push event that was received by the webhook. The raw payload is stored
+  and the builds are created in the background, see #flux.webhooks. The
+  #delivery_id is derived from the delivery header of the Git host, so a
+  delivery that the host retries is only processed once.
+
+  A delivery that was rejected (eg. because of an invalid payload or an
+  unknown repository) is marked as failed. If processing the delivery
+  raises, it stays pending and is retried until it reached
+  `webhook_max_attempts` #attempts, then it is marked as an error.
+  """
+
+  _table_ = 'webhook_deliveries'
+
+  Status_Pending = 'pending'
+  Status_Processed = 'processed'
+  Status_Failed = 'failed'
+  Status_Error = 'error'
+
+  delivery_id = orm.PrimaryKey(str)
+  api = orm.Required(str)
+  repo = orm.Optional(Repository, column='repo_id')
+  headers = orm.Required(orm.Json)
+  payload = orm.Required(bytes)
+  status = orm.Required(str, default=Status_Pending, index=True)
+  date_received = orm.Required(datetime.datetime, default=datetime.datetime.now, index=True)
+  date_processed = orm.Optional(datetime.datetime)
+  message = orm.Optional(str, nullable=True)
+  attempts = orm.Required(int, default=0)  # added by migration 7
+
+  @classmethod
+  def delete_processed(cls, max_age):
+    " Deletes deliveries that are older than *max_age* and no longer pending. "
+
+    cutoff = datetime.datetime.now() - max_age
+    return cls.select(lambda x: x.status != cls.Status_Pending and x.date_received < cutoff).delete(bulk=True)
+
+
+class SchemaMigration(db.Entity):
+  """
+  Records a schema migration from #flux.migrations that has been applied
+  to the database.
+  """
+
+  _table_ = 'schema_migrations'
+
+  version = orm.PrimaryKey(int)
+  name = orm.Required(str)
+  date_applied = orm.Required(datetime.datetime, default=datetime.datetime.now)
+
+
+def ewma(average, value, smoothing=None):
+  """
+  Returns the exponentially weighted moving *average* updated with the
+  new *value*. The *smoothing* factor defaults to the `estimate_smoothing`
+  option, higher values give more weight to recent values. The first value
+  (*average* is #None) is the initial average.
+  """
+
+  if smoothing is None:
+    smoothing = config.estimate_smoothing
+  if average is None:
+    return float(value)
+  return average + smoothing * (value - average)
+
+
+def filter_builds(query, status=None, ref=None, commit_sha=None):
+  """
+  Applies the optional filters to a #Build *query*. A *commit_sha* shorter
+  than 40 characters is matched as a prefix. The prefix is compared as a
+  range instead of with `LIKE`, which can not use the index on SQLite.
+  """
+
+  if status:
+    query = query.filter(lambda b: b.status == status)
+  if ref:
+    query = query.filter(lambda b: b.ref == ref)
+  if commit_sha and len(commit_sha) == 40:
+    query = query.filter(lambda b: b.commit_sha == commit_sha)
+  elif commit_sha:
+    commit_sha = commit_sha.lower()
+    end = commit_sha + '\uffff'
+    query = query.filter(lambda b: b.commit_sha >= commit_sha and b.commit_sha < end)
+  return query
+
+
+def paginate_builds(query, limit, before=None, after=None):
+  """
+  Keyset pagination for a #Build *query*, newest builds first. The builds
+  are ordered by `(date_queued, id)`. Pass the cursor of a build (see
+  #Build.cursor()) as *before* to get the next older page, or as *after*
+  to get the next newer page. Only `limit + 1` rows are fetched to check
+  whether another page exists, instead of counting all builds.
+
+  # Return
+  tuple of (list of Build, str, str): The builds of the page, and the
+      cursors to pass as *before* and *after* to get the older and newer
+      page, respectively. A cursor is #None if there is no such page.
+  """
+
+  before = Build.parse_cursor(before) if before else None
+  after = Build.parse_cursor(after) if after else None
+
+  if after:
+    date, id = after
+    query = query.filter(lambda b: b.date_queued > date or
+                         (b.date_queued == date and b.id > id))
+    builds = list(query.order_by(Build.date_queued, Build.id)[:limit + 1])
+    has_newer = len(builds) > limit
+    builds = builds[:limit][::-1]
+    has_older = True
+  else:
+    if before:
+      date, id = before
+      query = query.filter(lambda b: b.date_queued < date or
+                           (b.date_queued == date and b.id < id))
+    builds = list(query.order_by(desc(Build.date_queued), desc(Build.id))[:limit + 1])
+    has_older = len(builds) > limit
+    builds = builds[:limit]
+    has_newer = before is not None
+
+  older = builds[-1].cursor() if builds and has_older else None
+  newer = builds[0].cursor() if builds and has_newer else None
+  return builds, older, newer
 
 
 def get_target_for(path):
@@ -286,4 +893,78 @@ def get_target_for(path):
   return repo
 
 
-db.generate_mapping(create_tables=True)
+_init_lock = threading.Lock()
+
+
+def init():
+  """
+  Binds the #db to the `database` configuration and generates the mapping
+  of the entities, creating missing tables. The tables are not checked as
+  columns may still have to be added by the schema migrations, see
+  #flux.migrations.run_migrations(). Calling the function again has no
+  effect.
+  """
+
+  with _init_lock:
+    if db.schema is not None:
+      return
+    if db.provider is None:
+      db.bind(**config.database)
+    db.generate_mapping(create_tables=True, check_tables=False)
+    _init_sequence_db()
+    global skip_locked
+    skip_locked = _detect_skip_locked()
+
+
+def supports_skip_locked(provider, version):
+  """
+  Returns #True if the database server of the *provider* with the
+  specified *version* string supports `SELECT ... FOR UPDATE SKIP LOCKED`.
+  SQLite ignores the clause, as it does not lock rows.
+  """
+
+  if provider == 'postgres':
+    return int(version) >= 90500
+  if provider == 'mysql':
+    numbers = tuple(int(x) for x in re.findall(r'\d+', version)[:3])
+    if 'mariadb' in version.lower():
+      return numbers >= (10, 6)
+    return numbers >= (8, 0, 1)
+  return True
+
+
+def _detect_skip_locked():
+  """
+  Checks the version of the database server once. If it does not support
+  `SKIP LOCKED`, an error is logged and the build queue falls back to
+  plain `FOR UPDATE`, see #flux.build.BuildConsumer._next_entry().
+  """
+
+  queries = {'postgres': "current_setting('server_version_num')", 'mysql': 'VERSION()'}
+  if db.provider_name not in queries:
+    return True
+  with orm.db_session:
+    version = db.select(queries[db.provider_name])[0]
+  if supports_skip_locked(db.provider_name, version):
+    return True
+  logger.error('The database server ({} {}) does not support SELECT ... FOR UPDATE SKIP '
+    'LOCKED. Build workers that claim queued builds at the same time wait for each other. '
+    'Use PostgreSQL 9.5, MySQL 8.0.1, MariaDB 10.6 or newer.'.format(db.provider_name, version))
+  return False
+
+
+def _init_sequence_db():
+  """
+  Binds the #sequence_db to a separate connection of the same database. It
+  does not wait for locks of SQLite databases, see #IdAllocator. An
+  in-memory SQLite database can not be shared, so IDs are then reserved
+  in the caller's transaction.
+  """
+
+  options = dict(config.database)
+  if options.get('provider') == 'sqlite':
+    if options.get('filename') == ':memory:':
+      return
+    options['timeout'] = 0
+  sequence_db.bind(**options)
+  sequence_db.generate_mapping(create_tables=False, check_tables=False)
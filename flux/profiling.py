@@ -0,0 +1,165 @@
+# Copyright (c) 2016  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+'''
+Optional instrumentation of the web requests, enabled with the
+``request_profiling`` option. Every request is timed, and its latency,
+number of database queries and query time are recorded per endpoint in
+:mod:`flux.metrics`. Requests that take longer than ``slow_request_threshold``
+are logged with their SQL statements, and a ``profile_sample_rate`` share
+of the requests is profiled with :mod:`cProfile`.
+
+:func:`count_queries` and :func:`assert_max_queries` count the queries of a
+block of code, eg. a view that is called with the Flask test client, to
+catch views whose number of queries grows with the number of rows.
+'''
+
+from flux import app, config, logger, metrics, models
+from flask import g, request
+
+import contextlib
+import os
+import random
+import time
+
+request_latency = metrics.Histogram('flux_request_seconds',
+  'Request latency by endpoint.', ['endpoint'], metrics.LATENCY_BUCKETS)
+request_queries = metrics.Counter('flux_request_queries_total',
+  'Database queries by endpoint.', ['endpoint'])
+request_query_time = metrics.Counter('flux_request_query_seconds_total',
+  'Time spent in database queries by endpoint.', ['endpoint'])
+
+
+def get_local_queries():
+  ''' Returns a dictionary that maps the SQL statements that the current
+  thread executed since the query statistics were last merged (see
+  :func:`metrics.merge_query_stats`) to tuples of the number of executions
+  and the total time. '''
+
+  if models.db.provider is None:
+    return {}
+  return {sql: (stat.db_count, stat.sum_time or 0.0)
+          for sql, stat in models.db.local_stats.items()
+          if sql is not None and stat.db_count}
+
+
+def format_queries(queries):
+  ''' Formats the result of :func:`get_local_queries`, the slowest
+  statements first. '''
+
+  lines = []
+  for sql, (count, seconds) in sorted(queries.items(), key=lambda x: -x[1][1]):
+    lines.append('  {}x {:.1f} ms: {}'.format(count, seconds * 1000, ' '.join(sql.split())))
+  return '\n'.join(lines)
+
+
+@app.before_request
+def start_request_profiling():
+  if not config.request_profiling:
+    return
+  # Start with empty query statistics for this thread.
+  metrics.merge_query_stats()
+  g.profiling_start = time.perf_counter()
+  g.profiler = None
+  if config.profile_sample_rate and random.random() < config.profile_sample_rate:
+    import cProfile
+    g.profiler = cProfile.Profile()
+    g.profiler.enable()
+
+
+@app.after_request
+def finish_request_profiling(response):
+  start = g.pop('profiling_start', None)
+  if start is None:
+    return response
+  seconds = time.perf_counter() - start
+  endpoint = request.endpoint or 'none'
+  queries = get_local_queries()
+  query_count = sum(count for count, _ in queries.values())
+  query_time = sum(seconds for _, seconds in queries.values())
+  request_latency.observe(seconds, endpoint=endpoint)
+  request_queries.inc(query_count, endpoint=endpoint)
+  request_query_time.inc(query_time, endpoint=endpoint)
+
+  threshold = config.slow_request_threshold
+  if threshold is not None and seconds > threshold.total_seconds():
+    logger.warning('Slow request {} {} ({:.1f} ms, {} queries in {:.1f} ms)\n{}'.format(
+      request.method, request.full_path.rstrip('?'), seconds * 1000, query_count,
+      query_time * 1000, format_queries(queries)))
+
+  profiler = g.pop('profiler', None)
+  if profiler:
+    profiler.disable()
+    directory = config.profile_dir or os.path.join(config.root_dir, 'profiles')
+    os.makedirs(directory, exist_ok=True)
+    filename = '{}-{}-{}.prof'.format(endpoint, time.strftime('%Y%m%d%H%M%S'), int(seconds * 1000))
+    profiler.dump_stats(os.path.join(directory, filename))
+  return response
+
+
+class QueryCounter(object):
+  ''' The result of :func:`count_queries`. '''
+
+  def __init__(self):
+    self.count = 0
+    self.seconds = 0.0
+    self.statements = {}
+
+  def __str__(self):
+    return format_queries(self.statements)
+
+
+def _global_queries():
+  metrics.merge_query_stats()
+  return {sql: (stat.db_count, stat.sum_time or 0.0)
+          for sql, stat in models.db.global_stats.items() if sql is not None}
+
+
+@contextlib.contextmanager
+def count_queries():
+  ''' Counts the database queries that are executed in the block. The
+  statistics of all threads are merged by the request teardown and the
+  background threads, so the count includes the queries of a request that
+  is handled by the Flask test client in the block. '''
+
+  counter = QueryCounter()
+  before = _global_queries()
+  yield counter
+  for sql, (count, seconds) in _global_queries().items():
+    prev_count, prev_seconds = before.get(sql, (0, 0.0))
+    if count > prev_count:
+      counter.statements[sql] = (count - prev_count, seconds - prev_seconds)
+      counter.count += count - prev_count
+      counter.seconds += seconds - prev_seconds
+
+
+@contextlib.contextmanager
+def assert_max_queries(max_count):
+  ''' Raises an :class:`AssertionError` if the block executes more than
+  *max_count* database queries. ::
+
+    with assert_max_queries(5):
+      client.get('/repositories')
+  '''
+
+  with count_queries() as counter:
+    yield counter
+  if counter.count > max_count:
+    raise AssertionError('{} queries executed, expected at most {}:\n{}'.format(
+      counter.count, max_count, counter))
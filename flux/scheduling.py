@@ -0,0 +1,124 @@
+# Copyright (c) 2016  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+'''
+Scheduling policies of the build queue. A policy decides which queued
+build a worker starts next (see :meth:`build.BuildConsumer._claim`), and
+is selected with the ``queue_policy`` option:
+
+* ``fifo`` starts the builds in the order in which they were queued.
+* ``sejf`` (shortest expected job first) starts the build that is expected
+  to take the least time, based on the average build duration of its
+  repository (see :meth:`models.Repository.update_duration_estimate`).
+  Builds age while they wait: every second of waiting reduces the expected
+  duration by ``queue_aging_factor`` seconds, so long builds are delayed
+  by at most about their expected duration divided by the factor.
+
+:func:`simulate` replays a build history with a policy, see
+``benchmarks/scheduling.py``.
+'''
+
+from flux import config, models
+
+import heapq
+
+policies = ('fifo', 'sejf')
+
+
+def get_policy(name=None, aging_factor=None):
+  ''' Returns the priority function of the policy *name* (defaults to the
+  ``queue_policy`` option). The function is called with the expected
+  duration and the time that a build waited so far in seconds, and the
+  build with the lowest priority is started first. Builds with the same
+  priority are started in the order in which they were queued. '''
+
+  name = name or config.queue_policy
+  if name == 'fifo':
+    return lambda expected, waited: 0.0
+  elif name == 'sejf':
+    if aging_factor is None:
+      aging_factor = config.queue_aging_factor
+    return lambda expected, waited: expected - aging_factor * waited
+  raise ValueError('unknown queue_policy: {!r}'.format(name))
+
+
+def expected_durations(durations):
+  ''' Returns a function that returns the expected duration of a build of
+  a repository from the *durations* dictionary, which maps repository
+  names to seconds. Repositories without a duration are expected to take
+  as long as the average of all repositories. '''
+
+  default = sum(durations.values()) / len(durations) if durations else 0.0
+  return lambda repo: durations.get(repo, default)
+
+
+def select_next(candidates, policy):
+  ''' Returns the item of the candidate that *policy* starts next. The
+  *candidates* are tuples of the expected duration, the time waited, a
+  key that orders the builds as they were queued, and the item. '''
+
+  best = min(candidates, key=lambda x: (policy(x[0], x[1]), x[2]))
+  return best[3]
+
+
+def simulate(builds, slots, policy, smoothing=None):
+  ''' Simulates the build queue with *slots* workers and the *policy*.
+  The *builds* are tuples of ``(repo, queued, duration)`` where *queued*
+  is the time at which the build was queued and *duration* the time that
+  it took, in seconds. The expected durations are the moving averages of
+  the builds that finished earlier in the simulation.
+
+  Returns a list of the wait times of the *builds* in seconds. '''
+
+  arrivals = sorted(range(len(builds)), key=lambda i: (builds[i][1], i))
+  waits = [None] * len(builds)
+  averages = {}
+  pending = []
+  running = []  # heap of (finish time, index)
+  free = slots
+  now = None
+  next_arrival = 0
+
+  while next_arrival < len(arrivals) or pending or running:
+    times = []
+    if next_arrival < len(arrivals):
+      times.append(builds[arrivals[next_arrival]][1])
+    if running:
+      times.append(running[0][0])
+    now = min(times)
+
+    while running and running[0][0] <= now:
+      finished, index = heapq.heappop(running)
+      repo, queued, duration = builds[index]
+      averages[repo] = models.ewma(averages.get(repo), duration, smoothing)
+      free += 1
+    while next_arrival < len(arrivals) and builds[arrivals[next_arrival]][1] <= now:
+      pending.append(arrivals[next_arrival])
+      next_arrival += 1
+
+    expected = expected_durations(averages)
+    while free and pending:
+      candidates = [(expected(builds[i][0]), now - builds[i][1], (builds[i][1], i), i) for i in pending]
+      index = select_next(candidates, policy)
+      pending.remove(index)
+      waits[index] = now - builds[index][1]
+      heapq.heappush(running, (now + builds[index][2], index))
+      free -= 1
+
+  return waits
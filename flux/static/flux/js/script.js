@@ -5,51 +5,64 @@ $(document).ready(function() {
 		$('header nav ul').toggle();
 	});
 
-	$('.messages .close').click(function (event) {
-		event.preventDefault();
-		event.stopPropagation();
-		$(this).parent('.messages').hide();
-	});
-
-	$('[data-confirmation]').click(function(event) {
-		event.preventDefault();
-		event.stopPropagation();
-		$('#confirm-dialog .confirm-message').text($(this).attr('data-confirmation'));
-		$('#confirm-dialog .confirm-yes').off('click');
-		$('#confirm-dialog .confirm-yes').click(confirmationYes($(this)));
-		toggleConfirmDialog();
-	});
+	// Binds the messages, dropdowns, confirmations and input dialogs in
+	// *root*, which is also called for the parts of the page that are
+	// replaced by the live updates.
+	function bindActions(root) {
+		root.find('.messages .close').click(function (event) {
+			event.preventDefault();
+			event.stopPropagation();
+			$(this).parent('.messages').hide();
+		});
 
-	$('[data-input-callback]').click(function (event) {
-		event.preventDefault();
-		event.stopPropagation();
-		var caller = $(this);
-		var field = $('#input-dialog .input-text');
-		var inputText = caller.attr('data-input-text');
-		field.val(inputText !== undefined ? inputText : '');
-		if (field.val() !== '') {
-			field[0].select();
-		}
+		root.find('.dropdown').click(function(event){
+			event.preventDefault();
+			event.stopPropagation();
+			$(this).parent().find('.dropdown-menu').toggle();
+		});
 
-		$('#input-dialog .input-message').text($(this).attr('data-input-message'));
-		$('#input-dialog .input-cancel').off('click');
-		$('#input-dialog .input-cancel').click(function (event) {
-			field.val('');
-			toggleInputDialog();
+		root.find('[data-confirmation]').click(function(event) {
+			event.preventDefault();
+			event.stopPropagation();
+			$('#confirm-dialog .confirm-message').text($(this).attr('data-confirmation'));
+			$('#confirm-dialog .confirm-yes').off('click');
+			$('#confirm-dialog .confirm-yes').click(confirmationYes($(this)));
+			toggleConfirmDialog();
 		});
-		$('#input-dialog .input-ok').off('click');
-		$('#input-dialog .input-ok').click(function (event) {
+
+		root.find('[data-input-callback]').click(function (event) {
 			event.preventDefault();
 			event.stopPropagation();
+			var caller = $(this);
+			var field = $('#input-dialog .input-text');
+			var inputText = caller.attr('data-input-text');
+			field.val(inputText !== undefined ? inputText : '');
+			if (field.val() !== '') {
+				field[0].select();
+			}
+
+			$('#input-dialog .input-message').text($(this).attr('data-input-message'));
+			$('#input-dialog .input-cancel').off('click');
+			$('#input-dialog .input-cancel').click(function (event) {
+				field.val('');
+				toggleInputDialog();
+			});
+			$('#input-dialog .input-ok').off('click');
+			$('#input-dialog .input-ok').click(function (event) {
+				event.preventDefault();
+				event.stopPropagation();
+				toggleInputDialog();
+				var input = field.val();
+				field.val('');
+				var callback = caller.attr('data-input-callback');
+				eval(callback)(input);
+			});
 			toggleInputDialog();
-			var input = field.val();
-			field.val('');
-			var callback = caller.attr('data-input-callback');
-			eval(callback)(input);
+			field[0].focus();
 		});
-		toggleInputDialog();
-		field[0].focus();
-	});
+	}
+
+	bindActions($(document));
 
 	$('#confirm-dialog .confirm-no').click(function (event) {
 		event.preventDefault();
@@ -110,16 +123,120 @@ $(document).ready(function() {
 		}
 	}
 
-	$('.dropdown').click(function(event){
-		event.preventDefault();
-		event.stopPropagation();
-		$(this).parent().find('.dropdown-menu').toggle();
-	});
-
 	$(':not(.dropdown)').click(function(event) {
 		$('.dropdown-menu').hide();
 	});
 
+	// Update the builds on the page when they change (see flux/events.py).
+	// The builds that are shown are patched from the event. New builds and
+	// the status changes of the build on a build page load the page in the
+	// background and replace its content, so the event stream stays open.
+	var eventsUrl = document.body.getAttribute('data-events-url');
+	if (eventsUrl && window.EventSource) {
+		var eventsBuild = document.body.getAttribute('data-events-build');
+		var eventsStatus = document.body.getAttribute('data-events-status');
+		var buildIcons = {
+			queued: ['fa-clock-o', 'Queued'],
+			building: ['fa-refresh', 'Building'],
+			error: ['fa-times-circle', 'Error'],
+			success: ['fa-check-circle', 'Success'],
+			stopped: ['fa-stop-circle', 'Stopped']
+		};
+		var pad = function(value) {
+			return (value < 10 ? '0' : '') + value;
+		};
+		var parseDate = function(value) {
+			var parts = value.substr(0, 19).split(/[-T:]/);
+			return new Date(parts[0], parts[1] - 1, parts[2], parts[3], parts[4], parts[5]);
+		};
+		var formatDate = function(value) {
+			return value ? value.substr(0, 19).replace(/-/g, '/').replace('T', ' ') : '';
+		};
+		// Like flux.utils.get_date_diff().
+		var formatDuration = function(started, finished) {
+			if (!started) {
+				return '00:00:00';
+			}
+			var end = finished ? parseDate(finished) : new Date();
+			var seconds = Math.floor(Math.abs(end - parseDate(started)) / 1000) % 86400;
+			return pad(Math.floor(seconds / 3600)) + ':' + pad(Math.floor(seconds / 60) % 60) + ':' + pad(seconds % 60);
+		};
+		var patchBuild = function(data) {
+			var block = $('[data-build-id="' + data.id + '"]');
+			if (!block.length) {
+				return false;
+			}
+			var icon = buildIcons[data.status] || ['fa-question-circle', 'Unknown'];
+			block.find('[data-build-field=status]').empty()
+				.append($('<i>').addClass('fa ' + icon[0]).attr('title', icon[1]));
+			block.find('[data-build-field=date_started]').text(formatDate(data.date_started));
+			block.find('[data-build-field=date_finished]').text(formatDate(data.date_finished));
+			block.find('[data-build-field=duration]').text(formatDuration(data.date_started, data.date_finished));
+			if (data.status !== 'queued' && data.status !== 'building') {
+				block.find('[data-build-field=estimate]').remove();
+			}
+			return true;
+		};
+		var refreshTimer = null;
+		var refreshPage = function() {
+			if (refreshTimer !== null) {
+				return;
+			}
+			refreshTimer = setTimeout(function() {
+				refreshTimer = null;
+				if ($('header').hasClass('blur')) {
+					refreshPage();  // Wait until the dialog is closed
+					return;
+				}
+				$.get(window.location.href).done(function(html) {
+					var page = $('<div>').append($.parseHTML(html));
+					var toolbar = page.find('#toolbar');
+					var body = page.find('#page-body');
+					$('#toolbar').replaceWith(toolbar);
+					$('#page-body').replaceWith(body);
+					bindActions(toolbar);
+					bindActions(body);
+				});
+			}, 1000);
+		};
+		var source = null;
+		var onBuild = function(event) {
+			var data = JSON.parse(event.data);
+			if (eventsBuild) {
+				if (String(data.id) === eventsBuild && data.status !== eventsStatus) {
+					eventsStatus = data.status;
+					patchBuild(data);
+					refreshPage();
+				}
+			} else if (!patchBuild(data) && data.status === 'queued') {
+				refreshPage();
+			}
+		};
+		var connect = function() {
+			source = new EventSource(eventsUrl);
+			source.addEventListener('build', onBuild);
+			source.addEventListener('resync', function(event) {
+				source.close();
+				window.location.reload();
+			});
+			source.onerror = function(event) {
+				// The server refused the stream. Try again later and catch up
+				// with the changes that were missed in the meantime.
+				if (source.readyState === EventSource.CLOSED) {
+					setTimeout(function() {
+						connect();
+						refreshPage();
+					}, 10000);
+				}
+			};
+		};
+		connect();
+		// Close the stream right away instead of when the server writes to it.
+		$(window).on('pagehide', function() {
+			source.close();
+		});
+	}
+
 	$('.upload-form input[type=file]').on('change', function() {
 		if ('files' in $(this)[0]) {
 			if ($(this)[0].files.length > 0) {
@@ -19,6 +19,7 @@
 # THE SOFTWARE.
 
 import io
+import collections
 import functools
 import hashlib
 import hmac
@@ -28,19 +29,17 @@ import re
 import shlex
 import shutil
 import stat
+import struct
 import subprocess
+import threading
+import time
 import urllib.parse
 import uuid
-import werkzeug
 import zipfile
 
-from . import app, config, models
+from . import config, logger, models
 from urllib.parse import urlparse
-from flask import request, session, redirect, url_for, Response
-from datetime import datetime
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.backends import default_backend
+from datetime import datetime, timedelta, timezone
 
 
 def get_raise(data, key, expect_type=None):
@@ -98,22 +97,178 @@ def get(data, key, expect_type=None, default=None):
 def basic_auth(message='Login required'):
   ''' Sends a 401 response that enables basic auth. '''
 
+  from flask import Response
   headers = {'WWW-Authenticate': 'Basic realm="{}"'.format(message)}
   return Response('Please log in.', 401, headers, mimetype='text/plain')
 
 
+class AuthenticatedUser(object):
+  ''' A snapshot of the name and permissions of a :class:`models.User`
+  that is kept in the :class:`LoginTokenCache`. It is available as
+  ``request.user`` in views decorated with :func:`requires_auth`. '''
+
+  def __init__(self, user):
+    self.id = user.id
+    self.name = user.name
+    self.can_manage = user.can_manage
+    self.can_download_artifacts = user.can_download_artifacts
+    self.can_view_buildlogs = user.can_view_buildlogs
+
+  def url(self):
+    from flask import url_for
+    return url_for('edit_user', user_id=self.id)
+
+
+class CachedLoginToken(object):
+  ''' An entry in the :class:`LoginTokenCache`. '''
+
+  def __init__(self, token, valid_until):
+    self.token = token.token
+    self.ip = token.ip
+    self.user = AuthenticatedUser(token.user)
+    if config.login_token_duration is None:
+      self.expires = None
+    else:
+      self.expires = token.created + config.login_token_duration
+    self.valid_until = valid_until
+
+  def expired(self):
+    return self.expires is not None and self.expires < datetime.now()
+
+
+class LoginTokenCache(object):
+  ''' A bounded LRU cache of validated login tokens, so that
+  :func:`requires_auth` does not need to query the token and its user
+  for every request. Entries are dropped after *ttl* seconds, which
+  bounds how long changes made by other Flux processes go unnoticed.
+  Changes made in this process must be announced with
+  :meth:`invalidate` and :meth:`invalidate_user` after they have been
+  committed. A token that was loaded before an invalidation is not
+  cached, as it may reflect the state before the change. '''
+
+  def __init__(self, max_size=None, ttl=None):
+    self.max_size = max_size
+    self.ttl = ttl
+    self._lock = threading.Lock()
+    self._entries = collections.OrderedDict()
+    self._generation = 0
+
+  def get(self, token_string):
+    ''' Returns the :class:`CachedLoginToken` for *token_string*, loading
+    it from the database if necessary. Returns None if the token does not
+    exist. The token may be expired, check with
+    :meth:`CachedLoginToken.expired`. '''
+
+    if not token_string:
+      return None
+    now = time.monotonic()
+    with self._lock:
+      entry = self._entries.get(token_string)
+      if entry is not None and entry.valid_until > now and not entry.expired():
+        self._entries.move_to_end(token_string)
+        return entry
+      self._entries.pop(token_string, None)
+      generation = self._generation
+
+    token = models.LoginToken.get(token=token_string)
+    if not token:
+      return None
+    ttl = self.ttl if self.ttl is not None else config.login_token_cache_ttl
+    entry = CachedLoginToken(token, now + ttl.total_seconds())
+    if entry.expired():
+      return entry
+
+    max_size = self.max_size if self.max_size is not None else config.login_token_cache_size
+    with self._lock:
+      if generation != self._generation:
+        return entry
+      self._entries[token_string] = entry
+      while len(self._entries) > max_size:
+        self._entries.popitem(last=False)
+    return entry
+
+  def invalidate(self, token_string):
+    with self._lock:
+      self._generation += 1
+      self._entries.pop(token_string, None)
+
+  def invalidate_user(self, user_id):
+    with self._lock:
+      self._generation += 1
+      for key, entry in list(self._entries.items()):
+        if entry.user.id == user_id:
+          del self._entries[key]
+
+  def clear(self):
+    with self._lock:
+      self._generation += 1
+      self._entries.clear()
+
+
+login_token_cache = LoginTokenCache()
+
+
+class ZipIndexCache(object):
+  ''' A bounded LRU cache of :class:`file_utils.ZipIndex` objects, so that
+  the central directory of an artifact is only read once. An entry is
+  read again when the size or modification time of the file changed. '''
+
+  def __init__(self, max_size=None):
+    self.max_size = max_size
+    self._lock = threading.Lock()
+    self._entries = collections.OrderedDict()
+
+  def get(self, filename):
+    ''' Returns the :class:`file_utils.ZipIndex` for *filename*. Raises
+    :class:`OSError` or :class:`zipfile.BadZipFile`. '''
+
+    from flux import file_utils
+
+    st = os.stat(filename)
+    key = (st.st_mtime_ns, st.st_size)
+    with self._lock:
+      entry = self._entries.get(filename)
+      if entry is not None and entry[0] == key:
+        self._entries.move_to_end(filename)
+        return entry[1]
+
+    index = file_utils.ZipIndex(filename)
+    max_size = self.max_size if self.max_size is not None else config.artifact_index_cache_size
+    with self._lock:
+      self._entries[filename] = (key, index)
+      while len(self._entries) > max_size:
+        self._entries.popitem(last=False)
+    return index
+
+
+artifact_index_cache = ZipIndexCache()
+
+
+def get_login_token():
+  ''' Returns the :class:`CachedLoginToken` of the session of the current
+  request, or None if it is not logged in. Must be called inside a
+  database session. '''
+
+  from flask import request, session
+
+  token = login_token_cache.get(session.get('flux_login_token'))
+  if not token or token.ip != request.remote_addr or token.expired():
+    return None
+  return token
+
+
 def requires_auth(func):
   ''' Decorator for view functions that require basic authentication. '''
 
+  from flask import request, session, redirect, url_for
+
   @functools.wraps(func)
   def wrapper(*args, **kwargs):
     ip = request.remote_addr
-    token_string = session.get('flux_login_token')
-    token = models.LoginToken.select(lambda t: t.token == token_string).first()
+    token = login_token_cache.get(session.get('flux_login_token'))
     if not token or token.ip != ip or token.expired():
       if token and token.expired():
         flash("Your login session has expired.")
-        token.delete()
       return redirect(url_for('login'))
 
     request.login_token = token
@@ -123,6 +278,32 @@ def requires_auth(func):
   return wrapper
 
 
+def run_login_token_sweeper(interval=None):
+  ''' Starts a daemon thread that deletes expired login tokens from the
+  database every *interval* (a :class:`timedelta`, defaults to the
+  ``login_token_sweep_interval`` option). Does nothing if login tokens
+  do not expire. '''
+
+  if config.login_token_duration is None:
+    return None
+  interval = (interval or config.login_token_sweep_interval).total_seconds()
+
+  def sweeper():
+    while True:
+      try:
+        with models.session():
+          count = models.LoginToken.delete_expired()
+        if count:
+          logger.info('Deleted {} expired login token(s)'.format(count))
+      except BaseException as exc:
+        logger.exception(exc)
+      time.sleep(interval)
+
+  thread = threading.Thread(target=sweeper, name='LoginTokenSweeper', daemon=True)
+  thread.start()
+  return thread
+
+
 def with_io_response(kwarg='stream', stream_type='text', **response_kwargs):
   ''' Decorator for View functions that create a :class:`io.StringIO` or
   :class:`io.BytesIO` (based on the *stream_type* parameter) and pass it
@@ -136,6 +317,8 @@ def with_io_response(kwarg='stream', stream_type='text', **response_kwargs):
   else:
     raise ValueError('invalid value for stream_type: {!r}'.format(stream_type))
 
+  from flask import Response
+
   def decorator(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
@@ -194,20 +377,175 @@ def create_logger(stream, name=__name__, fmt=None):
   return logger
 
 
-def stream_file(filename, name=None, mime=None):
-  def generate():
+def stream_file(filename, name=None, mime=None, chunk_size=None):
+  ''' Returns a response that sends the file *filename* as an attachment
+  named *name*. Conditional requests (``If-None-Match`` and
+  ``If-Modified-Since``) are answered with 304 Not Modified, and a single
+  byte range is sent as 206 Partial Content.
+
+  The file is read in blocks of *chunk_size* bytes (defaults to the
+  ``stream_chunk_size`` option). If the ``file_offload`` option is set,
+  the file is sent by the reverse proxy instead. '''
+
+  def open_at(offset):
+    fp = open(filename, 'rb')
+    fp.seek(offset)
+    return fp
+
+  st = os.stat(filename)
+  return _send_file(open_at, st.st_size, '{:x}-{:x}'.format(st.st_mtime_ns, st.st_size),
+    int(st.st_mtime), name or os.path.basename(filename), mime, chunk_size,
+    offload_filename=filename, file_wrapper=True)
+
+
+def stream_zip_member(filename, member, name=None, mime=None, chunk_size=None):
+  ''' Like :func:`stream_file`, but sends the *member* (a
+  :class:`zipfile.ZipInfo`) of the zip file *filename* without extracting
+  the archive. Byte ranges are only supported for members that are stored
+  without compression. '''
+
+  if member.flag_bits & 0x1:
+    raise ValueError('encrypted zip members are not supported')
+
+  if member.compress_type == zipfile.ZIP_STORED:
     with open(filename, 'rb') as fp:
-      yield from fp
-  if name is None:
-    name = os.path.basename(filename)
+      fp.seek(member.header_offset)
+      header = struct.unpack(zipfile.structFileHeader, fp.read(zipfile.sizeFileHeader))
+    if header[0] != zipfile.stringFileHeader:
+      raise zipfile.BadZipFile('bad local file header for {!r}'.format(member.filename))
+    # The file name and extra field in the local header can differ from
+    # the ones in the central directory.
+    data_offset = member.header_offset + zipfile.sizeFileHeader + header[10] + header[11]
+    def open_at(offset):
+      fp = open(filename, 'rb')
+      fp.seek(data_offset + offset)
+      return fp
+  else:
+    def open_at(offset):
+      assert offset == 0
+      with zipfile.ZipFile(filename) as zf:
+        return zf.open(member)
+
+  st = os.stat(filename)
+  etag = '{:x}-{:x}-{:x}'.format(st.st_mtime_ns, member.header_offset, member.CRC)
+  return _send_file(open_at, member.file_size, etag, int(st.st_mtime),
+    name or os.path.basename(member.filename), mime, chunk_size,
+    ranges=member.compress_type == zipfile.ZIP_STORED)
+
+
+def _send_file(open_at, size, etag, mtime, name, mime, chunk_size,
+               offload_filename=None, file_wrapper=False, ranges=True):
+  ''' Implements :func:`stream_file`. *open_at* is a function that returns
+  a binary file object positioned at the specified offset of the content,
+  which is *size* bytes long. '''
+
+  from flask import Response, request
+  from werkzeug.http import http_date
+  from werkzeug.wsgi import wrap_file
+
+  chunk_size = chunk_size or config.stream_chunk_size
+
   headers = {}
+  headers['ETag'] = '"{}"'.format(etag)
+  headers['Last-Modified'] = http_date(mtime)
+  headers['Cache-Control'] = 'private, no-cache'
+  if _is_not_modified(request, etag, mtime):
+    return Response(None, 304, headers)
+
   headers['Content-Type'] = mime or 'application/x-octet-stream'
-  headers['Content-Length'] = os.stat(filename).st_size
   headers['Content-Disposition'] = 'attachment; filename="' + name + '"'
-  return Response(generate(), 200, headers)
+  headers['Accept-Ranges'] = 'bytes' if ranges else 'none'
+
+  offload = _get_offload_header(offload_filename) if offload_filename else None
+  if offload:
+    # The proxy handles the Range header itself.
+    headers[offload[0]] = offload[1]
+    headers['Content-Length'] = size
+    return Response(None, 200, headers)
+
+  span = None
+  if ranges and request.range and request.range.units == 'bytes' and _check_if_range(request, etag, mtime):
+    span = request.range.range_for_length(size)
+    if span is None and len(request.range.ranges) == 1:
+      headers['Content-Range'] = 'bytes */{}'.format(size)
+      return Response(None, 416, headers)
+
+  if span is None:
+    headers['Content-Length'] = size
+    if file_wrapper:
+      # Servers that provide `wsgi.file_wrapper` send the file without
+      # occupying the request thread.
+      body = wrap_file(request.environ, open_at(0), chunk_size)
+      return Response(body, 200, headers, direct_passthrough=True)
+    start, stop, status = 0, size, 200
+  else:
+    start, stop = span
+    headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop - 1, size)
+    headers['Content-Length'] = stop - start
+    status = 206
+
+  fp = open_at(start)
+
+  def generate():
+    with fp:
+      remaining = stop - start
+      while remaining > 0:
+        data = fp.read(min(chunk_size, remaining))
+        if not data:
+          break
+        remaining -= len(data)
+        yield data
+
+  return Response(generate(), status, headers, direct_passthrough=True)
+
+
+def _is_not_modified(request, etag, mtime):
+  if request.if_none_match:
+    return request.if_none_match.contains_weak(etag)
+  if request.if_modified_since:
+    return mtime <= _timestamp(request.if_modified_since)
+  return False
+
+
+def _check_if_range(request, etag, mtime):
+  ''' Returns False if an ``If-Range`` header does not match the file, in
+  which case the whole file must be sent. '''
+
+  if_range = request.if_range
+  if if_range.etag:
+    return if_range.etag == etag
+  if if_range.date:
+    return _timestamp(if_range.date) == mtime
+  return True
+
+
+def _timestamp(date):
+  # Older versions of werkzeug parse HTTP dates to naive UTC datetimes.
+  if date.tzinfo is None:
+    date = date.replace(tzinfo=timezone.utc)
+  return date.timestamp()
+
+
+def _get_offload_header(filename):
+  ''' Returns the header name and value that tells the reverse proxy to
+  send *filename* as configured with the ``file_offload`` option, or None. '''
+
+  filename = os.path.abspath(filename)
+  if config.file_offload == 'x-sendfile':
+    return ('X-Sendfile', filename)
+  elif config.file_offload == 'x-accel-redirect':
+    root_dir = os.path.abspath(config.root_dir)
+    if os.path.commonpath([root_dir, filename]) != root_dir:
+      return None
+    relpath = os.path.relpath(filename, root_dir).replace(os.sep, '/')
+    return ('X-Accel-Redirect', config.file_offload_prefix.rstrip('/') + '/' + urllib.parse.quote(relpath))
+  elif config.file_offload:
+    raise ValueError('invalid value for file_offload: {!r}'.format(config.file_offload))
+  return None
 
 
 def flash(message=None):
+  from flask import session
   if message is None:
     return session.pop('flux_flash', None)
   else:
@@ -258,7 +596,7 @@ def zipdir(dirname, filename):
 
 def secure_filename(filename):
   """
-  Similar to #werkzeug.secure_filename(), but preserves leading dots in
+  Similar to #werkzeug.utils.secure_filename(), but preserves leading dots in
   the filename.
   """
 
@@ -271,8 +609,9 @@ def secure_filename(filename):
     else:
       break
 
+  from werkzeug.utils import secure_filename as _secure_filename
   has_dot = filename.startswith('.')
-  filename = werkzeug.secure_filename(filename)
+  filename = _secure_filename(filename)
   if has_dot:
     filename = '.' + filename
   return filename
@@ -409,7 +748,19 @@ def get_date_diff(date1, date2):
   return '{:02d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
 
 
+def get_time_until(date):
+  ''' Returns the rough time until *date* for estimates, eg. ``~5 min``. '''
+
+  minutes = int(round((date - datetime.now()).total_seconds() / 60))
+  if minutes < 1:
+    return '< 1 min'
+  elif minutes < 60:
+    return '~{} min'.format(minutes)
+  return '~{} h {} min'.format(minutes // 60, minutes % 60)
+
+
 def is_page_active(page, user):
+  from flask import request
   path = request.path
 
   if page == 'dashboard' and (not path or path == '/'):
@@ -422,6 +773,8 @@ def is_page_active(page, user):
     return True
   elif page == 'integration' and path == '/integration':
     return True
+  elif page == 'workers' and path == '/workers':
+    return True
   return False
 
 
@@ -437,7 +790,7 @@ def ping_repo(repo_url, repo = None):
   ssh_cmd = ssh_command(None, identity_file=identity_file)
   env = {'GIT_SSH_COMMAND': ' '.join(map(quote, ssh_cmd))}
   ls_remote = ['git', 'ls-remote', '--exit-code', repo_url]
-  res = run(ls_remote, app.logger, env=env)
+  res = run(ls_remote, logger, env=env)
   return res
 
 
@@ -495,6 +848,11 @@ def generate_ssh_keypair():
   tuple(str, str): generated private and public keys
   """
 
+  # Importing cryptography is expensive and only required here.
+  from cryptography.hazmat.primitives import serialization
+  from cryptography.hazmat.primitives.asymmetric import rsa
+  from cryptography.hazmat.backends import default_backend
+
   key = rsa.generate_private_key(backend=default_backend(), public_exponent=65537, key_size=4096)
   private_key = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
   public_key = key.public_key().public_bytes(serialization.Encoding.OpenSSH, serialization.PublicFormat.OpenSSH)
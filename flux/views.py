@@ -18,26 +18,26 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from flux import app, config, file_utils, models, utils
-from flux.build import enqueue, terminate_build
-from flux.models import User, LoginToken, Repository, Build, get_target_for, select, desc
+from flux import app, badges, config, estimates, events, file_utils, metrics, models, utils, webhooks
+from flux.build import queue_build, restart_build, stop_build, resize_consumers, pool_size, active_builds, autoscaler
+from flux.models import User, LoginToken, Repository, Build, WebhookDelivery, get_target_for, select, desc
 from flux.utils import secure_filename
 from flask import request, session, redirect, url_for, render_template, abort
-from datetime import datetime
+from pony import orm
 
 import json
+import mimetypes
 import os
 import uuid
+import zipfile
+
+@app.teardown_request
+def merge_query_stats(exc):
+  metrics.merge_query_stats()
 
-API_GOGS = 'gogs'
-API_GITHUB = 'github'
-API_GITEA = 'gitea'
-API_GITBUCKET = 'gitbucket'
-API_BITBUCKET = 'bitbucket'
-API_BITBUCKET_CLOUD = 'bitbucket-cloud'
-API_GITLAB = 'gitlab'
 
 @app.route('/hook/push', methods=['POST'])
+@webhooks.instrumented
 @utils.with_io_response(mimetype='text/plain')
 @utils.with_logger()
 @models.session
@@ -55,154 +55,52 @@ def hook_push(logger):
   * ``gitlab``
 
   If no or an invalid value is specified for this parameter, a 400
-  Invalid Request response is generator. '''
+  Invalid Request response is generator.
+
+  A valid delivery is stored and answered with 202 Accepted, the build is
+  created in the background (see :mod:`flux.webhooks`). A delivery that
+  was received before is answered with 200 OK and ignored. '''
 
   api = request.args.get('api')
-  if api not in (API_GOGS, API_GITHUB, API_GITEA, API_GITBUCKET, API_BITBUCKET, API_BITBUCKET_CLOUD, API_GITLAB):
+  webhooks.record_delivery(api, request.headers, request.data)
+  if api not in webhooks.apis:
     logger.error('invalid `api` URL parameter: {!r}'.format(api))
     return 400
 
   logger.info('PUSH event received. Processing JSON payload.')
   try:
-    # XXX Determine encoding from Request Headers, if possible.
-    data = json.loads(request.data.decode('utf8'))
-  except (UnicodeDecodeError, ValueError) as exc:
-    logger.error('Invalid JSON data received: {}'.format(exc))
+    event = webhooks.parse_push(api, request.headers, request.data)
+  except webhooks.WebhookError as exc:
+    logger.error(str(exc))
     return 400
 
-  if api == API_GOGS:
-    owner = utils.get(data, 'repository.owner.username', str)
-    name = utils.get(data, 'repository.name', str)
-    ref = utils.get(data, 'ref', str)
-    commit = utils.get(data, 'after', str)
-    secret = utils.get(data, 'secret', str)
-    get_repo_secret = lambda r: r.secret
-  elif api == API_GITHUB:
-    event = request.headers.get('X-Github-Event')
-    if event != 'push':
-      logger.error("Payload rejected (expected 'push' event, got {!r})".format(event))
-      return 400
-    owner = utils.get(data, 'repository.owner.name', str)
-    name = utils.get(data, 'repository.name', str)
-    ref = utils.get(data, 'ref', str)
-    commit = utils.get(data, 'after', str)
-    secret = request.headers.get('X-Hub-Signature', '').replace('sha1=', '')
-    get_repo_secret = lambda r: utils.get_github_signature(r.secret, request.data)
-  elif api == API_GITEA:
-    event = request.headers.get('X-Gitea-Event')
-    if event != 'push':
-      logger.error("Payload rejected (expected 'push' event, got {!r})".format(event))
-      return 400
-    owner = utils.get(data, 'repository.owner.username', str)
-    name = utils.get(data, 'repository.name', str)
-    ref = utils.get(data, 'ref', str)
-    commit = utils.get(data, 'after', str)
-    secret = utils.get(data, 'secret', str)
-    get_repo_secret = lambda r: r.secret
-  elif api == API_GITBUCKET:
-    event = request.headers.get('X-Github-Event')
-    if event != 'push':
-      logger.error("Payload rejected (expected 'push' event, got {!r})".format(event))
-      return 400
-    owner = utils.get(data, 'repository.owner.login', str)
-    name = utils.get(data, 'repository.name', str)
-    ref = utils.get(data, 'ref', str)
-    commit = utils.get(data, 'after', str)
-    secret = request.headers.get('X-Hub-Signature', '').replace('sha1=', '')
-    if secret:
-      get_repo_secret = lambda r: utils.get_github_signature(r.secret, request.data)
-    else:
-      get_repo_secret = lambda r: r.secret
-  elif api == API_BITBUCKET:
-    event = request.headers.get('X-Event-Key')
-    if event != 'repo:refs_changed':
-      logger.error("Payload rejected (expected 'repo:refs_changed' event, got {!r})".format(event))
-      return 400
-    owner = utils.get(data, 'repository.project.name', str)
-    name = utils.get(data, 'repository.name', str)
-    ref = utils.get(data, 'changes.0.refId', str)
-    commit = utils.get(data, 'changes.0.toHash', str)
-    secret = request.headers.get('X-Hub-Signature', '').replace('sha256=', '')
-    if secret:
-      get_repo_secret = lambda r: utils.get_bitbucket_signature(r.secret, request.data)
-    else:
-      get_repo_secret = lambda r: r.secret
-  elif api == API_BITBUCKET_CLOUD:
-    event = request.headers.get('X-Event-Key')
-    if event != 'repo:push':
-      logger.error("Payload rejected (expected 'repo:push' event, got {!r})".format(event))
-      return 400
-    owner = utils.get(data, 'repository.project.project', str)
-    name = utils.get(data, 'repository.name', str)
-
-    ref_type = utils.get(data, 'push.changes.0.new.type', str)
-    ref_name = utils.get(data, 'push.changes.0.new.name', str)
-    ref = "refs/" + ("heads/" if ref_type == "branch" else "tags/") + ref_name
-
-    commit = utils.get(data, 'push.changes.0.new.target.hash', str)
-    secret = None
-    get_repo_secret = lambda r: r.secret
-  elif api == API_GITLAB:
-    event = utils.get(data, 'object_kind', str)
-    if event != 'push' and event != 'tag_push':
-      logger.error("Payload rejected (expected 'push' or 'tag_push' event, got {!r})".format(event))
-      return 400
-    owner = utils.get(data, 'project.namespace', str)
-    name = utils.get(data, 'project.name', str)
-    ref = utils.get(data, 'ref', str)
-    commit = utils.get(data, 'checkout_sha', str)
-    secret = request.headers.get('X-Gitlab-Token')
-    get_repo_secret = lambda r: r.secret
-  else:
-    assert False, "unreachable"
-
-  if not name:
-    logger.error('invalid JSON: no repository name received')
-    return 400
-  if not owner:
-    logger.error('invalid JSON: no repository owner received')
-    return 400
-  if not ref:
-    logger.error('invalid JSON: no Git ref received')
-    return 400
-  if not commit:
-    logger.error('invalid JSON: no commit SHA received')
-    return 400
-  if len(commit) != 40:
-    logger.error('invalid JSON: commit SHA has invalid length')
-    return 400
-  if secret == None:
-    secret = ''
-
-  name = owner + '/' + name
-
-  repo = Repository.get(name=name)
+  repo = Repository.get(name=event.repo_name)
   if not repo:
     logger.error('PUSH event rejected (unknown repository)')
     return 400
-  if get_repo_secret(repo) != secret:
+  if not event.verify(repo):
     logger.error('PUSH event rejected (invalid secret)')
     return 400
-  if not repo.check_accept_ref(ref):
-    logger.info('Git ref {!r} not whitelisted. No build dispatched'.format(ref))
-    return 200
 
-  build = Build(
+  delivery_id = webhooks.get_delivery_id(api, request.headers, request.data)
+  if WebhookDelivery.exists(delivery_id=delivery_id):
+    logger.info('Delivery {} was already received'.format(delivery_id))
+    return 200
+  WebhookDelivery(
+    delivery_id=delivery_id,
+    api=api,
     repo=repo,
-    commit_sha=commit,
-    num=repo.build_count,
-    ref=ref,
-    status=Build.Status_Queued,
-    date_queued=datetime.now(),
-    date_started=None,
-    date_finished=None)
-  repo.build_count += 1
-
-  models.commit()
-  enqueue(build)
-  logger.info('Build #{} for repository {} queued'.format(build.num, repo.name))
-  logger.info(utils.strip_url_path(config.app_url) + build.url())
-  return 200
+    headers=dict(request.headers),
+    payload=request.data)
+  try:
+    models.commit()
+  except orm.TransactionIntegrityError:
+    logger.info('Delivery {} was already received'.format(delivery_id))
+    return 200
+
+  webhooks.notify()
+  logger.info('Delivery {} accepted'.format(delivery_id))
+  return 202
 
 
 @app.route('/')
@@ -211,15 +109,64 @@ def hook_push(logger):
 def dashboard():
   context = {}
   context['builds'] = select(x for x in Build).order_by(desc(Build.date_queued)).limit(10)
+  context['estimates'] = estimates.get_estimates()
   context['user'] = request.user
   return render_template('dashboard.html', **context)
 
 
+@app.route('/events')
+@app.route('/events/<path:path>')
+@models.session
+@utils.requires_auth
+def build_events(path=None):
+  ''' Streams the state changes of the builds of all repositories, or of
+  the repository *path*, as server-sent events (see :mod:`flux.events`).
+  Answers 503 Service Unavailable if there are too many streams. '''
+
+  if path and not Repository.get(name=path):
+    return abort(404)
+  subscription = events.subscribe(repo=path, limit=config.event_stream_limit)
+  if not subscription:
+    response = app.response_class('Too many event streams.', 503, mimetype='text/plain')
+    response.headers['Retry-After'] = '60'
+    return response
+  response = app.response_class(events.stream(subscription), mimetype='text/event-stream')
+  response.headers['Cache-Control'] = 'no-cache'
+  response.headers['X-Accel-Buffering'] = 'no'
+  response.call_on_close(subscription.close)
+  return response
+
+
+@app.route('/badge/<path:path>.svg')
+def badge(path):
+  ''' Sends the status badge of the latest build of the repository *path*,
+  or of the ``ref`` URL parameter in the repository. Badges are served from
+  memory (see :mod:`flux.badges`), to logged in users only unless the
+  ``public_badges`` option is enabled. '''
+
+  if config.public_badges:
+    cache_control = 'public'
+  else:
+    with models.session():
+      if not utils.get_login_token():
+        return abort(403)
+    cache_control = 'private'
+  badge = badges.get_badge(path, request.args.get('ref'))
+  cache_control += ', max-age={}'.format(int(config.badge_max_age.total_seconds()))
+  if request.if_none_match.contains(badge.etag):
+    response = app.response_class(None, 304)
+  else:
+    response = app.response_class(badge.svg, mimetype='image/svg+xml')
+  response.headers['ETag'] = '"{}"'.format(badge.etag)
+  response.headers['Cache-Control'] = cache_control
+  return response
+
+
 @app.route('/repositories')
 @models.session
 @utils.requires_auth
 def repositories():
-  repositories = select(x for x in Repository).order_by(Repository.name)
+  repositories = select(x for x in Repository).order_by(Repository.name)[:]
   return render_template('repositories.html', user=request.user, repositories=repositories)
 
 
@@ -242,6 +189,32 @@ def integration():
   return render_template('integration.html', user=request.user, public_key=utils.get_public_key())
 
 
+@app.route('/workers', methods=['GET', 'POST'])
+@models.session
+@utils.requires_auth
+def workers():
+  if not request.user.can_manage:
+    return abort(403)
+  errors = []
+  if request.method == 'POST':
+    try:
+      size = int(request.form.get('pool_size', ''))
+    except ValueError:
+      size = 0
+    if size < 1:
+      errors.append('The number of parallel builds must be a positive number.')
+    elif not pool_size():
+      errors.append('This process does not run build workers.')
+    else:
+      resize_consumers(size)
+      utils.flash('Running up to {} builds in parallel.'.format(size))
+      return redirect(url_for('workers'))
+  queued = select(e for e in models.QueueEntry if e.claimed_by is None).count()
+  return render_template('workers.html', user=request.user, errors=errors,
+    pool_size=pool_size(), active_builds=active_builds(), queued=queued,
+    autoscaler=autoscaler, bounds=autoscaler.bounds())
+
+
 @app.route('/login', methods=['GET', 'POST'])
 @models.session
 def login():
@@ -263,7 +236,9 @@ def login():
 @utils.requires_auth
 def logout():
   if request.login_token:
-    request.login_token.delete()
+    LoginToken.select(lambda t: t.token == request.login_token.token).delete(bulk=True)
+    models.commit()
+    utils.login_token_cache.invalidate(request.login_token.token)
   session.pop('flux_login_token')
   return redirect(url_for('dashboard'))
 
@@ -279,17 +254,17 @@ def view_repo(path):
   context = {}
   page_size = 10
 
-  try:
-    context['page_number'] = int(request.args.get('page', 1))
-  except ValueError:
-    context['page_number'] = 1
-
-  page_from = (context['page_number'] - 1) * page_size
-  page_to = page_from + page_size
-
-  context['next_page'] = None if context['page_number'] <= 1 else context['page_number'] - 1
-  context['previous_page'] = None if len(repo.builds) <= page_to else context['page_number'] + 1
-  context['builds'] = repo.builds.select().order_by(desc(Build.date_queued))[page_from:page_to]
+  filters = {}
+  for key in ('status', 'ref', 'commit_sha'):
+    value = request.args.get(key, '').strip()
+    if value:
+      filters[key] = value
+  context['filters'] = filters
+
+  query = models.filter_builds(select(x for x in Build if x.repo == repo), **filters)
+  context['builds'], context['older_cursor'], context['newer_cursor'] = \
+    models.paginate_builds(query, page_size, request.args.get('before'), request.args.get('after'))
+  context['estimates'] = estimates.get_estimates()
   return render_template('view_repo.html', user=request.user, repo=repo, **context)
 
 
@@ -373,24 +348,16 @@ def view_build(path):
 
   restart = request.args.get('restart', '').strip().lower() == 'true'
   if restart:
-    if build.status != Build.Status_Building:
-      build.delete_build()
-      build.status = Build.Status_Queued
-      build.date_started = None
-      build.date_finished = None
-      models.commit()
-      enqueue(build)
+    restart_build(build)
     return redirect(build.url())
 
   stop = request.args.get('stop', '').strip().lower() == 'true'
   if stop:
-    if build.status == Build.Status_Queued:
-      build.status = Build.Status_Stopped
-    elif build.status == Build.Status_Building:
-      terminate_build(build)
+    stop_build(build)
     return redirect(build.url())
 
-  return render_template('view_build.html', user=request.user, build=build)
+  estimate = estimates.estimator.get(build.id)
+  return render_template('view_build.html', user=request.user, build=build, estimate=estimate)
 
 
 @app.route('/edit/repo', methods=['GET', 'POST'], defaults={'repo_id': None})
@@ -430,6 +397,7 @@ def edit_repo(repo_id):
     if (other and not repo) or (other and other.id != repo.id):
       errors.append('Repository {!r} already exists'.format(repo_name))
     if not errors:
+      renamed_from = repo.name if repo and repo.name != repo_name else None
       if not repo:
         repo = Repository(
           name=repo_name,
@@ -448,6 +416,11 @@ def edit_repo(repo_id):
         app.logger.info(exc)
         errors.append('Could not make change on build script')
       if not errors:
+        models.commit()
+        badges.badge_cache.invalidate(repo_name)
+        if renamed_from:
+          badges.badge_cache.invalidate(renamed_from)
+          estimates.estimator.invalidate()
         return redirect(repo.url())
 
   return render_template('edit_repo.html', user=request.user, repo=repo, errors=errors, **context)
@@ -500,6 +473,8 @@ def edit_user(user_id):
         cuser.can_manage = can_manage
         cuser.can_view_buildlogs = can_view_buildlogs
         cuser.can_download_artifacts = can_download_artifacts
+      models.commit()
+      utils.login_token_cache.invalidate_user(cuser.id)
     if not errors:
       return redirect(cuser.url())
     models.rollback()
@@ -526,6 +501,46 @@ def download(build_id, data):
   return utils.stream_file(build.path(data), name=download_name, mime=mime)
 
 
+@app.route('/artifacts/<int:build_id>/')
+@app.route('/artifacts/<int:build_id>/<path:path>')
+@models.session
+@utils.requires_auth
+def artifacts(build_id, path=''):
+  ''' Lists a folder in the artifact archive of a build, or sends a
+  single file from it without sending the whole archive. '''
+
+  build = Build.get(id=build_id)
+  if not build:
+    return abort(404)
+  if not build.check_download_permission(Build.Data_Artifact, request.user):
+    return abort(403)
+  if not build.exists(Build.Data_Artifact):
+    return abort(404)
+
+  filename = build.path(Build.Data_Artifact)
+  try:
+    index = utils.artifact_index_cache.get(filename)
+  except (OSError, zipfile.BadZipFile) as exc:
+    app.logger.info(exc)
+    return abort(404)
+
+  member = index.get_member(path)
+  if member:
+    mime = mimetypes.guess_type(member.filename)[0]
+    return utils.stream_zip_member(filename, member, mime=mime)
+  if not index.is_folder(path):
+    return abort(404)
+
+  path = path.strip('/')
+  context = {}
+  context['build'] = build
+  context['user'] = request.user
+  context['path'] = path
+  context['parent_path'] = path.rpartition('/')[0] if path else None
+  context['files'] = index.list_folder(path)
+  return render_template('view_artifacts.html', **context)
+
+
 @app.route('/delete')
 @models.session
 @utils.requires_auth
@@ -557,6 +572,14 @@ def delete():
 
   try:
     delete_target.delete()
+    if isinstance(delete_target, User):
+      models.commit()
+      utils.login_token_cache.invalidate_user(delete_target.id)
+    else:
+      repo_name = (delete_target if isinstance(delete_target, Repository) else delete_target.repo).name
+      models.commit()
+      badges.badge_cache.invalidate(repo_name)
+      estimates.estimator.invalidate()
   except Build.CanNotDelete as exc:
     models.rollback()
     utils.flash(str(exc))
@@ -578,21 +601,10 @@ def build():
   if not request.user.can_manage:
     return abort(403)
 
-  commit = '0' * 32
   repo = Repository.get(id=repo_id)
-  build = Build(
-    repo=repo,
-    commit_sha=commit,
-    num=repo.build_count,
-    ref=ref_name,
-    status=Build.Status_Queued,
-    date_queued=datetime.now(),
-    date_started=None,
-    date_finished=None)
-  repo.build_count += 1
-
-  models.commit()
-  enqueue(build)
+  if not repo:
+    return abort(404)
+  queue_build(repo, ref_name)
   return redirect(repo.url())
 
 @app.route('/ping-repo', methods=['POST'])
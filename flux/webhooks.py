@@ -0,0 +1,451 @@
+# Copyright (c) 2016  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+'''
+This module receives the push events of the Git hosts. The webhook view
+verifies a delivery and stores it (see :class:`models.WebhookDelivery`)
+before it responds, and a background thread turns the stored deliveries
+into builds, one transaction per delivery.
+
+Deliveries are identified by the delivery header that the Git hosts send
+with every request (or by the hash of the payload), so deliveries that
+are retried after a timeout do not create duplicate builds.
+
+If the ``webhook_record_file`` option is set, every request to the webhook
+is appended to that file (see :func:`record_delivery`), so that the traffic
+can be replayed with ``benchmarks/replay.py``.
+'''
+
+from flux import config, events, logger, metrics, models, utils
+from flux.build import enqueue_all, notify_consumers
+from flux.models import select, Build, Repository, WebhookDelivery
+from datetime import datetime
+from pony import orm
+
+import base64
+import collections
+import functools
+import hashlib
+import json
+import threading
+import time
+import uuid
+
+API_GOGS = 'gogs'
+API_GITHUB = 'github'
+API_GITEA = 'gitea'
+API_GITBUCKET = 'gitbucket'
+API_BITBUCKET = 'bitbucket'
+API_BITBUCKET_CLOUD = 'bitbucket-cloud'
+API_GITLAB = 'gitlab'
+
+apis = (API_GOGS, API_GITHUB, API_GITEA, API_GITBUCKET, API_BITBUCKET, API_BITBUCKET_CLOUD, API_GITLAB)
+
+#: The headers that contain the unique ID of a delivery.
+delivery_headers = {
+  API_GOGS: 'X-Gogs-Delivery',
+  API_GITHUB: 'X-GitHub-Delivery',
+  API_GITEA: 'X-Gitea-Delivery',
+  API_GITBUCKET: 'X-GitHub-Delivery',
+  API_BITBUCKET: 'X-Request-Id',
+  API_BITBUCKET_CLOUD: 'X-Request-UUID',
+  API_GITLAB: 'X-Gitlab-Event-UUID',
+}
+
+_wakeup = threading.Event()
+_record_lock = threading.Lock()
+
+
+class WebhookError(Exception):
+  ''' Raised by :func:`parse_push` if a payload is rejected. '''
+
+
+class PushEvent(object):
+  ''' A push event parsed by :func:`parse_push`. The *changes* are a list
+  of ``(ref, commit)`` tuples, every Git ref appears only once. '''
+
+  def __init__(self, api, repo_name, changes, secret, get_repo_secret):
+    self.api = api
+    self.repo_name = repo_name
+    self.changes = changes
+    self.secret = secret
+    self.get_repo_secret = get_repo_secret
+
+  def verify(self, repo):
+    ''' Returns True if the event was signed with the secret of *repo*. '''
+
+    return self.get_repo_secret(repo) == self.secret
+
+
+def parse_push(api, headers, data):
+  ''' Parses the push event payload *data* (bytes) that was sent with the
+  request *headers* for the specified *api*. Returns a :class:`PushEvent`
+  or raises a :class:`WebhookError`.
+
+  Bitbucket payloads can update several refs at once, deleted refs are
+  skipped. The changes are empty if a push only deleted refs. If a ref is
+  updated more than once, the last update supersedes the previous ones. '''
+
+  try:
+    # XXX Determine encoding from Request Headers, if possible.
+    payload = json.loads(data.decode('utf8'))
+  except (UnicodeDecodeError, ValueError) as exc:
+    raise WebhookError('Invalid JSON data received: {}'.format(exc))
+
+  changes = None
+
+  if api == API_GOGS:
+    owner = utils.get(payload, 'repository.owner.username', str)
+    name = utils.get(payload, 'repository.name', str)
+    ref = utils.get(payload, 'ref', str)
+    commit = utils.get(payload, 'after', str)
+    secret = utils.get(payload, 'secret', str)
+    get_repo_secret = lambda r: r.secret
+  elif api == API_GITHUB:
+    event = headers.get('X-Github-Event')
+    if event != 'push':
+      raise WebhookError("Payload rejected (expected 'push' event, got {!r})".format(event))
+    owner = utils.get(payload, 'repository.owner.name', str)
+    name = utils.get(payload, 'repository.name', str)
+    ref = utils.get(payload, 'ref', str)
+    commit = utils.get(payload, 'after', str)
+    secret = headers.get('X-Hub-Signature', '').replace('sha1=', '')
+    get_repo_secret = lambda r: utils.get_github_signature(r.secret, data)
+  elif api == API_GITEA:
+    event = headers.get('X-Gitea-Event')
+    if event != 'push':
+      raise WebhookError("Payload rejected (expected 'push' event, got {!r})".format(event))
+    owner = utils.get(payload, 'repository.owner.username', str)
+    name = utils.get(payload, 'repository.name', str)
+    ref = utils.get(payload, 'ref', str)
+    commit = utils.get(payload, 'after', str)
+    secret = utils.get(payload, 'secret', str)
+    get_repo_secret = lambda r: r.secret
+  elif api == API_GITBUCKET:
+    event = headers.get('X-Github-Event')
+    if event != 'push':
+      raise WebhookError("Payload rejected (expected 'push' event, got {!r})".format(event))
+    owner = utils.get(payload, 'repository.owner.login', str)
+    name = utils.get(payload, 'repository.name', str)
+    ref = utils.get(payload, 'ref', str)
+    commit = utils.get(payload, 'after', str)
+    secret = headers.get('X-Hub-Signature', '').replace('sha1=', '')
+    if secret:
+      get_repo_secret = lambda r: utils.get_github_signature(r.secret, data)
+    else:
+      get_repo_secret = lambda r: r.secret
+  elif api == API_BITBUCKET:
+    event = headers.get('X-Event-Key')
+    if event != 'repo:refs_changed':
+      raise WebhookError("Payload rejected (expected 'repo:refs_changed' event, got {!r})".format(event))
+    owner = utils.get(payload, 'repository.project.name', str)
+    name = utils.get(payload, 'repository.name', str)
+    changes = []
+    for change in utils.get(payload, 'changes', list, []):
+      if utils.get(change, 'type', str) == 'DELETE':
+        continue
+      changes.append((utils.get(change, 'refId', str), utils.get(change, 'toHash', str)))
+    secret = headers.get('X-Hub-Signature', '').replace('sha256=', '')
+    if secret:
+      get_repo_secret = lambda r: utils.get_bitbucket_signature(r.secret, data)
+    else:
+      get_repo_secret = lambda r: r.secret
+  elif api == API_BITBUCKET_CLOUD:
+    event = headers.get('X-Event-Key')
+    if event != 'repo:push':
+      raise WebhookError("Payload rejected (expected 'repo:push' event, got {!r})".format(event))
+    owner = utils.get(payload, 'repository.project.project', str)
+    name = utils.get(payload, 'repository.name', str)
+
+    changes = []
+    for change in utils.get(payload, 'push.changes', list, []):
+      if not change.get('new'):
+        continue  # The ref was deleted
+      ref_type = utils.get(change, 'new.type', str)
+      ref_name = utils.get(change, 'new.name', str)
+      ref = "refs/" + ("heads/" if ref_type == "branch" else "tags/") + ref_name
+      changes.append((ref, utils.get(change, 'new.target.hash', str)))
+    secret = None
+    get_repo_secret = lambda r: r.secret
+  elif api == API_GITLAB:
+    event = utils.get(payload, 'object_kind', str)
+    if event != 'push' and event != 'tag_push':
+      raise WebhookError("Payload rejected (expected 'push' or 'tag_push' event, got {!r})".format(event))
+    owner = utils.get(payload, 'project.namespace', str)
+    name = utils.get(payload, 'project.name', str)
+    ref = utils.get(payload, 'ref', str)
+    commit = utils.get(payload, 'checkout_sha', str)
+    secret = headers.get('X-Gitlab-Token')
+    get_repo_secret = lambda r: r.secret
+  else:
+    raise WebhookError('invalid `api` URL parameter: {!r}'.format(api))
+
+  if not name:
+    raise WebhookError('invalid JSON: no repository name received')
+  if not owner:
+    raise WebhookError('invalid JSON: no repository owner received')
+  if changes is None:
+    changes = [(ref, commit)]
+  for ref, commit in changes:
+    if not ref:
+      raise WebhookError('invalid JSON: no Git ref received')
+    if not commit:
+      raise WebhookError('invalid JSON: no commit SHA received')
+    if len(commit) != 40:
+      raise WebhookError('invalid JSON: commit SHA has invalid length')
+  if secret == None:
+    secret = ''
+
+  changes = list(collections.OrderedDict(changes).items())
+  return PushEvent(api, owner + '/' + name, changes, secret, get_repo_secret)
+
+
+def get_delivery_id(api, headers, data):
+  ''' Returns the ID of the delivery for deduplication. Falls back to the
+  hash of the payload *data* if the delivery header is not present. '''
+
+  value = headers.get(delivery_headers[api])
+  if not value:
+    value = 'sha1:' + hashlib.sha1(data).hexdigest()
+  return '{}:{}'.format(api, value)
+
+
+def record_delivery(api, headers, data):
+  ''' Appends a request to the webhook to the ``webhook_record_file`` as
+  a JSON object with the ``time`` it was received, the ``api``, the
+  ``headers`` and the ``body`` (or ``body_base64`` if the payload is not
+  UTF-8). Does nothing if the option is not set. '''
+
+  if not config.webhook_record_file:
+    return
+  record = {'time': time.time(), 'api': api, 'headers': dict(headers)}
+  try:
+    record['body'] = data.decode('utf8')
+  except UnicodeDecodeError:
+    record['body_base64'] = base64.b64encode(data).decode('ascii')
+  line = json.dumps(record, sort_keys=True) + '\n'
+  with _record_lock:
+    with open(config.webhook_record_file, 'a') as fp:
+      fp.write(line)
+
+
+def read_records(filename):
+  ''' Reads the requests that were written by :func:`record_delivery` and
+  yields tuples of ``(time, api, headers, data)``. '''
+
+  with open(filename) as fp:
+    for line in fp:
+      if not line.strip():
+        continue
+      record = json.loads(line)
+      if 'body_base64' in record:
+        data = base64.b64decode(record['body_base64'])
+      else:
+        data = record['body'].encode('utf8')
+      yield record['time'], record['api'], record['headers'], data
+
+
+def sign_delivery(api, headers, data, secret):
+  ''' The reverse of :func:`parse_push`: returns a copy of the *headers*
+  and the *data* of a delivery, signed with the repository *secret* the
+  same way that the Git host for the *api* does. '''
+
+  headers = dict(headers)
+  if api in (API_GOGS, API_GITEA):
+    payload = json.loads(data.decode('utf8'))
+    payload['secret'] = secret
+    data = json.dumps(payload).encode('utf8')
+  elif api == API_GITHUB or (api == API_GITBUCKET and headers.get('X-Hub-Signature')):
+    headers['X-Hub-Signature'] = 'sha1=' + utils.get_github_signature(secret, data)
+  elif api == API_BITBUCKET and headers.get('X-Hub-Signature'):
+    headers['X-Hub-Signature'] = 'sha256=' + utils.get_bitbucket_signature(secret, data)
+  elif api == API_GITLAB:
+    headers['X-Gitlab-Token'] = secret
+  return headers, data
+
+
+def new_delivery_id(api, headers):
+  ''' Returns a copy of the *headers* with a new delivery ID, so that the
+  delivery is not ignored as a duplicate (see :func:`get_delivery_id`). '''
+
+  name = delivery_headers[api]
+  headers = {k: v for k, v in headers.items() if k.lower() != name.lower()}
+  headers[name] = str(uuid.uuid4())
+  return headers
+
+
+def notify():
+  ''' Wakes up the delivery processor of this process. '''
+
+  _wakeup.set()
+
+
+def process_deliveries(batch_size=None):
+  ''' Creates the builds for up to *batch_size* pending deliveries (defaults
+  to the ``webhook_batch_size`` option) and adds them to the build queue.
+  Every delivery is processed and committed in its own transaction, so a
+  delivery that can not be processed does not hold up the others. Every
+  ref change of a delivery that passes the ref whitelist of the repository
+  creates a build. Returns the number of deliveries that were processed or
+  rejected. '''
+
+  with models.session():
+    query = select(d for d in WebhookDelivery if d.status == WebhookDelivery.Status_Pending)
+    delivery_ids = [d.delivery_id for d in query.order_by(WebhookDelivery.date_received)
+                    [:batch_size or config.webhook_batch_size]]
+
+  count = 0
+  queued = False
+  for delivery_id in delivery_ids:
+    try:
+      with models.session():
+        done, builds = process_delivery(delivery_id)
+    except Exception as exc:
+      logger.exception('Could not process webhook delivery {!r}'.format(delivery_id))
+      delivery_failed(delivery_id, exc)
+      continue
+    count += done
+    queued = queued or bool(builds)
+
+  if queued:
+    notify_consumers()
+  return count
+
+
+def process_delivery(delivery_id):
+  ''' Creates the builds of the pending delivery with the specified ID and
+  commits the current session. Returns a tuple of whether the delivery was
+  processed or rejected, and the list of builds. '''
+
+  from werkzeug.datastructures import Headers
+
+  delivery = WebhookDelivery.get_for_update(delivery_id=delivery_id)
+  if not delivery or delivery.status != WebhookDelivery.Status_Pending:
+    return False, []  # Processed by another Flux process in the meantime
+
+  now = datetime.now()
+  delivery.date_processed = now
+  repo = delivery.repo
+  try:
+    if not repo:
+      raise WebhookError('PUSH event rejected (unknown repository)')
+    event = parse_push(delivery.api, Headers(delivery.headers), delivery.payload)
+  except WebhookError as exc:
+    delivery.status = WebhookDelivery.Status_Failed
+    delivery.message = str(exc)
+    models.commit()
+    return True, []
+
+  changes, rejected = [], []
+  for ref, commit in event.changes:
+    (changes if repo.check_accept_ref(ref) else rejected).append((ref, commit))
+  if rejected:
+    delivery.message = 'Git ref(s) {} not whitelisted. No build dispatched'.format(
+      ', '.join(repr(ref) for ref, commit in rejected))
+
+  builds = []
+  for ref, commit in changes:
+    builds.append(Build(
+      repo=repo,
+      commit_sha=commit,
+      num=repo.build_count,
+      ref=ref,
+      status=Build.Status_Queued,
+      date_queued=now,
+      date_started=None,
+      date_finished=None))
+    repo.build_count += 1
+  enqueue_all(builds)
+  delivery.status = WebhookDelivery.Status_Processed
+  models.commit()
+
+  events.publish_builds(builds)
+  for build in builds:
+    logger.info('Build #{} for repository {} queued'.format(build.num, repo.name))
+  return True, builds
+
+
+def delivery_failed(delivery_id, exc):
+  ''' Records that processing the delivery with the specified ID raised the
+  exception *exc*. The delivery is marked as an error after it failed
+  ``webhook_max_attempts`` times, so that it is not retried forever. '''
+
+  with models.session():
+    delivery = WebhookDelivery.get_for_update(delivery_id=delivery_id)
+    if not delivery or delivery.status != WebhookDelivery.Status_Pending:
+      return
+    delivery.attempts += 1
+    delivery.message = '{}: {}'.format(type(exc).__name__, exc)
+    if delivery.attempts >= config.webhook_max_attempts:
+      delivery.status = WebhookDelivery.Status_Error
+      delivery.date_processed = datetime.now()
+
+
+def instrumented(func):
+  ''' Decorator for the webhook view that counts the requests and
+  measures their latency per ``api`` in :mod:`flux.metrics`. '''
+
+  from flask import request
+
+  @functools.wraps(func)
+  def wrapper(*args, **kwargs):
+    start = time.perf_counter()
+    code = 500
+    try:
+      response = func(*args, **kwargs)
+      code = response.status_code
+      return response
+    finally:
+      api = request.args.get('api')
+      api = api if api in apis else 'invalid'
+      metrics.webhook_requests.inc(api=api, code=code)
+      metrics.webhook_latency.observe(time.perf_counter() - start, api=api)
+
+  return wrapper
+
+
+def run_delivery_processor():
+  ''' Starts a daemon thread that processes the pending deliveries. It is
+  woken up by :func:`notify` and checks for deliveries that were received
+  by other Flux processes every ``webhook_poll_interval``. Deliveries are
+  deleted when they are older than ``webhook_delivery_retention``. '''
+
+  def processor():
+    last_purge = None
+    while True:
+      _wakeup.clear()
+      try:
+        while process_deliveries():
+          pass
+        if not last_purge or datetime.now() - last_purge > config.webhook_delivery_retention / 24:
+          with models.session():
+            count = WebhookDelivery.delete_processed(config.webhook_delivery_retention)
+          if count:
+            logger.info('Deleted {} old webhook deliveries'.format(count))
+          last_purge = datetime.now()
+      except orm.TransactionError as exc:
+        logger.debug('Could not process webhook deliveries: {}'.format(exc))
+      except BaseException as exc:
+        logger.exception(exc)
+      metrics.merge_query_stats()
+      _wakeup.wait(config.webhook_poll_interval.total_seconds())
+
+  thread = threading.Thread(target=processor, name='WebhookDeliveryProcessor', daemon=True)
+  thread.start()
+  return thread
@@ -25,6 +25,100 @@ host = os.environ.get('FLUX_HOST', 'localhost')
 ## Port of the Flux web server.
 port = int(os.environ.get('FLUX_PORT', 4042))
 
+## The server that runs the web interface. "werkzeug" is the development
+## server. Use "waitress" for production deployments, which requires the
+## waitress package ("pip install flux-ci[production]").
+web_server = 'werkzeug'
+
+## Options for the "waitress" server: the number of threads that handle
+## requests, the maximum number of open connections, the length of the
+## socket listen queue and the time after which idle keep-alive
+## connections are closed.
+web_threads = 32
+web_connection_limit = 100
+web_backlog = 1024
+web_keepalive_timeout = timedelta(seconds=120)
+
+## Run the build workers in the webserver process. Disable this option
+## to run them in one or more separate "flux-ci worker" processes that
+## share the database with the webserver.
+embedded_workers = True
+
+## Push events are stored by the webhook and turned into builds in the
+## background, up to this many deliveries at once. Deliveries that were
+## received by another Flux process are picked up after the poll interval.
+## A delivery that can not be processed is retried up to the maximum number
+## of attempts. Processed deliveries are kept for the retention period to
+## detect deliveries that are retried by the Git host.
+webhook_batch_size = 50
+webhook_max_attempts = 5
+webhook_poll_interval = timedelta(seconds=5)
+webhook_delivery_retention = timedelta(days=7)
+
+## Append every request to the webhook (headers and payload) to this
+## JSON lines file, to replay the traffic with benchmarks/replay.py.
+## The file contains the signatures and secrets of the payloads.
+webhook_record_file = None
+
+## Artifacts and logs are sent in blocks of this many bytes.
+stream_chunk_size = 64 * 1024
+
+## Let the reverse proxy send artifacts and logs instead of the Flux
+## process. Set to 'x-sendfile' for Apache (mod_xsendfile) or lighttpd,
+## or to 'x-accel-redirect' for nginx. With nginx, files are redirected
+## to the internal location file_offload_prefix, which must be an alias
+## of the root_dir (see the Installation documentation).
+file_offload = None
+file_offload_prefix = '/_flux_files/'
+
+## The number of artifacts whose file listing is kept in memory for the
+## artifact browser.
+artifact_index_cache_size = 32
+
+## Pages are updated live with server-sent events. Every event stream
+## occupies one of the web_threads, so the number of streams is limited
+## and should stay below web_threads. A closed tab releases its stream with
+## the next keepalive, the first write that notices the disconnect.
+## Streams end after the duration and are reopened by the browser, and a
+## browser that does not keep up with the events reloads the page instead.
+## Changes made by worker processes are picked up every poll interval.
+event_queue_size = 100
+event_stream_limit = 24
+event_stream_duration = timedelta(minutes=5)
+event_keepalive_interval = timedelta(seconds=5)
+event_poll_interval = timedelta(seconds=2)
+
+## Status badges (/badge/<owner>/<repo>.svg?ref=<branch>) may be cached by
+## browsers and image proxies for this long. Badges reveal the build status
+## of any repository whose name is known, so they are only served to logged
+## in users unless "public_badges" is enabled.
+badge_max_age = timedelta(minutes=1)
+public_badges = False
+
+## The queue position and the estimated start and finish of queued builds
+## are computed from the average build duration of every repository. The
+## average is weighted by this factor towards the most recent builds.
+estimate_smoothing = 0.2
+
+## The webserver serves Prometheus metrics at /metrics to users with the
+## "manage" privilege (use HTTP Basic authentication in the scrape config).
+## Worker processes (see the "worker" command) serve their metrics on this
+## host and port if the port is set. The metrics are only sent to users with
+## the "manage" privilege, too. Bind to a public address only if the
+## Prometheus server runs on another host.
+worker_metrics_host = '127.0.0.1'
+worker_metrics_port = None
+
+## Record the latency and database queries of every request per endpoint
+## (see /metrics), and log requests that take longer than the threshold
+## with their SQL statements. A share of the requests can be profiled with
+## cProfile, the profiles are written to profile_dir (defaults to the
+## "profiles" folder in the root_dir).
+request_profiling = False
+slow_request_threshold = timedelta(seconds=1)
+profile_sample_rate = 0
+profile_dir = None
+
 ## Enable this option to increase the logging output, wich makes it
 ## easier to find and debug problems with Flux.
 debug = True
@@ -60,15 +154,61 @@ database = {
   'create_db': True
 }
 
+## The number of IDs that a Flux process reserves at once for new users,
+## repositories, builds and login tokens. Larger blocks mean fewer writes
+## to the ID sequence table, but IDs that were reserved by a process and
+## not used before it exits are skipped.
+id_block_size = 20
+
 ## Username and password of the root user with full access.
 root_user = 'root'
 root_password = 'alpine'
 
 ## The number of builds that may be executed in parallel. One is
 ## usually a good value since today's builds (depending on the used
-## build system) are usually multiprocessed already.
+## build system) are usually multiprocessed already. The number can be
+## changed at runtime on the "Workers" page or with the API, without
+## interrupting the running builds.
 parallel_builds = 1
 
+## Adjusts the number of parallel builds of every Flux process to the
+## load of the host. Every "autoscale_interval", a process runs one build
+## less if the load average per CPU exceeds "autoscale_max_load" or the
+## available memory or the free space of "build_dir" (in bytes) is below
+## the minimum, and one build more if builds are waiting in the queue.
+## The number stays between "autoscale_min_builds" and
+## "autoscale_max_builds" (defaults to "parallel_builds").
+autoscale = False
+autoscale_min_builds = 1
+autoscale_max_builds = None
+autoscale_interval = timedelta(seconds=30)
+autoscale_max_load = 1.0
+autoscale_min_free_memory = 512 * 1024 * 1024
+autoscale_min_free_disk = 1024 * 1024 * 1024
+
+## The build queue is stored in the database and can be consumed by
+## several Flux processes. A process claims a queued build with a lease
+## that it renews while the build is running. If the process dies, the
+## build is marked as stopped after the lease expired. Every process also
+## registers the size of its worker pool, which the queue estimates use,
+## and is considered dead if it did not renew it for the same duration.
+## Workers check the database for new builds at least every
+## "queue_poll_interval".
+queue_lease_duration = timedelta(minutes=2)
+queue_poll_interval = timedelta(seconds=5)
+
+## The order in which queued builds are started. "fifo" starts them in the
+## order in which they were queued. "sejf" starts the build that is expected
+## to finish first (by the average build duration of its repository), which
+## lowers the average wait time if some repositories have long builds.
+## Every second that a build waits counts as "queue_aging_factor" seconds
+## less of expected duration, so long builds are not delayed forever. Only
+## the oldest "queue_policy_window" builds are considered. Compare the
+## policies on your build history with benchmarks/scheduling.py.
+queue_policy = 'fifo'
+queue_aging_factor = 1.0
+queue_policy_window = 100
+
 ## Filenames of build scripts in a repository. The first matching
 ## filename will be used.
 if os.name == 'nt':
@@ -106,3 +246,13 @@ ssh_verbose = False
 ## The time that a login token should be valid for. Specify "None" to
 ## prevent login tokens from expiring.
 login_token_duration = timedelta(hours=6)
+
+## Validated login tokens are cached in memory so that pages do not need
+## to query the token and its user on every request. Changes to a user that
+## are made by another Flux process sharing the database take effect after
+## at most "login_token_cache_ttl".
+login_token_cache_size = 1000
+login_token_cache_ttl = timedelta(minutes=5)
+
+## How often expired login tokens are deleted from the database.
+login_token_sweep_interval = timedelta(minutes=15)
@@ -10,9 +10,9 @@ def package_files(directory):
       paths.append(os.path.join('..', path, filename))
   return paths
 
-if sys.version[:3] < '3.4':
+if sys.version_info < (3, 7):
   raise EnvironmentError('Flux CI is not compatible with Python {}'
-                         .format(sys.version[:3]))
+                         .format(sys.version.split()[0]))
 
 with open('README.md') as fp:
   readme = fp.read()
@@ -30,7 +30,11 @@ setuptools.setup(
   long_description_content_type = 'text/markdown',
   license = 'MIT',
   url = 'https://github.com/NiklasRosenstein/flux-ci',
+  python_requires = '>=3.7',
   install_requires = requirements,
+  extras_require = {
+    'production': ['waitress>=1.1.0'],
+  },
   packages = setuptools.find_packages(),
   package_data = {
     'flux': package_files('flux/static') + package_files('flux/templates')
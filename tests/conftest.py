@@ -0,0 +1,90 @@
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+
+@pytest.fixture(scope='session')
+def flux_root():
+  ''' Loads the default configuration with a temporary root directory and
+  sets up the database. Pony can bind the models only once per process,
+  so all tests share the database. '''
+
+  with tempfile.TemporaryDirectory() as root:
+    os.environ['FLUX_ROOT'] = root
+    from flux import config, main
+    config.load(os.path.join(repo_dir, 'flux_config.py'))
+    main.setup()
+    yield root
+
+
+@pytest.fixture
+def make_repo(flux_root):
+  ''' Returns a function that creates a repository with the secret
+  "secret" in the current database session. '''
+
+  import uuid
+  from flux import models
+
+  def make_repo():
+    return models.Repository(name='test/' + uuid.uuid4().hex[:8], clone_url='file:///dev/null',
+      secret='secret', build_count=0)
+  return make_repo
+
+
+@pytest.fixture
+def make_build(flux_root):
+  ''' Returns a function that adds a build with the next number to a
+  repository in the current database session. '''
+
+  from datetime import datetime
+  from flux import models
+
+  def make_build(repo, status='success', ref='refs/heads/master', commit_sha='0' * 40):
+    build = models.Build(repo=repo, commit_sha=commit_sha, num=repo.build_count, ref=ref,
+      status=status, date_queued=datetime.now())
+    repo.build_count += 1
+    return build
+  return make_build
+
+
+@pytest.fixture
+def repo(make_repo):
+  ''' The ID of a new repository. '''
+
+  from flux import models
+  with models.session():
+    return make_repo().id
+
+
+@pytest.fixture
+def client(flux_root):
+  ''' A test client that is logged in as the root user. '''
+
+  import flux
+  from flux import app, config, views, api, build, events, profiling, webhooks
+  app.jinja_env.globals['config'] = config
+  app.jinja_env.globals['flux'] = flux
+  app.secret_key = 'test'
+  client = app.test_client()
+  response = client.post('/login', data={'user_name': config.root_user, 'user_password': config.root_password})
+  assert response.status_code == 302
+  return client
+
+
+@pytest.fixture
+def wait_for():
+  ''' Returns a function that waits until *predicate* returns True, and
+  fails the test after *timeout* seconds. '''
+
+  def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+      assert time.monotonic() < deadline, 'timeout'
+      time.sleep(0.01)
+  return wait_for
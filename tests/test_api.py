@@ -0,0 +1,136 @@
+def test_builds_etag(client, repo, make_build):
+  from flux import build, models
+  with models.session():
+    r = models.Repository[repo]
+    name = r.name
+    done = make_build(r)
+
+  url = '/api/v1/builds?repo=' + name
+  response = client.get(url)
+  assert response.status_code == 200
+  etag = response.headers['ETag']
+  assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+  with models.session():
+    queued = build.queue_build(models.Repository[repo], 'refs/heads/master')
+  response = client.get(url, headers={'If-None-Match': etag})
+  assert response.status_code == 200
+  assert [b['id'] for b in response.get_json()['builds']] == [queued.id, done.id]
+  etag = response.headers['ETag']
+
+  assert client.get('/delete?build_id={}'.format(queued.id)).status_code == 302
+  response = client.get(url, headers={'If-None-Match': etag})
+  assert response.status_code == 200
+  assert [b['id'] for b in response.get_json()['builds']] == [done.id]
+
+
+def test_queue_etag(client, repo):
+  from flux import build, models
+  url = '/api/v1/queue'
+  response = client.get(url)
+  assert response.status_code == 200
+  etag = response.headers['ETag']
+  assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+  with models.session():
+    queued = build.queue_build(models.Repository[repo], 'refs/heads/master')
+  response = client.get(url, headers={'If-None-Match': etag})
+  assert response.status_code == 200
+  assert queued.id in [b['id'] for b in response.get_json()['builds']]
+  etag = response.headers['ETag']
+  assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+  assert client.get('/delete?build_id={}'.format(queued.id)).status_code == 302
+  response = client.get(url, headers={'If-None-Match': etag})
+  assert response.status_code == 200
+  assert queued.id not in [b['id'] for b in response.get_json()['builds']]
+
+
+def test_cross_site_post_is_rejected(client, repo):
+  from flux import models
+  with models.session():
+    name = models.Repository[repo].name
+  data = {'repo': name, 'ref': 'refs/heads/master'}
+  assert client.post('/api/v1/builds', data=data).status_code == 403
+  response = client.post('/api/v1/builds', data=data, headers={'Origin': 'http://evil.example.com'})
+  assert response.status_code == 403
+  response = client.post('/api/v1/builds', data=data, headers={'Origin': 'http://localhost'})
+  assert response.status_code == 201
+  build_id = response.get_json()['id']
+  response = client.post('/api/v1/builds/{}/stop'.format(build_id), headers={'Referer': 'http://localhost/'})
+  assert response.status_code == 200
+
+
+def test_basic_auth_post_without_origin(client, repo):
+  import base64
+  from flux import app, config, models
+  with models.session():
+    name = models.Repository[repo].name
+  credentials = base64.b64encode('{}:{}'.format(config.root_user, config.root_password).encode()).decode()
+  basic_client = app.test_client()
+  headers = {'Authorization': 'Basic ' + credentials}
+  response = basic_client.post('/api/v1/builds', data={'repo': name, 'ref': 'refs/heads/master'}, headers=headers)
+  assert response.status_code == 201
+  headers['Origin'] = 'http://evil.example.com'
+  response = basic_client.post('/api/v1/builds/{}/stop'.format(response.get_json()['id']), headers=headers)
+  assert response.status_code == 403
+
+
+def test_workers_resize_requires_manage(client, monkeypatch):
+  import base64
+  import uuid
+  from flux import api, app, models, utils
+  name = 'user-' + uuid.uuid4().hex[:8]
+  with models.session():
+    models.User(name=name, passhash=utils.hash_pw('secret'), can_manage=False,
+      can_download_artifacts=False, can_view_buildlogs=False)
+  resized = []
+  monkeypatch.setattr(api, 'resize_consumers', resized.append)
+  monkeypatch.setattr(api, 'pool_size', lambda: 2)
+
+  credentials = base64.b64encode('{}:secret'.format(name).encode()).decode()
+  headers = {'Authorization': 'Basic ' + credentials}
+  response = app.test_client().post('/api/v1/workers', data={'size': '3'}, headers=headers)
+  assert response.status_code == 403
+  assert resized == []
+  response = client.post('/api/v1/workers', data={'size': '3'}, headers={'Origin': 'http://localhost'})
+  assert response.status_code == 200
+  assert resized == [3]
+
+
+def test_etag_changes_when_the_pool_is_resized(client, repo, monkeypatch):
+  from datetime import datetime
+  from flux import build, estimates, models
+  now = datetime.now()
+
+  class frozen_datetime(datetime):
+    @classmethod
+    def now(cls):
+      return now
+
+  # Recompute the estimates and read the pool size for every request, at
+  # the same time, so that only the pool size changes the estimates.
+  monkeypatch.setattr(estimates, 'datetime', frozen_datetime)
+  monkeypatch.setattr(estimates.estimator, 'max_age', -1)
+  with models.session():
+    models.Worker.select().delete(bulk=True)
+    r = models.Repository[repo]
+    r.duration_estimate = 60.0
+    name = r.name
+    build.queue_build(r, 'refs/heads/master')
+    queued = build.queue_build(r, 'refs/heads/master').id
+  estimates.estimator.invalidate()
+
+  urls = ['/api/v1/builds?repo=' + name, '/api/v1/builds/{}'.format(queued)]
+  etags = [client.get(url).headers['ETag'] for url in urls]
+  assert [client.get(url).headers['ETag'] for url in urls] == etags
+  try:
+    with models.session():
+      models.Worker.register('etag-test', 100, now)
+    for url, etag in zip(urls, etags):
+      response = client.get(url, headers={'If-None-Match': etag})
+      assert response.status_code == 200
+      assert response.headers['ETag'] != etag
+  finally:
+    with models.session():
+      models.Worker.select().delete(bulk=True)
@@ -0,0 +1,72 @@
+def test_badge_status_of_latest_build(repo, make_build):
+  from flux import badges, build, models
+  cache = badges.BadgeCache()
+  with models.session():
+    r = models.Repository[repo]
+    name = r.name
+    make_build(r, 'success')
+    make_build(r, 'error')
+    make_build(r, 'success', ref='refs/heads/dev')
+
+  assert cache.get_status(name, 'refs/heads/master') == 'error'
+  assert cache.get_status(name, 'refs/heads/dev') == 'success'
+  assert cache.get_status(name) == 'success'
+  assert cache.get_status(name, 'refs/heads/other') is None
+  assert cache.get_status('test/unknown') is None
+
+  with models.session():
+    queued = build.queue_build(models.Repository[repo], 'refs/heads/master')
+  assert cache.get_status(name, 'refs/heads/master') == 'queued'
+  assert cache.get_status(name) == 'queued'
+
+
+def test_badge_status_follows_build_numbers(repo, make_build):
+  from flux import badges, models
+  cache = badges.BadgeCache()
+  with models.session():
+    r = models.Repository[repo]
+    name = r.name
+    newer = make_build(r, 'error')
+    older = make_build(r, 'success')
+    # IDs are not chronological, the build with the higher number is the latest.
+    newer.num, older.num = older.num, newer.num
+
+  assert cache.get_status(name, 'refs/heads/master') == 'error'
+  assert cache.get_status(name) == 'error'
+
+
+def test_unknown_repositories_are_remembered(flux_root, monkeypatch):
+  import uuid
+  from flux import badges
+  cache = badges.BadgeCache()
+  loads = []
+  load = cache._load
+  monkeypatch.setattr(cache, '_load', lambda name: loads.append(name) or load(name))
+  name = 'test/' + uuid.uuid4().hex[:8]
+
+  assert cache.get_status(name) is None
+  assert cache.get_status(name) is None
+  assert loads == [name]
+  cache.invalidate(name)
+  assert cache.get_status(name) is None
+  assert loads == [name, name]
+
+
+def test_badges_require_login_unless_public(client, repo, make_build, monkeypatch):
+  from flux import app, config, models
+  with models.session():
+    r = models.Repository[repo]
+    url = '/badge/{}.svg'.format(r.name)
+    make_build(r, 'success')
+
+  anonymous = app.test_client()
+  assert anonymous.get(url).status_code == 403
+  response = client.get(url)
+  assert response.status_code == 200
+  assert response.headers['Cache-Control'].startswith('private')
+
+  monkeypatch.setattr(config, 'public_badges', True)
+  response = anonymous.get(url)
+  assert response.status_code == 200
+  assert response.headers['Cache-Control'].startswith('public')
+  assert b'passing' in response.data
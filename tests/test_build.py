@@ -0,0 +1,221 @@
+import threading
+from datetime import timedelta
+
+import pytest
+
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_worker_survives_claim_errors(flux_root, monkeypatch, wait_for):
+  from flux import build, config
+  monkeypatch.setattr(config, 'queue_poll_interval', timedelta(milliseconds=10))
+  consumer = build.BuildConsumer()
+  calls = []
+
+  def claim():
+    calls.append(threading.current_thread())
+    if len(calls) == 1:
+      raise RuntimeError('database is locked')
+    if len(calls) == 2:
+      raise SystemExit  # kills the worker thread
+    return None
+
+  monkeypatch.setattr(consumer, '_claim', claim)
+  consumer.start(1)
+  try:
+    wait_for(lambda: len(calls) >= 2)
+    assert calls[0] is calls[1]
+    wait_for(lambda: not calls[1].is_alive())
+    assert consumer._workers == 0
+    consumer.resize(1)
+    wait_for(lambda: len(calls) >= 3)
+    assert calls[2] is not calls[1]
+    assert consumer._workers == 1
+  finally:
+    consumer.stop()
+  assert consumer._workers == 0
+
+
+def test_claim_gives_up_after_lost_races(flux_root, monkeypatch):
+  from flux import build
+  from pony import orm
+  consumer = build.BuildConsumer()
+  calls = []
+
+  def next_entry(now):
+    calls.append(now)
+    raise orm.TransactionError('lost the race')
+
+  monkeypatch.setattr(consumer, '_next_entry', next_entry)
+  assert consumer._claim() is None
+  assert len(calls) == consumer.claim_attempts
+
+
+def test_put_leaves_the_commit_to_the_caller(repo, make_build):
+  from flux import build, models
+  consumer = build.BuildConsumer()
+  with models.session():
+    queued = make_build(models.Repository[repo], status='queued')
+    models.commit()
+    consumer.put(queued)
+    assert queued.queue_entry
+    models.rollback()
+  with models.session():
+    assert models.QueueEntry.get(build=queued.id) is None
+
+
+
+def test_phase_timer_records_consecutive_phases(monkeypatch):
+  from flux import build
+  clock = iter([10.0, 10.5, 10.5, 12.0, 12.0, 12.25])
+  monkeypatch.setattr(build.time, 'perf_counter', lambda: next(clock))
+  timer = build.PhaseTimer()
+  timer.start('clone')
+  timer.start('checkout')
+  timer.start('script')
+  timer.stop()
+  timer.stop()
+  assert [(name, seconds) for name, date, seconds in timer.phases] == \
+    [('clone', 0.5), ('checkout', 1.5), ('script', 0.25)]
+
+
+def test_do_build_stores_phases(make_repo, make_build, tmp_path):
+  import subprocess
+  from flux import build, models
+
+  def git(*args):
+    subprocess.run(('git', '-c', 'user.name=test', '-c', 'user.email=test@localhost') + args,
+      cwd=str(tmp_path), check=True, stdout=subprocess.DEVNULL)
+
+  git('init', '-q')
+  script = tmp_path / '.flux-build.sh'
+  script.write_text('#!/bin/sh\necho done\n')
+  script.chmod(0o755)
+  git('add', '-A')
+  git('commit', '-q', '-m', 'fixture')
+  sha = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=str(tmp_path)).decode().strip()
+
+  with models.session():
+    repo = make_repo()
+    repo.clone_url = str(tmp_path)
+    build_id = make_build(repo, status='queued', commit_sha=sha).id
+
+  assert build.do_build(build_id, threading.Event())
+  with models.session():
+    finished = models.Build[build_id]
+    rows = finished.phases.select().order_by(models.BuildPhase.date_started)[:]
+    assert [p.name for p in rows] == ['clone', 'checkout', 'overrides', 'script', 'zip', 'rmtree']
+    assert all(p.duration >= 0 for p in rows)
+    assert sum(p.duration for p in rows) <= (finished.date_finished - finished.date_started).total_seconds()
+    timeline = finished.phase_timeline()
+    assert [s.name for s in timeline] == [p.name for p in rows]
+    assert [s.duration for s in timeline] == [p.duration for p in rows]
+    assert sum(s.percent for s in timeline) == pytest.approx(100)
+    averages = finished.repo.phase_averages()
+    assert [s.name for s in averages] == models.BuildPhase.Names
+
+
+class FakeConsumer(object):
+
+  def __init__(self, size, active):
+    self.size = size
+    self.active = active
+
+  def pool_size(self):
+    return self.size
+
+  def active_builds(self):
+    return self.active
+
+  def resize(self, size):
+    self.size = size
+
+
+@pytest.fixture
+def autoscale(repo, monkeypatch):
+  ''' Returns a function that runs one check of an autoscaler with the
+  measured *values* and returns the new pool size. One build is queued. '''
+
+  from flux import build, config, models
+  monkeypatch.setattr(config, 'autoscale_min_builds', 2)
+  monkeypatch.setattr(config, 'autoscale_max_builds', 4)
+  with models.session():
+    queued = build.queue_build(models.Repository[repo], 'refs/heads/master')
+
+  def autoscale(size, active, **values):
+    values = dict({'load': 0.1, 'free_memory': None, 'free_disk': None}, **values)
+    autoscaler = build.Autoscaler(FakeConsumer(size, active))
+    monkeypatch.setattr(autoscaler, 'measure', lambda: dict(values))
+    result = autoscaler.check()
+    assert autoscaler.consumer.size == result == autoscaler.last_check['size']
+    return result
+
+  yield autoscale
+  with models.session():
+    models.Build[queued.id].delete()
+
+
+def test_autoscaler_grows_busy_pool(autoscale):
+  assert autoscale(2, 2) == 3
+  assert autoscale(3, 2) == 3  # a worker is idle
+
+
+def test_autoscaler_shrinks_under_pressure(autoscale):
+  from flux import config
+  assert autoscale(3, 3, load=config.autoscale_max_load + 1) == 2
+  assert autoscale(3, 3, free_memory=config.autoscale_min_free_memory - 1) == 2
+  assert autoscale(3, 3, free_disk=0) == 2
+
+
+def test_autoscaler_clamps_pool(autoscale):
+  from flux import config
+  assert autoscale(4, 4) == 4
+  assert autoscale(6, 0) == 5
+  assert autoscale(1, 0, load=config.autoscale_max_load + 1) == 2
+  assert autoscale(2, 2, load=config.autoscale_max_load + 1) == 2
+
+
+def test_skip_locked_support():
+  from flux import models
+  assert models.supports_skip_locked('postgres', '90500')
+  assert not models.supports_skip_locked('postgres', '90424')
+  assert models.supports_skip_locked('mysql', '8.0.32')
+  assert not models.supports_skip_locked('mysql', '8.0.0-dmr')
+  assert not models.supports_skip_locked('mysql', '5.7.30-log')
+  assert models.supports_skip_locked('mysql', '10.6.12-MariaDB-1:10.6.12+maria~ubu2004')
+  assert not models.supports_skip_locked('mysql', '10.5.8-MariaDB')
+  assert models.supports_skip_locked('sqlite', '3.40.1')
+
+
+def test_claim_without_skip_locked(repo, make_build, monkeypatch):
+  from flux import build, models
+  from pony import orm
+
+  class FakeDatabase(object):
+    provider_name = 'mysql'
+    select = staticmethod(lambda sql: ['5.7.30-log'])
+
+  monkeypatch.setattr(models, 'db', FakeDatabase())
+  assert models._detect_skip_locked() is False
+  monkeypatch.undo()
+
+  calls = []
+  for_update = orm.core.Query.for_update
+
+  def spy(self, nowait=False, skip_locked=False):
+    calls.append(skip_locked)
+    return for_update(self, nowait=nowait, skip_locked=skip_locked)
+
+  monkeypatch.setattr(orm.core.Query, 'for_update', spy)
+  monkeypatch.setattr(models, 'skip_locked', False)
+  consumer = build.BuildConsumer()
+  with models.session():
+    queued = make_build(models.Repository[repo], status='queued')
+    consumer.put(queued)
+  try:
+    claimed = consumer._claim()
+    assert claimed is not None
+    consumer._release(claimed)
+    assert calls and not any(calls)
+  finally:
+    with models.session():
+      models.Build[queued.id].delete()
@@ -0,0 +1,26 @@
+import pytest
+
+
+def test_lint_reports_invalid_files(tmp_path):
+  from flux import cifile
+  result = cifile.lint_cifile(str(tmp_path / 'missing.yml'), 'master', 'src', 'msg', 'refs/heads/master')
+  assert not result['ok']
+  assert result['error'].startswith('FileNotFoundError')
+
+
+def test_lint_does_not_swallow_interrupts(tmp_path, monkeypatch):
+  from flux import cifile
+
+  def read_cifile(self, path):
+    raise KeyboardInterrupt
+
+  monkeypatch.setattr(cifile.CiFile, 'read_cifile', read_cifile)
+  with pytest.raises(KeyboardInterrupt):
+    cifile.lint_cifile(str(tmp_path / '.flux.yml'), 'master', 'src', 'msg', 'refs/heads/master')
+
+
+def test_batch_results_follow_input_order(tmp_path):
+  from flux import cifile
+  paths = [str(tmp_path / name) for name in ('b.yml', 'c.yml', 'a.yml', 'd.yml')]
+  results = list(cifile.lint_cifiles(paths, 'master', 'src', 'msg', 'refs/heads/master', jobs=2))
+  assert [x['file'] for x in results] == paths
@@ -0,0 +1,117 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def estimator(flux_root, monkeypatch):
+  ''' A queue estimator with a running build of repository "a" that is
+  halfway done, and three queued builds. No workers are registered. '''
+
+  from flux import config, estimates, models
+  monkeypatch.setattr(config, 'queue_policy', 'fifo')
+  monkeypatch.setattr(config, 'parallel_builds', 1)
+  with models.session():
+    models.Worker.select().delete(bulk=True)
+  now = datetime(2020, 1, 1, 12, 0, 0)
+  estimator = estimates.QueueEstimator()
+  estimator._durations = {'a': 60.0, 'b': 120.0}
+  estimator._running = {1: (now - timedelta(seconds=30), 'a')}
+  estimator._queued = {
+    2: (now - timedelta(seconds=20), 'a'),
+    3: (now - timedelta(seconds=10), 'b'),
+    4: (now - timedelta(seconds=5), 'c'),
+  }
+  estimator.now = now
+  return estimator
+
+
+def offsets(estimates, now):
+  return {build_id: (e.position, (e.date_started - now).total_seconds(),
+          (e.date_finished - now).total_seconds()) for build_id, e in estimates.items()}
+
+
+def test_estimates_with_registered_workers(estimator):
+  from flux import models
+  now = estimator.now
+  with models.session():
+    models.Worker.register('worker-1', 1, now)
+    models.Worker.register('worker-2', 1, now)
+  try:
+    assert offsets(estimator._compute(now, estimator._pool_size(now)), now) == {
+      1: (None, -30, 30),
+      2: (1, 0, 60),
+      3: (2, 30, 150),
+      4: (3, 60, 150),  # "c" takes the average of "a" and "b"
+    }
+  finally:
+    with models.session():
+      models.Worker.select().delete(bulk=True)
+
+
+def test_estimates_ignore_dead_workers(estimator):
+  from flux import config, models
+  now = estimator.now
+  with models.session():
+    models.Worker(worker_id='dead', pool_size=4, date_seen=now - config.queue_lease_duration * 2)
+  try:
+    # Falls back to "parallel_builds".
+    assert offsets(estimator._compute(now, estimator._pool_size(now)), now) == {
+      1: (None, -30, 30),
+      2: (1, 30, 90),
+      3: (2, 90, 210),
+      4: (3, 210, 300),
+    }
+  finally:
+    with models.session():
+      models.Worker.select().delete(bulk=True)
+
+
+def test_consumer_registers_its_pool(flux_root, monkeypatch, wait_for):
+  from flux import build, models
+  consumer = build.BuildConsumer()
+  monkeypatch.setattr(consumer, '_claim', lambda: None)
+
+  def registered_size():
+    with models.session():
+      worker = models.Worker.get(worker_id=consumer.worker_id)
+      return worker.pool_size if worker else None
+
+  consumer.start(2)
+  try:
+    wait_for(lambda: registered_size() == 2)
+    consumer.resize(3)
+    wait_for(lambda: registered_size() == 3)
+    with models.session():
+      assert models.Worker.total_pool_size() == 3
+  finally:
+    consumer.stop()
+  assert registered_size() is None
+
+
+def test_estimates_follow_the_queue_policy(estimator, monkeypatch):
+  from flux import config
+  monkeypatch.setattr(config, 'queue_policy', 'sejf')
+  monkeypatch.setattr(config, 'queue_aging_factor', 0)
+  now = estimator.now
+  assert offsets(estimator._compute(now, estimator._pool_size(now)), now) == {
+    1: (None, -30, 30),
+    2: (1, 30, 90),
+    4: (2, 90, 180),
+    3: (3, 180, 300),
+  }
+
+
+def test_pool_size_is_read_without_the_lock(estimator, monkeypatch):
+  from flux import models
+  reads = []
+
+  def total_pool_size(now=None):
+    assert not estimator._lock.locked()
+    reads.append(now)
+    return 2
+  monkeypatch.setattr(models.Worker, 'total_pool_size', total_pool_size)
+  monkeypatch.setattr(estimator, '_loaded', True)
+  assert estimator.get(1).position is None
+  assert estimator.get(2).position == 1
+  assert len(reads) == 1
@@ -0,0 +1,53 @@
+import threading
+
+
+def test_shards_of_finished_threads_are_folded(flux_root):
+  from flux import metrics
+  counter = metrics.Counter('test_requests_total', 'Test counter.', ['code'])
+  histogram = metrics.Histogram('test_duration_seconds', 'Test histogram.', buckets=(1,))
+  metrics.registry.remove(counter)
+  metrics.registry.remove(histogram)
+
+  def work():
+    counter.inc(code=200)
+    histogram.observe(0.5)
+
+  for i in range(50):
+    thread = threading.Thread(target=work)
+    thread.start()
+    thread.join()
+  work()
+
+  assert counter.samples()[0][2] == 51
+  assert dict((suffix, value) for suffix, labels, value in histogram.samples()) == \
+    {'_bucket': 51, '_sum': 25.5, '_count': 51}
+  assert len(counter._shards._shards) == 1
+  assert len(histogram._shards._shards) == 1
+
+
+def test_worker_metrics_require_authentication(flux_root):
+  import base64
+  import urllib.error
+  import urllib.request
+  from flux import config, metrics
+  server = metrics.serve('127.0.0.1', 0)
+  url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+
+  def get(user, password):
+    request = urllib.request.Request(url)
+    if user:
+      credentials = base64.b64encode('{}:{}'.format(user, password).encode()).decode()
+      request.add_header('Authorization', 'Basic ' + credentials)
+    try:
+      with urllib.request.urlopen(request, timeout=10) as response:
+        return response.status
+    except urllib.error.HTTPError as exc:
+      return exc.code
+
+  try:
+    assert get(None, None) == 401
+    assert get(config.root_user, 'wrong') == 401
+    assert get(config.root_user, config.root_password) == 200
+  finally:
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,154 @@
+import threading
+
+import pytest
+
+
+def run_with_timeout(func, timeout=30):
+  ''' Runs *func* in a thread and fails if it does not return in time,
+  so that a deadlock fails the test instead of hanging it. '''
+
+  result = []
+  thread = threading.Thread(target=lambda: result.append(func()), daemon=True)
+  thread.start()
+  thread.join(timeout)
+  assert not thread.is_alive(), 'deadlock'
+  assert result, 'function raised'
+  return result[0]
+
+
+def test_allocate_after_flush(repo, make_build, monkeypatch):
+  from flux import models
+  monkeypatch.setattr(models.Build.id_allocator, 'block_size', 1)
+  models.Build.id_allocator.reset()
+
+  def func():
+    with models.session():
+      r = models.Repository[repo]
+      first = make_build(r)
+      models.select(b for b in models.Build).count()
+      second = make_build(r)
+      return first.id, second.id
+
+  first, second = run_with_timeout(func)
+  assert second > first
+
+
+def test_allocate_after_commit_and_read(repo, make_build):
+  from flux import models
+
+  def func():
+    with models.session():
+      r = models.Repository[repo]
+      ids = [make_build(r).id]
+      models.commit()
+      r.build_count
+      models.select(b for b in models.Build).count()
+      for i in range(models.config.id_block_size + 5):
+        ids.append(make_build(r).id)
+      return ids
+
+  ids = run_with_timeout(func)
+  assert len(set(ids)) == len(ids)
+
+
+def test_rolled_back_reservation(repo, make_build):
+  from flux import models
+
+  def func():
+    with models.session():
+      r = models.Repository[repo]
+      make_build(r)
+      models.orm.flush()
+      make_build(r)
+      models.rollback()
+    with models.session():
+      r = models.Repository[repo]
+      ids = [make_build(r).id for i in range(3)]
+    with models.session():
+      return ids, models.select(b.id for b in models.Build if b.id in ids)[:]
+
+  ids, stored = run_with_timeout(func)
+  assert sorted(stored) == sorted(ids)
+
+
+def test_queue_many_builds_in_one_session(repo):
+  from flux import build, models
+
+  def func():
+    with models.session():
+      r = models.Repository[repo]
+      ids = [build.queue_build(r, 'refs/heads/master').id for i in range(30)]
+      for b in models.select(b for b in models.Build if b.id in ids):
+        build.stop_build(b)
+      return ids
+
+  ids = run_with_timeout(func)
+  assert len(set(ids)) == 30
+
+
+def test_block_is_reserved_on_separate_connection(flux_root):
+  from flux import models
+  allocator = models.IdAllocator('test:block', block_size=10)
+
+  def func():
+    with models.session():
+      ids = [allocator.next_id() for i in range(3)]
+      models.rollback()
+    with models.session():
+      return ids, models.IdSequence.get_value('test:block')
+
+  ids, value = run_with_timeout(func)
+  assert ids == [1, 2, 3]
+  assert value == 10
+
+
+def test_single_id_in_write_transaction(flux_root):
+  from flux import models
+  allocator = models.IdAllocator('test:single', block_size=10)
+
+  def func():
+    with models.session():
+      models.IdSequence.increment('test:single:lock')
+      models.orm.flush()
+      first = allocator.next_id()
+      models.rollback()
+    with models.session():
+      return first, models.IdSequence.get_value('test:single'), allocator.next_id()
+
+  first, value, second = run_with_timeout(func)
+  assert first == 1
+  assert value == 0
+  assert second == 1
+
+
+def test_filter_builds_by_commit_prefix(repo, make_build):
+  from flux import models
+
+  with models.session():
+    r = models.Repository[repo]
+    for sha in ('ab' + '0' * 38, 'abc' + '0' * 37, 'b' + '0' * 39):
+      make_build(r, commit_sha=sha)
+    query = models.select(b for b in models.Build if b.repo == r)
+    assert models.filter_builds(query, commit_sha='AB').count() == 2
+    assert models.filter_builds(query, commit_sha='abc').count() == 1
+    assert models.filter_builds(query, commit_sha='b' + '0' * 39).count() == 1
+    sql = models.filter_builds(query, commit_sha='ab').get_sql()
+    assert 'LIKE' not in sql.upper()
+
+
+def test_sequence_id_generator(make_repo):
+  from flux import models
+  with models.session():
+    first, second = make_repo().id, make_repo().id
+  generator = models.SequenceIdGenerator.for_repository(first)
+  assert models.SequenceIdGenerator.for_repository(first) is generator
+  assert generator.current_ids() == {'job': 0, 'pipeline': 0}
+
+  # A generator of another process shares the sequences of the repository.
+  other = models.SequenceIdGenerator(first, block_size=2)
+  ids = [generator.next_job_id(), other.next_job_id(), other.next_job_id(), other.next_job_id()]
+  assert len(set(ids)) == len(ids)
+  assert generator.current_ids() == {'job': ids[0], 'pipeline': 0}
+  assert other.current_ids() == {'job': ids[-1], 'pipeline': 0}
+
+  assert models.SequenceIdGenerator.for_repository(second).next_pipeline_id() == 1
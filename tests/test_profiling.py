@@ -0,0 +1,23 @@
+import pytest
+
+
+@pytest.mark.parametrize('url', ['/repositories', '/', '/api/v1/repos'])
+def test_listing_queries_do_not_grow_with_repositories(client, make_repo, make_build, url):
+  from flux import models
+  from flux.profiling import count_queries, assert_max_queries
+
+  def add_repos(count):
+    with models.session():
+      for i in range(count):
+        repo = make_repo()
+        make_build(repo, 'success')
+        make_build(repo, 'error')
+
+  add_repos(2)
+  assert client.get(url).status_code == 200
+  with count_queries() as few:
+    assert client.get(url).status_code == 200
+  add_repos(20)
+  with assert_max_queries(few.count):
+    assert client.get(url).status_code == 200
+  assert few.count <= 5, str(few)
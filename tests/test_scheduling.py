@@ -0,0 +1,49 @@
+import pytest
+
+# The durations are known after the first two builds: "long" builds take
+# 100 seconds and "short" builds 10 seconds.
+TRACE = [
+  ('long', 0, 100),
+  ('short', 0, 10),
+  ('short', 50, 10),
+  ('long', 60, 100),
+  ('short', 70, 10),
+]
+
+
+def test_select_next():
+  from flux import scheduling
+  # (expected duration, waited, queue order, item)
+  candidates = [(100, 30, 1, 'long'), (10, 20, 2, 'short'), (10, 10, 3, 'newer short')]
+  assert scheduling.select_next(candidates, scheduling.get_policy('fifo')) == 'long'
+  assert scheduling.select_next(candidates, scheduling.get_policy('sejf', 0)) == 'short'
+  assert scheduling.select_next(candidates, scheduling.get_policy('sejf', 1)) == 'short'
+  assert scheduling.select_next(candidates, scheduling.get_policy('sejf', 10)) == 'long'
+  with pytest.raises(ValueError):
+    scheduling.get_policy('lifo')
+
+
+def test_simulate_trace():
+  from flux import scheduling
+  fifo = scheduling.simulate(TRACE, 1, scheduling.get_policy('fifo'), smoothing=1)
+  assert fifo == [0, 100, 60, 60, 150]
+  sejf = scheduling.simulate(TRACE, 1, scheduling.get_policy('sejf', 0), smoothing=1)
+  assert sejf == [0, 100, 60, 70, 50]
+  assert scheduling.simulate(TRACE, 2, scheduling.get_policy('sejf', 0), smoothing=1) == [0, 0, 0, 0, 30]
+
+
+def test_aging_promotes_starved_builds():
+  from flux import scheduling
+  # A long build waits while short builds arrive faster than they run.
+  trace = TRACE[:2] + [('long', 1, 100)] + [('short', t, 10) for t in range(1, 1000, 5)]
+  starved = scheduling.simulate(trace, 1, scheduling.get_policy('sejf', 0), smoothing=1)
+  aged = scheduling.simulate(trace, 1, scheduling.get_policy('sejf', 1), smoothing=1)
+  fifo = scheduling.simulate(trace, 1, scheduling.get_policy('fifo'), smoothing=1)
+
+  # Without aging it starts when no short build is left.
+  assert starved[2] > max(starved[3:]) > 1000
+  # With aging it starts once it waited about its expected duration longer
+  # than the oldest short build, and the short builds still wait less than
+  # with fifo.
+  assert fifo[2] < aged[2] < 400
+  assert sum(aged) < sum(fifo)
@@ -0,0 +1,231 @@
+def test_delete_queued_build(client, repo):
+  from flux import build, models
+  with models.session():
+    queued = build.queue_build(models.Repository[repo], 'refs/heads/master')
+  response = client.get('/delete?build_id={}'.format(queued.id))
+  assert response.status_code == 302
+  with models.session():
+    assert models.Build.get(id=queued.id) is None
+    assert models.QueueEntry.get(build=queued.id) is None
+
+
+def test_delete_repo_with_queued_build(client, repo):
+  from flux import build, models
+  with models.session():
+    queued = build.queue_build(models.Repository[repo], 'refs/heads/master')
+  response = client.get('/delete?repo_id={}'.format(repo))
+  assert response.status_code == 302
+  with models.session():
+    assert models.Repository.get(id=repo) is None
+    assert models.QueueEntry.get(build=queued.id) is None
+
+
+def test_closed_event_streams_are_released(client):
+  from flux import config
+  for i in range(config.event_stream_limit + 2):
+    response = client.get('/events', buffered=False)
+    assert response.status_code == 200
+    response.close()
+
+
+def test_build_rows_can_be_patched(client, repo):
+  from flux import build, models
+  with models.session():
+    queued = build.queue_build(models.Repository[repo], 'refs/heads/master')
+    path = models.Repository[repo].name
+  html = client.get('/repo/' + path).get_data(as_text=True)
+  assert 'data-build-id="{}"'.format(queued.id) in html
+  assert 'data-build-field="status"' in html
+  assert 'id="page-body"' in html
+
+
+def make_user_token(name):
+  from flux import models, utils
+  with models.session():
+    user = models.User(name=name, passhash=utils.hash_pw('secret'), can_manage=False,
+      can_download_artifacts=False, can_view_buildlogs=False)
+    return user.id, models.LoginToken.create('127.0.0.1', user).token
+
+
+def test_user_changes_refresh_the_token_cache(client):
+  import uuid
+  from flux import models, utils
+  user_id, token = make_user_token('user-' + uuid.uuid4().hex[:8])
+  with models.session():
+    assert not utils.login_token_cache.get(token).user.can_manage
+  response = client.post('/user/{}'.format(user_id), data={'user_can_manage': 'on'})
+  assert response.status_code == 302
+  with models.session():
+    assert utils.login_token_cache.get(token).user.can_manage
+  response = client.get('/delete?user_id={}'.format(user_id))
+  assert response.status_code == 302
+  with models.session():
+    assert utils.login_token_cache.get(token) is None
+
+
+def test_token_loaded_before_invalidation_is_not_cached(client, monkeypatch):
+  import uuid
+  from flux import models, utils
+  user_id, token = make_user_token('user-' + uuid.uuid4().hex[:8])
+  cache = utils.LoginTokenCache()
+  get = models.LoginToken.get
+
+  def get_and_invalidate(**kwargs):
+    result = get(**kwargs)
+    cache.invalidate_user(user_id)
+    return result
+
+  monkeypatch.setattr(models.LoginToken, 'get', get_and_invalidate)
+  with models.session():
+    assert cache.get(token) is not None
+  assert token not in cache._entries
+
+
+def make_log(repo, make_build, content=b'0123456789'):
+  import os
+  from flux import models
+  with models.session():
+    build = make_build(models.Repository[repo])
+    filename = build.path(models.Build.Data_Log)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'wb') as fp:
+      fp.write(content)
+    return '/download/{}/log'.format(build.id), filename
+
+
+def test_download_range(client, repo, make_build):
+  url, filename = make_log(repo, make_build)
+  response = client.get(url, headers={'Range': 'bytes=2-5'})
+  assert response.status_code == 206
+  assert response.headers['Content-Range'] == 'bytes 2-5/10'
+  assert response.get_data() == b'2345'
+
+
+def test_download_unsatisfiable_range(client, repo, make_build):
+  url, filename = make_log(repo, make_build)
+  response = client.get(url, headers={'Range': 'bytes=20-30'})
+  assert response.status_code == 416
+  assert response.headers['Content-Range'] == 'bytes */10'
+
+
+def test_download_if_range_mismatch_sends_the_file(client, repo, make_build):
+  url, filename = make_log(repo, make_build)
+  response = client.get(url, headers={'Range': 'bytes=2-5', 'If-Range': '"outdated"'})
+  assert response.status_code == 200
+  assert response.get_data() == b'0123456789'
+
+
+def test_download_if_none_match(client, repo, make_build):
+  url, filename = make_log(repo, make_build)
+  etag = client.get(url).headers['ETag']
+  response = client.get(url, headers={'If-None-Match': etag})
+  assert response.status_code == 304
+  assert response.get_data() == b''
+
+
+def test_download_offload(client, repo, make_build, monkeypatch):
+  import os
+  from flux import config
+  url, filename = make_log(repo, make_build)
+  monkeypatch.setattr(config, 'file_offload', 'x-sendfile')
+  response = client.get(url)
+  assert response.status_code == 200
+  assert response.headers['X-Sendfile'] == os.path.abspath(filename)
+  assert response.get_data() == b''
+
+  monkeypatch.setattr(config, 'file_offload', 'x-accel-redirect')
+  response = client.get(url)
+  relpath = os.path.relpath(filename, config.root_dir).replace(os.sep, '/')
+  assert response.headers['X-Accel-Redirect'] == config.file_offload_prefix + relpath
+  assert response.headers['Content-Length'] == '10'
+
+
+def make_artifact(repo, make_build, members):
+  import os
+  import zipfile
+  from flux import models
+  with models.session():
+    build = make_build(models.Repository[repo])
+    filename = build.path(models.Build.Data_Artifact)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with zipfile.ZipFile(filename, 'w') as zf:
+      for name, data in members.items():
+        zf.writestr(name, data, zipfile.ZIP_STORED if name.endswith('.bin') else zipfile.ZIP_DEFLATED)
+    return '/artifacts/{}/'.format(build.id), filename
+
+
+def test_artifact_member_download(client, repo, make_build):
+  url, filename = make_artifact(repo, make_build, {'dir/a.txt': 'hello', 'b.bin': b'0123456789'})
+  response = client.get(url + 'dir/a.txt')
+  assert response.status_code == 200
+  assert response.get_data() == b'hello'
+  response = client.get(url + 'b.bin', headers={'Range': 'bytes=3-4'})
+  assert response.status_code == 206
+  assert response.get_data() == b'34'
+  assert 'a.txt' in client.get(url + 'dir').get_data(as_text=True)
+
+
+def test_artifact_missing_member(client, repo, make_build):
+  url, filename = make_artifact(repo, make_build, {'a.txt': 'hello'})
+  assert client.get(url + 'b.txt').status_code == 404
+
+
+def test_artifact_paths_outside_the_archive(client, repo, make_build):
+  url, filename = make_artifact(repo, make_build, {'../a.txt': 'hello', 'b.txt': 'world'})
+  assert client.get(url + '../a.txt').status_code == 404
+  assert client.get(url + 'b.txt').status_code == 200
+
+
+def test_artifact_index_rejects_absolute_paths(tmp_path):
+  import zipfile
+  from flux import file_utils
+  filename = str(tmp_path / 'artifact.zip')
+  with zipfile.ZipFile(filename, 'w') as zf:
+    zf.writestr('dir/a.txt', 'hello')
+  index = file_utils.ZipIndex(filename)
+  assert index.get_member('dir/a.txt')
+  assert index.get_member('/dir/a.txt') is None
+  assert index.get_member('dir/../dir/a.txt') is None
+  assert index.is_folder('dir/')
+  assert not index.is_folder('/dir')
+
+
+def test_artifact_index_cache_reloads_changed_files(tmp_path):
+  import zipfile
+  from flux import utils
+  filename = str(tmp_path / 'artifact.zip')
+  with zipfile.ZipFile(filename, 'w') as zf:
+    zf.writestr('a.txt', 'hello')
+  cache = utils.ZipIndexCache(max_size=2)
+  index = cache.get(filename)
+  assert cache.get(filename) is index
+  with zipfile.ZipFile(filename, 'w') as zf:
+    zf.writestr('a.txt', 'hello')
+    zf.writestr('b.txt', 'world')
+  assert cache.get(filename) is not index
+  assert cache.get(filename).get_member('b.txt')
+
+
+def test_only_managers_resize_the_workers(client, monkeypatch):
+  import uuid
+  from flux import app, views
+  name = 'user-' + uuid.uuid4().hex[:8]
+  make_user_token(name)
+  user_client = app.test_client()
+  response = user_client.post('/login', data={'user_name': name, 'user_password': 'secret'})
+  assert response.status_code == 302
+
+  resized = []
+  monkeypatch.setattr(views, 'resize_consumers', resized.append)
+  monkeypatch.setattr(views, 'pool_size', lambda: 2)
+  assert user_client.get('/workers').status_code == 403
+  assert user_client.post('/workers', data={'pool_size': '3'}).status_code == 403
+  assert resized == []
+
+  assert client.post('/workers', data={'pool_size': '0'}).status_code == 200
+  assert client.post('/workers', data={'pool_size': '3'}).status_code == 302
+  assert resized == [3]
+  monkeypatch.setattr(views, 'pool_size', lambda: 0)
+  response = client.post('/workers', data={'pool_size': '4'})
+  assert 'does not run build workers' in response.get_data(as_text=True)
+  assert resized == [3]
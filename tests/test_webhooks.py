@@ -0,0 +1,86 @@
+import json
+import uuid
+
+
+def add_delivery(r, commit, offset=0):
+  from flux import models
+  owner, name = r.name.split('/')
+  payload = {'repository': {'owner': {'username': owner}, 'name': name},
+             'ref': 'refs/heads/master', 'after': commit, 'secret': r.secret}
+  return models.WebhookDelivery(delivery_id=uuid.uuid4().hex, api='gogs', repo=r, headers={},
+    payload=json.dumps(payload).encode('utf8'),
+    date_received=models.datetime.datetime.now() + models.datetime.timedelta(microseconds=offset)).delivery_id
+
+
+def test_deliveries_are_built_in_order(repo):
+  from flux import models, webhooks
+  with models.session():
+    r = models.Repository[repo]
+    for i in range(3):
+      add_delivery(r, str(i) * 40, i)
+
+  assert webhooks.process_deliveries() == 3
+  with models.session():
+    builds = models.select(b for b in models.Build if b.repo.id == repo).order_by(models.Build.num)[:]
+    assert [b.commit_sha[0] for b in builds] == ['0', '1', '2']
+
+
+def test_delivery_of_deleted_repository_fails(repo):
+  from flux import models, webhooks
+  with models.session():
+    delivery_id = add_delivery(models.Repository[repo], '0' * 40)
+  with models.session():
+    models.Repository[repo].delete()
+
+  assert webhooks.process_deliveries() >= 1
+  with models.session():
+    delivery = models.WebhookDelivery[delivery_id]
+    assert delivery.status == models.WebhookDelivery.Status_Failed
+    assert 'unknown repository' in delivery.message
+
+
+def test_broken_delivery_does_not_block_the_others(repo, monkeypatch):
+  from flux import config, models, webhooks
+  with models.session():
+    r = models.Repository[repo]
+    broken = add_delivery(r, 'b' * 40)
+    working = add_delivery(r, 'a' * 40, 1)
+
+  parse_push = webhooks.parse_push
+  def parse_or_fail(api, headers, data):
+    if b'b' * 40 in data:
+      raise RuntimeError('broken')
+    return parse_push(api, headers, data)
+  monkeypatch.setattr(webhooks, 'parse_push', parse_or_fail)
+
+  webhooks.process_deliveries()
+  with models.session():
+    assert models.WebhookDelivery[working].status == models.WebhookDelivery.Status_Processed
+    assert models.WebhookDelivery[broken].status == models.WebhookDelivery.Status_Pending
+    assert models.WebhookDelivery[broken].attempts == 1
+  for i in range(config.webhook_max_attempts - 1):
+    webhooks.process_deliveries()
+  with models.session():
+    delivery = models.WebhookDelivery[broken]
+    assert delivery.status == models.WebhookDelivery.Status_Error
+    assert delivery.attempts == config.webhook_max_attempts
+    assert delivery.message == 'RuntimeError: broken'
+    assert [b.commit_sha[0] for b in models.Repository[repo].builds] == ['a']
+
+
+def test_bitbucket_push_of_deleted_refs_is_accepted(client, repo):
+  from flux import models, webhooks
+  with models.session():
+    owner, name = models.Repository[repo].name.split('/')
+  payload = {'repository': {'project': {'name': owner}, 'name': name},
+             'changes': [{'type': 'DELETE', 'refId': 'refs/heads/old', 'toHash': '0' * 40}]}
+  headers = webhooks.new_delivery_id('bitbucket', {'X-Event-Key': 'repo:refs_changed', 'X-Hub-Signature': 'sha256='})
+  headers, data = webhooks.sign_delivery('bitbucket', headers, json.dumps(payload).encode('utf8'), 'secret')
+
+  response = client.post('/hook/push?api=bitbucket', data=data, headers=headers, content_type='application/json')
+  assert response.status_code == 202
+  assert webhooks.process_deliveries() >= 1
+  with models.session():
+    assert models.Repository[repo].builds.is_empty()
+    delivery = models.WebhookDelivery.get(delivery_id=webhooks.get_delivery_id('bitbucket', headers, data))
+    assert delivery.status == models.WebhookDelivery.Status_Processed